@@ -2,7 +2,7 @@
 import datetime
 import argparse
 
-from basebot import BaseIrcBot, HelpCommand, VersionCommand, PingCommand, ReconnectCommand, QuitCommand, IssueCommand, MsgCommand  # RestartCommand,
+from basebot import BaseIrcBot, HelpCommand, VersionCommand, PingCommand, ReconnectCommand, ReloadCommand, QuitCommand, IssueCommand, MsgCommand, FlushCacheCommand, PerfCommand, ProfileCommand  # RestartCommand,
 from auth import BaseAuthTrigger
 
 import settings
@@ -12,14 +12,14 @@ class TrajRandTrigger(BaseAuthTrigger):
     REGEXP = r'(?P<username>[^ ]+)? ?obtient un (?P<roll>\d{1,3}) \(1-100\)'
 
     def handle(self):
-        self.bot.auth_plugin.get_user(self.ev.source.nick, self.handle2)
+        self.bot.auth_plugin.get_user(self.ev.source.nick, self.handle2, plugin=self.plugin)
 
     def handle2(self, source):
         if source.auth == '`Xrs`Jeeju`':
             user = self.get_user_from_line()
             if not user:  # damn Traj, need a special rule just for him
                 user = 'Traj'
-            self.bot.auth_plugin.get_user(user, self.process)
+            self.bot.auth_plugin.get_user(user, self.process, plugin=self.plugin)
 
     def process(self, user, *args):
         roll = self.match.group('roll')
@@ -30,7 +30,7 @@ class TrajRandTrigger(BaseAuthTrigger):
 class StupidIrcBot(BaseIrcBot):
     VERSION = u'0.9.7'
 
-    COMMANDS = [HelpCommand, VersionCommand, PingCommand, ReconnectCommand, IssueCommand, QuitCommand, MsgCommand]  # RestartCommand
+    COMMANDS = [HelpCommand, VersionCommand, PingCommand, ReconnectCommand, ReloadCommand, IssueCommand, FlushCacheCommand, PerfCommand, ProfileCommand, QuitCommand, MsgCommand]  # RestartCommand
     TRIGGERS = [TrajRandTrigger,]
 
     def __init__(self, custom_settings=None):
@@ -0,0 +1,131 @@
+"""
+Logging without waiting for the disk.
+
+AsyncHandler puts the records in a bounded in-memory queue, a background thread
+writes them with the real handlers, flushing once per batch instead of once per record.
+"""
+import logging
+import os
+import time
+from logging import handlers
+from threading import Thread
+from Queue import Queue, Full, Empty
+
+
+class BatchingMixin(object):
+    """
+    for the StreamHandler based handlers: no flush after every record while batching
+    """
+    batching = False
+
+    def flush(self):
+        if not self.batching:
+            super(BatchingMixin, self).flush()
+
+
+class RotatingFileHandler(BatchingMixin, handlers.RotatingFileHandler):
+    pass
+
+
+class TimedRotatingFileHandler(BatchingMixin, handlers.TimedRotatingFileHandler):
+    pass
+
+
+class AsyncHandler(logging.Handler):
+    """
+    fsync_interval:
+    * None: never fsync, let the os do its job
+    * 0: fsync after every batch
+    * N: fsync at most every N seconds
+    """
+    # how long flush waits for the queue to be written
+    FLUSH_TIMEOUT = 5  # in seconds
+
+    def __init__(self, targets, max_queue=10000, batch_size=200, fsync_interval=None):
+        logging.Handler.__init__(self)
+        self.targets = targets
+        self.batch_size = batch_size
+        self.fsync_interval = fsync_interval
+        self.queue = Queue(max_queue)
+
+        self.dropped = 0  # the records lost because the queue was full
+        self._reported = 0
+        self._last_fsync = 0
+        self._formatter = logging.Formatter()  # only for the tracebacks
+
+        t = Thread(target=self._writer, name='log-writer')
+        t.daemon = True
+        t.start()
+
+    def prepare(self, record):
+        """
+        like the QueueHandler of python 3, the message and the traceback are formatted right away:
+        the args could change before the record is written, and exc_info keeps the frames alive in the queue
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self._formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def flush(self):
+        """
+        waits until everything queued is written (called by logging at exit)
+        """
+        deadline = time.time() + self.FLUSH_TIMEOUT
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+
+    def _writer(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+
+            try:
+                self._write(batch)
+            except Exception:
+                pass  # nowhere to log it
+            finally:
+                for record in batch:
+                    self.queue.task_done()
+
+    def _write(self, batch):
+        if self.dropped != self._reported:
+            lost = self.dropped - self._reported
+            self._reported = self.dropped
+            batch = batch + [logging.LogRecord(batch[0].name, logging.WARNING, __file__, 0,
+                                               'Log queue full, %d records dropped.', (lost,), None)]
+
+        for target in self.targets:
+            target.batching = True
+            try:
+                for record in batch:
+                    if record.levelno >= target.level:
+                        target.handle(record)
+            finally:
+                target.batching = False
+            target.flush()
+
+        if self.fsync_interval is not None and batch[-1].created - self._last_fsync >= self.fsync_interval:
+            self._last_fsync = batch[-1].created
+            for target in self.targets:
+                stream = getattr(target, 'stream', None)
+                if stream:
+                    os.fsync(stream.fileno())
@@ -1,18 +1,249 @@
+import os
+import sqlite3
 import threading
+import time
+from collections import OrderedDict
 
+from basebot import BaseCommand, BaseBotPlugin, BaseTrigger, PRIORITY_LOW
+from engine import Blocking, Sleep
+from flood import TokenBucket, monotonic
 import settings
-from basebot import BaseCommand, BaseBotPlugin, BaseTrigger
+
+
+class AuthCache(object):
+    """
+    The answers of the auth bot by nick and host, kept ttl seconds (negative_ttl for
+    the users who are not authed) and saved in a sqlite file to survive a restart.
+    A nick only has one host at a time, the entry is ignored if it connects from another one.
+    """
+
+    def __init__(self, db_file, ttl, negative_ttl):
+        self.db_file = db_file
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = {}  # nick -> (host, auth or None, expires at)
+        self.dirty = False  # changed since the last save
+        self.forgotten = set()  # the nicks to delete from the file at the next save
+        self._lock = threading.Lock()
+        if os.path.isfile(self.db_file):
+            self.load()
+
+    def get(self, nick, host):
+        """
+        returns (True, auth), or (False, None) if the nick with this host is unknown or expired
+        """
+        entry = self.entries.get(nick)
+        if entry is None or host is None or entry[0] != host or entry[2] <= time.time():
+            return False, None
+        return True, entry[1]
+
+    def expires(self, nick):
+        """
+        when the entry of nick expires, None if there is none
+        """
+        entry = self.entries.get(nick)
+        return entry[2] if entry is not None else None
+
+    def set(self, nick, host, auth):
+        ttl = self.ttl if auth else self.negative_ttl
+        if host is None or ttl <= 0:
+            return
+        with self._lock:
+            self.entries[nick] = (host, auth, time.time() + ttl)
+            self.forgotten.discard(nick)
+            self.dirty = True
+
+    def forget(self, nick):
+        with self._lock:
+            if self.entries.pop(nick, None) is not None:
+                self.forgotten.add(nick)
+                self.dirty = True
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file)
+        conn.execute("""CREATE TABLE IF NOT EXISTS auths (
+                            nick VARCHAR(50) PRIMARY KEY,
+                            host VARCHAR(200) NOT NULL,
+                            auth VARCHAR(50),
+                            expires REAL NOT NULL);""")
+        return conn
+
+    def load(self):
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT nick, host, auth, expires FROM auths WHERE expires > ?;", [time.time()]).fetchall()
+        finally:
+            conn.close()
+        with self._lock:
+            for nick, host, auth, expires in rows:
+                self.entries[nick] = (host, auth, expires)
+
+    def save(self):
+        """
+        writes the entries not expired yet, and deletes the expired and forgotten ones,
+        leaving alone the other rows, in case another process uses the same file
+        """
+        now = time.time()
+        with self._lock:
+            rows = [(nick, host, auth, expires) for nick, (host, auth, expires) in self.entries.items() if expires > now]
+            forgotten = [(nick,) for nick in self.forgotten]
+            self.forgotten = set()
+            self.dirty = False
+        conn = self._connect()
+        try:
+            with conn:  # in a transaction
+                conn.execute("DELETE FROM auths WHERE expires <= ?;", [now])
+                conn.executemany("DELETE FROM auths WHERE nick = ?;", forgotten)
+                conn.executemany("INSERT OR REPLACE INTO auths (nick, host, auth, expires) VALUES (?, ?, ?, ?);", rows)
+        finally:
+            conn.close()
+
+
+class AuthQueryQueue(object):
+    """
+    The nicks waiting to be checked with the auth bot, in order and each one once,
+    let out at rate per second (burst at once) by BaseIdentPlugin._send_queries,
+    so a big channel can't fill the outgoing queue with queries.
+    """
+
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.pending = OrderedDict()  # nick -> the BaseAuths waiting for it, usually one
+        self.scheduled = False  # _send_queries will run
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, auth):
+        """
+        returns True if the queries must be scheduled
+        """
+        with self._lock:
+            self.pending.setdefault(auth.nick, []).append(auth)
+            if self.scheduled:
+                return False
+            self.scheduled = True
+            return True
+
+    def take(self):
+        """
+        returns the (nick, auths) that can be asked now, and the delay before the next ones,
+        None if there are none left
+        """
+        with self._lock:
+            now = monotonic()
+            batch = []
+            while self.pending and not self.bucket.delay(1, now):
+                self.bucket.consume(1, now)
+                batch.append(self.pending.popitem(last=False))
+            if not self.pending:
+                self.scheduled = False
+                return batch, None
+            return batch, self.bucket.delay(1, now)
+
+
+class AuthFuture(object):
+    """
+    What get_user returns: resolved once, with the BaseAuth of the nick, when the auth bot
+    answered or timed out (right away if the auth was known), then its callbacks are called
+    and dropped. It can be cancelled, or given a timeout after which it is resolved with
+    the auth as it is, still unknown.
+    """
+
+    def __init__(self, bot, auth):
+        self.bot = bot
+        self.auth = auth
+        self.done = False
+        self.cancelled = False
+        self._callbacks = []  # (fn, args, plugin)
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add_done_callback(self, fn, *args, **kwargs):
+        """
+        fn(auth, *args) is called once resolved, right now if it already is.
+        With plugin=PLUGIN, a callback resolved later is run by a worker of this plugin,
+        not in the thread resolving the future (the single slot of the auth plugin, or the reactor)
+        """
+        plugin = kwargs.get('plugin')
+        with self._lock:
+            if not self.done:
+                self._callbacks.append((fn, args, plugin))
+                return
+        if not self.cancelled:
+            fn(self.auth, *args)
+
+    def set_timeout(self, seconds):
+        with self._lock:
+            if self.done:
+                return
+            self._timer = self.bot.timers.call_later(seconds, self._expire)
+
+    def cancel(self):
+        """
+        the callbacks won't be called, returns False if it was already resolved
+        """
+        if self._finish(cancelled=True) is None:  # [] for a pending future without callback
+            return False
+        if isinstance(self.auth, BaseAuth):
+            self.auth._discard(self)
+        return True
+
+    def _finish(self, cancelled=False):
+        """
+        returns the callbacks to call, None if it was already done
+        """
+        with self._lock:
+            if self.done:
+                return None
+            self.done = True
+            self.cancelled = cancelled
+            callbacks, self._callbacks = self._callbacks, []
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        return callbacks
+
+    def _resolve(self):
+        for fn, args, plugin in self._finish() or []:
+            if plugin is None:
+                fn(self.auth, *args)
+            elif not self.bot.workers.submit(plugin, fn, self.auth, *args):
+                self.bot.error_logger.warning('Worker queue full (%d), dropping %s.' % (self.bot.workers.queue_depth(), fn))
+
+    def _expire(self):
+        """
+        called from the timer thread, the callbacks are run by a worker like for an answer
+        """
+        if isinstance(self.auth, BaseAuth):
+            self.auth._discard(self)
+        if not self.bot.workers.submit(self.bot.auth_plugin, self._resolve):
+            self._resolve()
 
 
 class BaseAuth(object):
-    def __init__(self, bot, nick):
+    def __init__(self, bot, nick, known=False, auth=None, expires=None):
+        """
+        asks the auth bot, unless the auth is already known (from the cache, until expires)
+        """
         self.nick = nick
         self.auth = None
-        self.callbacks = []
+        self.waiters = []  # the AuthFutures to resolve with the next answer
+        self._lock = threading.Lock()
         self._checked = False
         self.bot = bot
         self.timeout_flag = False
-        self.check_authed()
+        self.timeout = None  # the Timer of the pending query
+        self.check_started = None  # when the auth bot was asked, for the metrics
+        self.expires = None  # when the auth has to be checked again, None while it is unknown
+        if known:
+            self._checked = True
+            self.is_checking = False
+            self.auth = auth
+            self.expires = expires if expires is not None else self._expiry(auth)
+        else:
+            self.check_authed()
 
     def get_auth(self):
         if self.auth:
@@ -26,38 +257,85 @@ class BaseAuth(object):
 
         return u
 
-    def process_callbacks(self):
-        for cb in self.callbacks:
-            if not cb.get('_lock', False):
-                cb['_lock'] = True
-                cb['fn'](self, *cb['args'])
-                del cb
+    def _expiry(self, auth):
+        plugin = self.bot.auth_plugin
+        return time.time() + (plugin.AUTH_CACHE_TTL if auth else plugin.AUTH_CACHE_NEGATIVE_TTL)
 
-    def set_timeout(self):
-        def _timedout():
-            if self.timeout_flag:
-                # the bot timed out, netsplit or whatever, he is not responding
-                self.bot.error_logger.error("%s is not responding." % settings.AUTH_BOT)
-                self.set_auth(None)
+    def is_stale(self):
+        """
+        the auth is known but too old to be trusted
+        """
+        return not self.is_checking and self.expires is not None and self.expires <= time.time()
+
+    def future(self):
+        """
+        a new AuthFuture, already resolved if nothing is being checked
+        """
+        future = AuthFuture(self.bot, self)
+        with self._lock:
+            waiting = self.is_checking
+            if waiting:
+                self.waiters.append(future)
+        if not waiting:
+            future._resolve()
+        return future
+
+    def _discard(self, future):
+        with self._lock:
+            if future in self.waiters:
+                self.waiters.remove(future)
 
+    def set_timeout(self):
         self.timeout_flag = True
-        threading.Timer(self.bot.auth_plugin.AUTH_BOT_TIMEOUT, _timedout).start()
+        if self.timeout is not None:
+            self.timeout.cancel()
+        self.timeout = self.bot.timers.call_later(self.bot.auth_plugin.AUTH_BOT_TIMEOUT, self._expire)
+
+    def _expire(self):
+        """
+        called from the timer thread, the callbacks are run by a worker like for an answer
+        """
+        if not self.bot.workers.submit(self.bot.auth_plugin, self._timedout):
+            self._timedout()  # the workers are overloaded, late is better than never
+
+    def _timedout(self):
+        if self.timeout_flag:
+            # the bot timed out, netsplit or whatever, he is not responding
+            self.bot.error_logger.error("%s is not responding." % self.bot.auth_plugin.AUTH_BOT)
+            self.bot.metrics.inc('auth_timeouts_total')
+            self.check_started = None
+            self.set_auth(None)
 
     def check_authed(self):
         self._checked = True
         self.is_checking = True
-        self.bot.send(self.bot.auth_plugin.AUTH_BOT, self.USER_INFO_CMD % self.nick)
-        self.set_timeout()
+        self.bot.auth_plugin.queue_check(self)
 
-    def add_callback(self, cb, args):
-        if cb:
-            self.callbacks.append({'fn':cb,'args':args})
+    def query_sent(self):
+        """
+        called by the auth plugin when it asks the auth bot
+        """
+        self.check_started = time.time()
+        self.bot.metrics.inc('auth_checks_total')
+        self.set_timeout()
 
     def set_auth(self, auth):
+        if self.check_started:
+            self.bot.metrics.observe('auth_roundtrip_seconds', time.time() - self.check_started)
+            self.check_started = None
+            # the auth bot answered, this was not a timeout
+            self.bot.auth_plugin.auth_cache.set(self.nick, self.bot.auth_plugin.hosts.get(self.nick), auth)
         self.timeout_flag = False
-        self.is_checking = False
-        self.auth = auth
-        self.process_callbacks()
+        if self.timeout is not None:
+            self.timeout.cancel()
+            self.timeout = None
+        with self._lock:
+            self.is_checking = False
+            self.auth = auth
+            self.expires = self._expiry(auth)
+            waiters, self.waiters = self.waiters, []
+        for future in waiters:
+            future._resolve()
 
 
 class BaseAuthCommand(BaseCommand):
@@ -80,15 +358,15 @@ class BaseAuthCommand(BaseCommand):
 
     def check_admin(self, user):
         if self._is_admin():
-            self.bot.auth_plugin.get_user(self.get_user_from_line(), self.process)
+            self.bot.auth_plugin.get_user(self.get_user_from_line(), self.process, plugin=self.plugin)
         else:
             self.bot.send(self.ev.target, self.get_needs_to_be_admin())
 
     def handle(self):
         if self.REQUIRE_ADMIN:
-            self.bot.auth_plugin.get_user(self.ev.source.nick, self.check_admin)
+            self.bot.auth_plugin.get_user(self.ev.source.nick, self.check_admin, plugin=self.plugin)
         else:
-            self.bot.auth_plugin.get_user(self.get_user_from_line(), self.process)
+            self.bot.auth_plugin.get_user(self.get_user_from_line(), self.process, plugin=self.plugin)
 
     def process(self, user, *args, **kwargs):
         if user:
@@ -105,9 +383,9 @@ class AuthCommand(BaseAuthCommand):
 
     def handle(self):
         if self.REQUIRE_ADMIN:
-            self.bot.auth_plugin.get_user(self.ev.source.nick, self.check_admin, force_check=True)
+            self.bot.auth_plugin.get_user(self.ev.source.nick, self.check_admin, force_check=True, plugin=self.plugin)
         else:
-            self.bot.auth_plugin.get_user(self.get_user_from_line(), self.process, force_check=True)
+            self.bot.auth_plugin.get_user(self.get_user_from_line(), self.process, force_check=True, plugin=self.plugin)
 
     def get_response(self):
         if self.user.nick:
@@ -132,7 +410,7 @@ class BaseAuthTrigger(BaseTrigger):
 
     def handle(self):
         # this method is just here to be homogenous with BaseCommand
-        self.bot.auth_plugin.get_user(self.get_user_from_line(), self.process)
+        self.bot.auth_plugin.get_user(self.get_user_from_line(), self.process, plugin=self.plugin)
 
     def process(self, *args):
         pass
@@ -145,7 +423,7 @@ class BaseAuthPlugin(BaseBotPlugin):
 
     an auth plugin is a bit of a specific plugin,
     it shouldn't lie in settings.PLUGINS but in settings.AUTH_PLUGIN
-    the get_user method could be asynchronous in some case, and so will always return None
+    the get_user method could be asynchronous in some case, and so returns an AuthFuture
     """
     def get_user(self, user, cb, *args, **kwargs):
         """
@@ -153,8 +431,11 @@ class BaseAuthPlugin(BaseBotPlugin):
         it is asynchronous, and will call command.process() passing user as an argument
         once it knows his real name
         """
+        kwargs.pop('plugin', None)  # already in the worker of the plugin
         cb(user=user, *args, **kwargs)
-        return None
+        future = AuthFuture(self.bot, user)
+        future._resolve()
+        return future
 
     def get_username(self, user):
         return user
@@ -169,60 +450,241 @@ class BaseIdentPlugin(BaseAuthPlugin):
     AUTH_CLASS = BaseAuth
     AUTH_BOT_TIMEOUT = 5  # in seconds
 
+    # the auths are shared, the replies of the auth bot are handled one at a time
+    MAX_CONCURRENCY = 1
+
+    # how long the answers of the auth bot are trusted, in seconds, 0 to always ask
+    AUTH_CACHE_TTL = getattr(settings, 'AUTH_CACHE_TTL', 3600)
+    # the same for the users who are not authed, they can auth at any time
+    AUTH_CACHE_NEGATIVE_TTL = getattr(settings, 'AUTH_CACHE_NEGATIVE_TTL', 300)
+    # how often the cache is saved to auth-<network>.db, in seconds
+    AUTH_CACHE_SAVE_INTERVAL = getattr(settings, 'AUTH_CACHE_SAVE_INTERVAL', 60)
+
+    # the queries to the auth bot per second, and how many can be sent at once
+    AUTH_QUERY_RATE = getattr(settings, 'AUTH_QUERY_RATE', 5)
+    AUTH_QUERY_BURST = getattr(settings, 'AUTH_QUERY_BURST', 10)
+    # behind the replies, so the queries of a big join don't delay them,
+    # and taking turns with the feed announcements in the round robin of the outgoing queue
+    AUTH_QUERY_PRIORITY = PRIORITY_LOW
+
+    # where the server supports them (not QuakeNet), the IRCv3 capabilities telling the accounts
+    # of the users, the auth bot is then only asked about the users we share no channel with.
+    # account-tag is not asked, the irc library can't parse the message tags
+    AUTH_IRCV3 = getattr(settings, 'AUTH_IRCV3', True)
+    CAPABILITIES = ('account-notify', 'extended-join')
+    # the WHO of a joined channel with the accounts (WHOX), at most one every WHOX_INTERVAL seconds
+    WHOX_INTERVAL = 1
+    WHOX_TOKEN = '482'  # tells our replies from the others
+
     def __init__(self, bot):
         super(BaseIdentPlugin, self).__init__(bot)
         self.auths = {}
+        self._auths_lock = threading.Lock()  # get_auth is called by the workers
+        self.hosts = {}  # nick -> host, from the joins and messages
+        self.auth_cache = AuthCache(self.bot._log_file_name('auth-%s.db' % self.bot.network_name),
+                                    self.AUTH_CACHE_TTL, self.AUTH_CACHE_NEGATIVE_TTL)
+        self.saver = None
+        self.auth_queries = AuthQueryQueue(self.AUTH_QUERY_RATE, self.AUTH_QUERY_BURST)
+        self.caps = set()  # the capabilities acknowledged by the server
+        self.whox = False  # the server supports WHOX
+        self._whox_next = 0  # when the next WHOX can be sent
 
     def get_auth(self, user):
-        if user in self.auths:
-            auth = self.auths[user]
-        else:
-            auth = self.AUTH_CLASS(self.bot, user)
-            self.auths[user] = auth
+        """
+        the BaseAuth of user, checked again with the auth bot once it expired
+        """
+        with self._auths_lock:
+            auth = self.auths.get(user)
+            if auth is None:
+                hit, cached = self.auth_cache.get(user, self.hosts.get(user))
+                self.bot.metrics.inc('auth_cache_%s_total' % ('hits' if hit else 'misses'))
+                auth = self.AUTH_CLASS(self.bot, user, known=hit, auth=cached, expires=self.auth_cache.expires(user) if hit else None)
+                self.auths[user] = auth
+            elif auth.is_stale():
+                self.bot.metrics.inc('auth_memory_expired_total')
+                auth.check_authed()
+            else:
+                self.bot.metrics.inc('auth_memory_hits_total')
         return auth
 
+    def queue_check(self, auth):
+        if self.auth_queries.put(auth):
+            # nothing is waiting for the rate limit, sent from this thread
+            self._send_queries()
+
+    def _send_queries(self):
+        batch, delay = self.auth_queries.take()
+        for nick, auths in batch:
+            for auth in auths:
+                auth.query_sent()  # before the answer can come
+        if batch:
+            self.bot.send(self.AUTH_BOT, [self.AUTH_CLASS.USER_INFO_CMD % nick for nick, auths in batch], priority=self.AUTH_QUERY_PRIORITY)
+        if delay is not None:
+            self.bot.timers.call_later(delay, self._send_queries)
+
+    def account_known(self, nick, host, account):
+        """
+        the server told us the account of nick (None if it is not logged in), no need to ask the auth bot
+        """
+        if host is not None:
+            if self.hosts.get(nick, host) != host:
+                self.forget(nick)
+            self.hosts[nick] = host
+        self.auth_cache.set(nick, self.hosts.get(nick), account)
+        with self._auths_lock:
+            auth = self.auths.get(nick)
+            if auth is None:
+                self.auths[nick] = self.AUTH_CLASS(self.bot, nick, known=True, auth=account)
+                return
+        if auth.is_checking:
+            auth.set_auth(account)  # answers the commands waiting for it
+        else:
+            auth.auth = account
+            auth.expires = auth._expiry(account)
+
+    def forget(self, nick):
+        """
+        the nick is gone, or somebody else can take it
+        """
+        with self._auths_lock:
+            self.auths.pop(nick, None)
+        self.hosts.pop(nick, None)
+        self.auth_cache.forget(nick)
+
     def get_user(self, user, cb, *args, **kwargs):
+        """
+        returns an AuthFuture, cb(auth, *args) is called once it is resolved.
+        force_check=True asks the auth bot even if the auth is known,
+        timeout=SECONDS calls cb anyway after this delay, with the auth still unknown,
+        plugin=PLUGIN runs cb in a worker of this plugin (see AuthFuture.add_done_callback)
+        """
         auth = self.get_auth(user)
-        if 'force_check' in kwargs and kwargs['force_check'] and not auth.is_checking:
+        if kwargs.get('force_check') and not auth.is_checking:
             auth.check_authed()
 
-        auth.add_callback(cb, args)
-        if auth._checked and not auth.is_checking:
-            auth.process_callbacks()
+        future = auth.future()
+        if kwargs.get('timeout'):
+            future.set_timeout(kwargs['timeout'])
+        if cb:
+            future.add_done_callback(cb, *args, plugin=kwargs.get('plugin'))
+        return future
 
     def get_username(self, user):
         return user.get_auth()
 
     def on_welcome(self, serv, ev):
-        self.authentify()
-
-    def _on_join(self, serv, ev):
-        nick = ev.source.nick
-        self.auths[nick] = self.AUTH_CLASS(self.bot, nick)
+        if self.bot.owns(self.AUTH_BOT):  # only one shard process authentifies the bot
+            self.authentify()
+        self.caps = set()
+        self.whox = False
+        if self.AUTH_IRCV3 and self.bot.owns(self.AUTH_BOT):
+            # after the registration, a server without CAP only answers an unknown command
+            serv.cap('REQ', *self.CAPABILITIES)
+        if self.saver is None or self.saver.done:
+            self.saver = self.spawn(self._save_cache())
+
+    def on_disconnect(self, serv, ev):
+        if self.auth_cache.dirty:
+            self._save_now()
+
+    def _save_now(self):
+        try:
+            self.auth_cache.save()
+        except sqlite3.Error, e:
+            self.bot.error_logger.warning('Could not save the auth cache to %s : %s' % (self.auth_cache.db_file, e))
+
+    def _save_cache(self):
+        while True:
+            yield Sleep(self.AUTH_CACHE_SAVE_INTERVAL)
+            if self.auth_cache.dirty:
+                yield Blocking(self._save_now)
+
+    def _seen(self, source):
+        if not source or '@' not in source:
+            return  # a server, or a log without the hosts (see bench/replay.py)
+        nick = source.nick
+        host = source.host
+        if self.hosts.get(nick, host) != host:
+            # not the same user anymore
+            self.forget(nick)
+        self.hosts[nick] = host
+
+    def on_join(self, serv, ev):
+        self._seen(ev.source)
+        if 'extended-join' in self.caps and ev.arguments and '@' in ev.source:
+            # JOIN #channel account :real name
+            account = ev.arguments[0]
+            self.account_known(ev.source.nick, ev.source.host, None if account == '*' else account)
+
+    # IRCv3
+
+    def on_cap(self, serv, ev):
+        # CAP * ACK :account-notify extended-join
+        if len(ev.arguments) < 2:
+            return
+        if ev.arguments[0] == 'ACK':
+            for cap in ev.arguments[1].split():
+                if cap.startswith('-'):
+                    self.caps.discard(cap[1:])
+                else:
+                    self.caps.add(cap.lstrip('~='))
+            self.bot.error_logger.info('Capabilities acknowledged by %s : %s' % (self.bot.network_name, ', '.join(sorted(self.caps))))
+        elif ev.arguments[0] == 'NAK':
+            self.bot.error_logger.info('Capabilities refused by %s : %s, the auths are asked to %s.' % (self.bot.network_name, ev.arguments[1], self.AUTH_BOT))
+
+    def on_featurelist(self, serv, ev):
+        # the irc library ignores the features without a value, like WHOX
+        if 'WHOX' in ev.arguments:
+            self.whox = True
+
+    def on_endofnames(self, serv, ev):
+        # the bot joined a channel, asks the accounts of everybody in it
+        channel = ev.arguments[0] if ev.arguments else None
+        if not self.AUTH_IRCV3 or not self.whox or not channel or not self.bot.owns(channel):
+            return
+        now = time.time()
+        delay = max(0, self._whox_next - now)
+        self._whox_next = now + delay + self.WHOX_INTERVAL
+        # token, host, nick, account
+        self.bot.engine.call_later(delay, serv.send_raw, 'WHO %s %%thna,%s' % (channel, self.WHOX_TOKEN))
+
+    def on_354(self, serv, ev):
+        # RPL_WHOSPCRPL, not named by the irc library: me 482 host nick account
+        if len(ev.arguments) < 4 or ev.arguments[0] != self.WHOX_TOKEN:
+            return
+        host, nick, account = ev.arguments[1:4]
+        self.account_known(nick, host, None if account == '0' else account)
+
+    def on_account(self, serv, ev):
+        # account-notify: ACCOUNT account, or * when logging out
+        if '@' not in ev.source:
+            return
+        self.account_known(ev.source.nick, ev.source.host, None if ev.target == '*' else ev.target)
+
+    def on_pubmsg(self, serv, ev):
+        self._seen(ev.source)
+
+    def on_privmsg(self, serv, ev):
+        self._seen(ev.source)
 
     #def _on_part(self, c, e):
     #def _on_kick(self, c, e):
 
-    def _on_nick(self, c, e):
+    def on_nick(self, c, e):
         before = e.source.nick
         after = e.target
-        auth = self.auths[before]
-        del self.auths[before]
-        self.auths[after] = auth
-
-    def _on_quit(self, c, e):
-        nick = e.source.nick
-        del self.auths[nick]
-
-    def _on_namreply(self, c, e):
-        # e.arguments[0] == "@" for secret channels,
-        #                     "*" for private channels,
-        #                     "=" for others (public channels)
-        # e.arguments[1] == channel
-        # e.arguments[2] == nick list
-        user_list = e.arguments[2]
-        for nick in [n for n in user_list if n not in self.auths]:
-            self.auths[nick] = self.AUTH_CLASS(self.bot, nick)
+        host = self.hosts.get(before)
+        auth = self.auths.get(before)
+        self.forget(before)
+        self.forget(after)
+        if host is not None:
+            self.hosts[after] = host
+        if 'account-notify' in self.caps and auth is not None and not auth.is_checking:
+            # the account stays, we would be told if it changed
+            self.account_known(after, host, auth.auth)
+
+    def on_quit(self, c, e):
+        self.forget(e.source.nick)
 
     def authentify(self):
         """
@@ -4,29 +4,83 @@ import os
 import re
 import sys
 import signal
+import sre_constants
+import sre_parse
 import time
+import types
 from threading import Thread
-from Queue import Queue
+from collections import OrderedDict
 import datetime
-from logging import handlers
 
-from irc.client import DecodingLineBuffer
+from irc.client import DecodingLineBuffer, ServerConnectionError
 from irc.bot import SingleServerIRCBot
 
 import settings
+from asynclog import AsyncHandler, RotatingFileHandler, TimedRotatingFileHandler
+from cache import LRUCache
+from engine import Engine, Sleep, Blocking
+from flood import FloodController, CommandRateLimiter
+from metrics import Metrics
+from profiler import SamplingProfiler
+from singleflight import SingleFlight
+from outqueue import OutQueue, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW, split_text, to_bytes
+from shards import ShardSet
+from timers import Timers
+from workers import WorkerPool
 
 
 class CompliantDecodingLineBuffer(DecodingLineBuffer):
+    """
+    Decodes every line on its own: ascii as is, then with the encoding last detected for
+    the nick who sent it, utf-8, and latin-1 as a fallback (it can decode anything).
+    """
+    # the number of nicks we remember the encoding of
+    MAX_ENCODINGS = 1000
+
+    # a utf-8 multi-byte character read as latin-1, the nick probably switched to utf-8
+    UTF8_AS_LATIN1 = re.compile(u'[\xc2-\xf4][\x80-\xbf]')
+
+    def __init__(self, encodings=None):
+        super(CompliantDecodingLineBuffer, self).__init__()
+        # nick -> encoding, shared by the bot so it survives a reconnection
+        self.encodings = encodings if encodings is not None else OrderedDict()
+
     def lines(self):
-        lines = [l for l in super(DecodingLineBuffer, self).lines()]
+        # Note: skipping parent in super to go up one class in the branch (to avoid trying to decode with 'replace')
+        lines = super(DecodingLineBuffer, self).lines()
+        return (self.decode(line) for line in lines)
+
+    def _get_nick(self, line):
+        # :nick!user@host COMMAND ...
+        if line.startswith(':'):
+            return line[1:line.find(' ')].split('!', 1)[0]
+        return None
+
+    def decode(self, line):
+        try:
+            return line.decode('ascii')
+        except UnicodeDecodeError:
+            pass
+
+        nick = self._get_nick(line)
+        if self.encodings.get(nick) == 'latin-1':
+            decoded = line.decode('latin-1')
+            if not self.UTF8_AS_LATIN1.search(decoded):
+                return decoded
 
         try:
-            # Note: skipping parent in super to go up one class in the branch (to avoid trying to decode with 'replace')
-            return iter([line.decode('utf-8') for line in lines])
+            decoded = line.decode('utf-8')
+            encoding = 'utf-8'
         except UnicodeDecodeError:
-            return iter([line.decode('latin-1') for line in lines])
-        # fallback
-        return iter([line.decode('utf-8', 'replace') for line in lines])
+            decoded = line.decode('latin-1')
+            encoding = 'latin-1'
+
+        if nick and self.encodings.get(nick) != encoding:
+            self.encodings.pop(nick, None)
+            self.encodings[nick] = encoding
+            if len(self.encodings) > self.MAX_ENCODINGS:
+                self.encodings.popitem(last=False)
+        return decoded
 
 
 class ImproperlyConfigured(Exception):
@@ -68,9 +122,23 @@ class BaseCommand(object):
     # * target : will respond to the same channel were the command was issued
     TARGET = "target"
 
+    # the priority of the response in the outgoing queue, admin commands are always answered first
+    PRIORITY = PRIORITY_NORMAL
+
+    # how much this command counts in the flood protection of the user issuing it
+    COST = 1
+
+    # if set, the response is cached for this many seconds and reused for the same get_cache_key()
+    CACHE_TTL = 0
+
+    # with settings.SHARDS, run by every shard process instead of the one of the channel (see shards.py),
+    # for the commands acting on the process itself (reload, flushcache...)
+    BROADCAST = False
+
     def __init__(self, bot, ev):
         self.bot = bot
         self.ev = ev
+        self.issued = time.time()
 
         self.split_options(ev.arguments)
         self.parse_options()  # BadCommandLineException is catched in the main loop
@@ -99,12 +167,75 @@ class BaseCommand(object):
         """
         Most of the time this will be the only method to implement
         It should return a string containing the response of the bot to the issued command
+
+        It can also be a coroutine (see engine.py), raising Return(response) when it is done.
         """
         return u""
 
+    def get_cache_key(self):
+        """
+        Override this if the response doesn't only depend on the options and named arguments,
+        it is called once the user is known (see BaseAuthCommand), return None to not use the cache.
+        """
+        return tuple(self.options), tuple(sorted(self.args.items()))
+
+    def should_cache(self, response):
+        """
+        Override this to not cache the errors
+        """
+        return bool(response)
+
     def process(self, *args, **kwargs):
+        self.cache_key = None
+        if self.CACHE_TTL:
+            key = self.get_cache_key()
+            if key is not None:
+                self.cache_key = (self.bot.network_name, self.NAME, key)
+                hit, msg = self.bot.response_cache.get(self.cache_key)
+                self.bot.metrics.inc('command_cache_%s_total' % ('hits' if hit else 'misses'), command=self.NAME)
+                if hit:
+                    self._observe_latency()
+                    self.bot.send(self.get_target(), self.label_shard(msg), priority=self.get_priority())
+                    return
+
         msg = self.get_response()
-        self.bot.send(self.get_target(), msg)
+        if isinstance(msg, types.GeneratorType):
+            self.bot.engine.spawn(msg, self.plugin).add_done_callback(self._send_result)
+        else:
+            self._cache(msg)
+            self._observe_latency()
+            self.bot.send(self.get_target(), self.label_shard(msg), priority=self.get_priority())
+
+    def _send_result(self, task):
+        self._observe_latency()
+        if not task._exc_info:  # errors are logged by the engine
+            self._cache(task.result())
+            self.bot.send(self.get_target(), self.label_shard(task.result()), priority=self.get_priority())
+
+    def label_shard(self, msg):
+        """
+        the replies of a BROADCAST command tell which shard process they come from
+        """
+        if not self.BROADCAST or self.bot.shard_index is None:
+            return msg
+        if isinstance(msg, (tuple, list)):
+            return [u'[shard %d] %s' % (self.bot.shard_index, m) for m in msg]
+        return u'[shard %d] %s' % (self.bot.shard_index, msg)
+
+    def _cache(self, msg):
+        if self.cache_key is not None and self.should_cache(msg):
+            self.bot.response_cache.set(self.cache_key, msg, self.CACHE_TTL)
+
+    def _observe_latency(self):
+        """
+        from the message of the user to the response, the auth checks and blocking calls included
+        """
+        self.bot.metrics.observe('command_latency_seconds', time.time() - self.issued, command=self.NAME)
+
+    def get_priority(self):
+        if self.REQUIRE_ADMIN:
+            return PRIORITY_HIGH
+        return self.PRIORITY
 
     def get_target(self):
         if self.TARGET == "target":
@@ -133,7 +264,7 @@ class BaseCommand(object):
 
     def handle(self):
         if self.REQUIRE_ADMIN:
-            self.bot.auth_plugin.get_user(self.ev.source.nick, self.check_admin)
+            self.bot.auth_plugin.get_user(self.ev.source.nick, self.check_admin, plugin=self.plugin)
         else:
             self.process()
 
@@ -162,6 +293,138 @@ class BaseTrigger(object):
         pass
 
 
+def _literal_prefix(items):
+    """
+    Walk a parsed regexp and return (prefix, complete),
+    prefix being the literal string any match has to start with,
+    and complete telling if the whole pattern was literal.
+    """
+    prefix = []
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            prefix.append(unichr(av))
+        elif op == sre_constants.AT and av == sre_constants.AT_BEGINNING:
+            continue
+        elif op == sre_constants.SUBPATTERN:
+            sub, complete = _literal_prefix(av[-1])
+            prefix.append(sub)
+            if not complete:
+                return u''.join(prefix), False
+        else:
+            return u''.join(prefix), False
+    return u''.join(prefix), True
+
+
+class TriggerIndex(object):
+    """
+    Holds the trigger classes and their compiled REGEXPs.
+
+    Everything is (re)compiled when a trigger is added or removed,
+    so matching a message only costs:
+    * one pass of a combined regexp, rejecting the messages no trigger could match
+    * a lookup on the first character of the message, against the literal prefix of the REGEXPs
+    * the actual match of the remaining candidates
+
+    The REGEXPs with inline flags ((?i), (?x)...) are left out of the combined regexp,
+    where their flags would apply to all the others, and are always matched.
+    """
+
+    def __init__(self):
+        self._triggers = OrderedDict()  # REGEXP -> trigger class
+        self._build()
+
+    def __len__(self):
+        return len(self._triggers)
+
+    def __iter__(self):
+        return iter(self._triggers.values())
+
+    def __contains__(self, trigger_class):
+        return self._triggers.get(trigger_class.REGEXP) is trigger_class
+
+    def add(self, *trigger_classes):
+        for trigger_class in trigger_classes:
+            self._triggers[trigger_class.REGEXP] = trigger_class
+        self._build()
+
+    def remove(self, *trigger_classes):
+        for trigger_class in trigger_classes:
+            if trigger_class in self:
+                del self._triggers[trigger_class.REGEXP]
+        self._build()
+
+    def replace(self, old_classes, new_classes):
+        """
+        remove then add, with a single rebuild: the messages never miss both
+        """
+        for trigger_class in old_classes:
+            if trigger_class in self:
+                del self._triggers[trigger_class.REGEXP]
+        for trigger_class in new_classes:
+            self._triggers[trigger_class.REGEXP] = trigger_class
+        self._build()
+
+    def _combine(self, regexps):
+        """
+        a single regexp matching if any of the given regexps match,
+        the named groups are stripped to avoid name collisions between triggers
+        """
+        if not regexps or any(re.search(r'\(\?P=|\\[1-9]', r) for r in regexps):
+            return None  # backreferences can't survive the group stripping
+        try:
+            return re.compile(u'|'.join(u'(?:%s)' % re.sub(r'\(\?P<\w+>', u'(?:', r) for r in regexps))
+        except re.error:
+            return None
+
+    def _build(self):
+        by_first_char = {}
+        unprefixed = []
+        flagged = []
+        combined = []
+        default_flags = re.compile(u'').flags
+        for regexp, trigger_class in self._triggers.items():
+            compiled = re.compile(regexp)
+            if compiled.flags & ~default_flags:
+                flagged.append((u'', compiled, trigger_class))
+                continue
+            combined.append(regexp)
+            prefix = u''
+            if not compiled.flags & re.IGNORECASE:
+                prefix, complete = _literal_prefix(sre_parse.parse(regexp))
+            if prefix:
+                by_first_char.setdefault(prefix[0], []).append((prefix, compiled, trigger_class))
+            else:
+                unprefixed.append((prefix, compiled, trigger_class))
+        # swapped at once, so a message being matched in another thread never sees half an index
+        self._index = (self._combine(combined), by_first_char, unprefixed, flagged)
+
+    def match(self, msg):
+        """
+        yields a (trigger_class, match) tuple for every trigger matching msg
+        """
+        combined, by_first_char, unprefixed, flagged = self._index
+        if combined is not None and not combined.match(msg):
+            by_first_char, unprefixed = {}, ()
+        for candidates in (by_first_char.get(msg[:1], ()), unprefixed, flagged):
+            for prefix, compiled, trigger_class in candidates:
+                if msg.startswith(prefix):
+                    m = compiled.match(msg)
+                    if m:
+                        yield trigger_class, m
+
+
+def index_handlers(plugins):
+    """
+    event type -> [(plugin, its on_<event type> method), ...]
+    """
+    handlers = {}
+    for plugin in plugins:
+        for name in dir(plugin):
+            if name.startswith('on_') and callable(getattr(plugin, name)):
+                handlers.setdefault(name[3:], []).append((plugin, getattr(plugin, name)))
+    return handlers
+
+
 class BaseBotPlugin(object):
     """
     Abstract class for any irc bot plugin
@@ -169,13 +432,33 @@ class BaseBotPlugin(object):
     COMMANDS = {}
     TRIGGERS = []
 
+    # the maximum number of commands/triggers of this plugin handled at the same time
+    # by the worker threads, None for no limit other than the number of workers
+    MAX_CONCURRENCY = None
+
     def __init__(self, bot):
         self.bot = bot
 
+    def spawn(self, coroutine):
+        """
+        runs coroutine in the bot engine, its blocking calls count in MAX_CONCURRENCY
+        """
+        return self.bot.engine.spawn(coroutine, self)
+
+    def migrate(self, old):
+        """
+        Called on the new instance instead of __init__ when the plugin is reloaded (see ReloadCommand),
+        to take over the state of the old one (db connections, caches...).
+        Override it to convert what the new code can't use as is,
+        or to restart the background tasks with the new code.
+        """
+        self.__dict__.update(old.__dict__)
+
 
 class HelpCommand(BaseCommand):
     NAME = u'help'
     HELP = u"""Display this help."""
+    CACHE_TTL = 3600  # flushed when a plugin is added, reloaded or unloaded
 
     def get_response(self):
         if self.options:
@@ -233,6 +516,31 @@ class ReconnectCommand(BaseCommand):
         self.bot._connect()
 
 
+class ReloadCommand(BaseCommand):
+    NAME = u"reload"
+    HELP = u"reload PLUGIN - reload the code of a plugin, without reconnecting."
+    REQUIRE_ADMIN = True
+    IS_HIDDEN = True
+    BROADCAST = True
+
+    def parse_options(self):
+        if len(self.options) != 1:
+            raise BadCommandLineException
+
+    def get_response(self):
+        plugin = self.bot.find_plugin(self.options[0])
+        if plugin is None:
+            return u"No such plugin."
+        try:
+            new_plugin = self.bot.reload_plugin(plugin)
+        except Exception, e:
+            self.bot.error_logger.exception('Can not reload %s : %s' % (plugin, e))
+            new_plugin = None
+        if new_plugin is None:
+            return u"Could not reload %s, the old code is still running." % plugin.__class__.__name__
+        return u"%s reloaded." % new_plugin.__class__.__name__
+
+
 class IssueCommand(BaseCommand):
     NAME = u"command"
     ALIASES = [u"cmd",]
@@ -260,69 +568,287 @@ class MsgCommand(BaseCommand):
             raise BadCommandLineException
 
     def get_response(self):
-        self.bot.send(self._target, self.msg)
+        self.bot.send(self._target, self.msg, priority=PRIORITY_HIGH)
         return u''
 
+class FlushCacheCommand(BaseCommand):
+    NAME = u"flushcache"
+    HELP = u"flushcache : forget the cached responses of the commands."
+    REQUIRE_ADMIN = True
+    IS_HIDDEN = True
+    BROADCAST = True
+
+    def get_response(self):
+        stats = self.bot.response_cache.stats()
+        return u"%d cached responses flushed (%d hits, %d misses so far)." % (self.bot.response_cache.clear(), stats['hits'], stats['misses'])
+
+
+class PerfCommand(BaseCommand):
+    NAME = u"perf"
+    HELP = u"perf : the slowest commands, the queues and the flood waits, see metrics.py."
+    REQUIRE_ADMIN = True
+    IS_HIDDEN = True
+    BROADCAST = True
+    TARGET = "source"
+
+    def _format_latencies(self, name, label):
+        latencies = []
+        for labels, (count, total, maximum, quantiles) in self.bot.metrics.slowest(name):
+            latencies.append(u'%s %s (%d)' % (dict(labels)[label], u'/'.join(u'%.2f' % v for q, v in quantiles), count))
+        return u', '.join(latencies) or u'none yet'
+
+    def get_response(self):
+        gauges = dict(self.bot.metrics.read_gauges())
+        queues = [u'%s %d (flood wait %.1fs)' % (name, gauges[('msg_queue_depth', (('network', name),))], gauges[('flood_wait_seconds_total', (('network', name),))])
+                  for name in self.bot.networks.keys()]
+        auth = self.bot.metrics.slowest('auth_roundtrip_seconds', 1)
+        return [u'Slowest commands (p50/p95/p99 in s, count) : %s' % self._format_latencies('command_latency_seconds', 'command'),
+                u'Slowest triggers : %s' % self._format_latencies('trigger_seconds', 'trigger'),
+                u'Outgoing queues : %s' % u', '.join(queues),
+                u'Workers : %d queued, %d running. Logs dropped : %d. Auth round-trip p95 : %s.' % (
+                    gauges[('worker_queue_depth', ())], gauges[('worker_running', ())], gauges[('log_records_dropped_total', ())],
+                    auth and u'%.2fs' % dict(auth[0][1][3])[0.95] or u'none yet')]
+
+
+class ProfileCommand(BaseCommand):
+    NAME = u"profile"
+    HELP = u"profile [SECONDS] : samples what all the threads of the bot are doing for SECONDS (default 10), see profiler.py."
+    REQUIRE_ADMIN = True
+    IS_HIDDEN = True
+    BROADCAST = True
+
+    DEFAULT_SECONDS = 10
+    MAX_SECONDS = 300
+
+    def parse_options(self):
+        try:
+            self.seconds = float(self.options[0]) if self.options else self.DEFAULT_SECONDS
+        except ValueError:
+            raise BadCommandLineException(u'SECONDS should be a number.')
+        if not 0 < self.seconds <= self.MAX_SECONDS:
+            raise BadCommandLineException(u'SECONDS should be between 0 and %d.' % self.MAX_SECONDS)
+
+    def process(self):
+        # in its own thread: a worker would be busy for nothing, and with WORKER_THREADS = 0 the reactor would be blocked
+        t = Thread(target=self._profile, name='profiler')
+        t.daemon = True
+        t.start()
+
+    def _profile(self):
+        profiler = SamplingProfiler().run(self.seconds)
+        path = os.path.join(getattr(settings, 'LOG_DIR', 'logs'), self.bot._log_file_name(datetime.datetime.now().strftime('profile-%Y%m%d-%H%M%S.folded')))
+        try:
+            profiler.write(path)
+        except IOError, e:
+            self.bot.error_logger.warning('Could not write the profile to %s : %s' % (path, e))
+            path = None
+        hot = u', '.join(u'%s %d%%' % (name, share * 100) for name, share in profiler.top())
+        self.bot.send(self.get_target(), self.label_shard([u'%d samples, the busiest functions : %s' % (profiler.samples, hot or u'none, the bot was idle'),
+                                                           path and u'Collapsed stacks written to %s' % path or u'Could not write the collapsed stacks.']),
+                      priority=self.get_priority())
+
+
 class QuitCommand(BaseCommand):
     NAME = u"quit"
     REQUIRE_ADMIN = True
     IS_HIDDEN = True
 
-    def get_response(self):
-        self.bot.disconnect()
-        sys.exit(0)
+    def process(self):
+        if self.bot.shard_index is not None:
+            # the front process owns the connections, and stops the shards
+            self.bot.shards.quit_front()
+            return
+        # sys.exit would only end the worker thread, the reactor quits like on a signal
+        self.bot.engine.call_soon(self.bot.quit)
 
 
 class Message():
     """
     only a small helper to help with the msg queue
     """
-    def __init__(self, target, text):
+    def __init__(self, target, text, priority=PRIORITY_NORMAL):
         self.target = target
         self.text = text
+        self.priority = priority
+
+
+class MsgQueueMixin(object):
+    """
+    The outgoing side of a connection: an OutQueue emptied by a thread
+    at the pace allowed by self.flood, through self.server.
+    """
+
+    def _start_msg_consumer(self):
+        if self.shard_index is not None:
+            return  # the front process sends the messages of the shards
+        t = Thread(target=self._msg_consumer, name='msg-consumer-%s' % self.network_name)
+        t.daemon = True
+        t.start()
+
+    def _send(self, msg):
+        # msg.text can be a str in another encoding than utf-8, see split_text
+        nbytes = len(to_bytes(u'PRIVMSG %s :\r\n' % msg.target)) + len(to_bytes(msg.text))
+        with self.metrics.timer('flood_wait_seconds', network=self.network_name):
+            self.flood.acquire(nbytes)
+        self.metrics.inc('messages_sent_total', network=self.network_name)
+        self.metrics.inc('bytes_sent_total', nbytes, network=self.network_name)
+        self.msg_logger.info(u'>>> %s - %s', msg.target, msg.text if isinstance(msg.text, unicode) else msg.text.decode('utf-8', 'replace'))
+        self.server.privmsg(msg.target, msg.text)
+
+    def _msg_consumer(self):
+        """
+        Called from a specific Thread because it is blocking
+        """
+        while True:
+            msg = self.msg_queue.get()
+            max_bytes = self.MAX_MSG_LEN - len(to_bytes(u'PRIVMSG %s :' % msg.target))
+            chunks = split_text(msg.text, max_bytes)
+            for chunk in chunks[:-1]:
+                self._send(Message(msg.target, chunk, msg.priority))
+            msg.text = chunks[-1]
+            if self.COALESCE_LINES and msg.target != getattr(self.auth_plugin, 'AUTH_BOT', None):
+                # the services read one command per line
+                self._coalesce(msg, max_bytes)
+            self._send(msg)
+
+    def _coalesce(self, msg, max_bytes):
+        """
+        appends to msg the next lines already waiting for the same target, as long as it fits in max_bytes
+        """
+        sep = to_bytes(self.COALESCE_SEPARATOR)
+        size = len(to_bytes(msg.text))
+        while True:
+            following = self.msg_queue.take(msg.target, msg.priority, max_bytes - size - len(sep))
+            if following is None:
+                return
+            if isinstance(msg.text, unicode) and isinstance(following.text, unicode):
+                msg.text = self.COALESCE_SEPARATOR.join([msg.text, following.text])
+            else:
+                msg.text = sep.join([to_bytes(msg.text), to_bytes(following.text)])
+            size += len(sep) + len(to_bytes(following.text))
 
+    def send(self, target, msg, priority=PRIORITY_NORMAL):
+        """
+        priority is one of the outqueue PRIORITY_*
+        """
+        if not type(msg) in (tuple, list, set):  # we don't use collections.Iterable because a string is an iterable
+            msg = msg.split("\n")
+        else:
+            # ok.
+            msg = [i for sub in [s.split("\n") for s in msg] for i in sub]
 
-class BaseIrcBot(SingleServerIRCBot):
+        for m in msg:
+            self.msg_queue.put(Message(target, m, priority), priority)
+
+
+class BaseIrcBot(MsgQueueMixin, SingleServerIRCBot):
     COMMAND_PREFIX = '!'
 
-    # its 512 but we need some space for the command arguments, might depend on irc server
+    NICK = getattr(settings, 'NICK', None)
+    REALNAME = getattr(settings, 'REALNAME', None)
+    START_CHANNELS = getattr(settings, 'START_CHANNELS', [])
+    PORT = getattr(settings, 'PORT', 6667)
+    # used by the auth plugin to authentify the bot
+    AUTH_LOGIN = getattr(settings, 'AUTH_LOGIN', None)
+    AUTH_PASSWORD = getattr(settings, 'AUTH_PASSWORD', None)
+
+    # the other irc networks to connect to, a list of dicts, see Network
+    NETWORKS = getattr(settings, 'NETWORKS', [])
+
+    # the maximum length in bytes of a 'PRIVMSG target :text' line,
+    # its 512 but the server adds our nick!user@host when relaying it
     MAX_MSG_LEN = getattr(settings, 'MAX_MSG_LEN', 450)
 
-    # The time in seconds that the bot will wait before sending 2 consecutive messages
-    TIME_BETWEEN_MSGS = getattr(settings, 'TIME_BETWEEN_MSGS', 1)
+    # if True, consecutive short lines waiting for the same target are sent as a single line
+    COALESCE_LINES = getattr(settings, 'COALESCE_LINES', False)
+    COALESCE_SEPARATOR = getattr(settings, 'COALESCE_SEPARATOR', u' | ')
 
     # because there is no way to know how the server implement the flood protection
     # and thus we can't make a more reliable rule to avoid it
-    # the number of commands before we stop answering (if set to 2, the 3rd command will remain unanswered)
+    # the number of commands a user can issue at once (if set to 2, the 3rd command will remain unanswered)
     FLOOD_PROTECTION_MAX_COMMANDS = getattr(settings, 'FLOOD_PROTECTION_MAX_COMMANDS', 2)
-    # the number of seconds before we reset the command timer
+    # the number of seconds to recover from FLOOD_PROTECTION_MAX_COMMANDS commands
     FLOOD_PROTECTION_TIMER = getattr(settings, 'FLOOD_PROTECTION_TIMER', 4)
-    # the period of time in which the bot is allowed to send MAX_MSG_LEN bytes
-    FLOOD_TIMER = getattr(settings, 'FLOOD_TIMER', 4)
+    # the maximum number of users tracked by the flood protection
+    FLOOD_PROTECTION_MAX_USERS = getattr(settings, 'FLOOD_PROTECTION_MAX_USERS', 10000)
+
+    # the outgoing rate limits, one of flood.FLOOD_PROFILES,
+    # defaults to the FLOOD_PROFILE of the auth plugin (QuakeNet, Freenode...)
+    FLOOD_PROFILE = getattr(settings, 'FLOOD_PROFILE', None)
 
     LEAVE_MESSAGE = getattr(settings, 'LEAVE_MESSAGE', 'Bye.')
     RECONNECTION_INTERVAL = getattr(settings, 'RECONNECTION_INTERVAL', 30)
 
+    # the number of threads handling the commands and triggers, 0 to handle them in the reactor thread
+    WORKER_THREADS = getattr(settings, 'WORKER_THREADS', 4)
+    # the number of commands/triggers waiting for a worker before we start dropping them
+    WORKER_QUEUE_SIZE = getattr(settings, 'WORKER_QUEUE_SIZE', 100)
+
+    # the number of processes handling the commands and triggers, 0 to do it in this one, see shards.py
+    SHARDS = getattr(settings, 'SHARDS', 0)
+
+    # the maximum number of command responses cached, see BaseCommand.CACHE_TTL
+    RESPONSE_CACHE_SIZE = getattr(settings, 'RESPONSE_CACHE_SIZE', 1000)
+
+    # if True, the time spent in the on_* handlers of the plugins is kept in handler_timings
+    PROFILE_HANDLERS = getattr(settings, 'PROFILE_HANDLERS', False)
+
+    # how often the metrics are written to LOG_DIR/metrics.prom, in seconds, 0 to never write them
+    METRICS_INTERVAL = getattr(settings, 'METRICS_INTERVAL', 60)
+
+    # the number of log records waiting to be written before we start dropping them
+    LOG_QUEUE_SIZE = getattr(settings, 'LOG_QUEUE_SIZE', 10000)
+    # None: never fsync the logs, 0: after every write, N: at most every N seconds
+    LOG_FSYNC = getattr(settings, 'LOG_FSYNC', None)
+
     def __init__(self):
+        self.shards = None
+        self.shard_index = None  # None in the front process
+        if self.SHARDS:
+            # before any thread is started, from here this can be a shard process
+            self.shards = ShardSet(self.SHARDS)
+            self.shard_index = self.shards.fork()
+
         self._init_loggers()
-        super(BaseIrcBot, self).__init__([(settings.SERVER,),], settings.NICK, settings.REALNAME, reconnection_interval=self.RECONNECTION_INTERVAL)
+        self.metrics = Metrics()
+        self.metrics.add_gauges(self._metrics_gauges)
+        super(BaseIrcBot, self).__init__([(settings.SERVER, self.PORT),], self.NICK, self.REALNAME, reconnection_interval=self.RECONNECTION_INTERVAL)
 
-        # used by simple implementation
-        # self.last_sent = datetime.datetime.now()
-        self.last_sent = []
+        self.network_name = settings.SERVER
+        self.msg_queue = self._new_msg_queue(self.network_name)  # message queue, one per target
+        self.encodings = OrderedDict()  # the encodings detected for the nicks, see CompliantDecodingLineBuffer
 
-        self.msg_queue = Queue()  # message queue
-        self._start_msg_consumer()
+        # remembers the last commands of the users, see check_command_timer
+        self.command_limiter = CommandRateLimiter(self.FLOOD_PROTECTION_MAX_COMMANDS, self.FLOOD_PROTECTION_TIMER, self.FLOOD_PROTECTION_MAX_USERS)
 
-        # the map to remember the last user's command time
-        self.command_timer_map = {}
+        self.workers = WorkerPool(self, self.WORKER_THREADS, self.WORKER_QUEUE_SIZE)
+        self.timers = Timers(self)
+        self.response_cache = LRUCache(self.RESPONSE_CACHE_SIZE)
+        self.flights = SingleFlight(self.metrics)  # the upstream requests of the plugins, see singleflight.py
+        self.engine = Engine(self, getattr(self, 'reactor', None) or self.ircobj)
+        if self.METRICS_INTERVAL:
+            self.engine.spawn(self._write_metrics())
 
         self.plugins = []
+        self.plugin_paths = {}  # plugin -> (path, append_plugin_dir) it was loaded with, to reload it
+        self.plugin_timings = {}  # path -> (import time, init time) in seconds
+        self.welcome = None  # (connection, event) of the last welcome, for the plugins ready after it
+        self.handlers = {}  # event type -> the on_* handlers of the plugins, see index_handlers
+        self.handler_timings = {}  # 'Plugin.on_event' -> [calls, total time, max time], if PROFILE_HANDLERS
         self.commands = {}
-        self.triggers = {}
+        self.triggers = TriggerIndex()
+
+        # server -> network, this bot being the one of settings.SERVER
+        self.networks = OrderedDict([(self.network_name, self)])
+        self._connections = {}  # connection -> network
+        self._init_networks()
 
         self._init_plugins()
+        self.flood = FloodController.from_profile(self.FLOOD_PROFILE or getattr(self.auth_plugin, 'FLOOD_PROFILE', 'default'), self.error_logger)
+        self._start_msg_consumer()
         self.connection.add_global_handler("all_events", self.global_handler)
+        if self.shard_index is not None:
+            self.connection = self.server = self._new_connection(self.network_name)
 
         # catch to disconnect gracefully..
         signal.signal(signal.SIGINT, self.quit)
@@ -331,38 +857,150 @@ class BaseIrcBot(SingleServerIRCBot):
         signal.signal(signal.SIGQUIT, self.quit)
 
     def quit(self, signal=None, frame=None):
-        self.error_logger.warning("Received a SIGINT|SIGKILL|SIGTERM (%s) signal, trying to quit gracefully" % str(signal))
-        self.disconnect()
+        if signal is None:
+            self.error_logger.info("Quitting because you asked so ...")
+        else:
+            self.error_logger.warning("Received a SIGINT|SIGKILL|SIGTERM (%s) signal, trying to quit gracefully" % str(signal))
+        if self.shard_index is None:
+            for network in self.networks.values():
+                network.disconnect()
+            if self.shards:
+                self.shards.stop()
         sys.exit(0)
 
-    def _load_plugin(self, plugin, append_plugin_dir=True):
-        self.error_logger.info('Loading %s.', plugin)
+    def start(self):
+        if self.shard_index is not None:
+            self.shards.serve(self)
+            return
 
+        if self.shards:
+            self.shards.start_front(self)
+        for network in self.networks.values():
+            if network is not self:
+                network._connect()
+        super(BaseIrcBot, self).start()
+
+    def _new_connection(self, network_name):
+        if self.shard_index is not None:
+            return self.shards.connection(network_name)
+        return self.engine.reactor.server()
+
+    def _new_msg_queue(self, network_name):
+        if self.shard_index is not None:
+            return self.shards.msg_queue(network_name)
+        return OutQueue()
+
+    def owns(self, target):
+        """
+        False if the messages of target (a channel or a nick) are handled by another shard process.
+        The plugins use it to do channel related background work (polling...) only once.
+        """
+        return self.shards is None or self.shards.owns(self.network_name, target)
+
+    def _init_networks(self):
+        for config in self.NETWORKS:
+            network = Network(self, config)
+            self.networks[network.network_name] = network
+            self._connections[network.connection] = network
+
+    def get_network(self, connection):
+        """
+        the network (or the bot itself) owning this connection
+        """
+        return self._connections.get(connection, self)
+
+    def _import_plugin(self, plugin, append_plugin_dir=True, reload_module=False):
+        """
+        returns the plugin class, or None if it can not be imported
+        """
         try:
             if append_plugin_dir:
                 mod = __import__(getattr(settings, 'PLUGINS_DIR', 'plugins') + '.' + '.'.join(plugin.split('.')[:-1]), globals(), locals(), [plugin.split('.')[-1]])
             else:
                 mod = __import__('.'.join(plugin.split('.')[:-1]), globals(), locals(), [plugin.split('.')[-1]])
+            if reload_module:
+                mod = reload(mod)
         except ImportError, e:
             self.error_logger.error("Can not import Plugin %s : %s" % (plugin, e))
+            return None
+
+        plugin_class = getattr(mod, plugin.split('.')[-1])
+        if not issubclass(plugin_class, BaseBotPlugin):
+            raise ImproperlyConfigured("%s is not a BaseBotPlugin subclass ! it should be." % plugin)
+        return plugin_class
+
+    def _load_plugin(self, plugin, append_plugin_dir=True):
+        self.error_logger.info('Loading %s.', plugin)
+
+        plugin_class = self._import_plugin(plugin, append_plugin_dir)
+        if plugin_class is None:
             return
 
-        plugin_instance = getattr(mod, plugin.split('.')[-1])(self)
+        plugin_instance = plugin_class(self)
+        self._add_plugin(plugin_instance, plugin, append_plugin_dir)
+        return plugin_instance
 
-        if not isinstance(plugin_instance, BaseBotPlugin):
-            raise ImproperlyConfigured("%s is not a BaseBotPlugin subclass ! it should be." % plugin)
+    def _add_plugin(self, plugin_instance, plugin, append_plugin_dir=True):
+        self._register(plugin_instance, self.commands)
+        self.triggers.add(*plugin_instance.TRIGGERS)
 
-        for command_class in plugin_instance.COMMANDS:
-            self.commands.update({command_class.NAME : command_class})
+        self.plugins.append(plugin_instance)
+        self.plugin_paths[plugin_instance] = (plugin, append_plugin_dir)
+        self.handlers = index_handlers(self.plugins)
+        self.response_cache.clear()  # the help lists the new commands
+
+    def _register(self, plugin, commands):
+        """
+        adds the commands of plugin to the commands dict
+        """
+        for command_class in plugin.COMMANDS:
+            commands.update({command_class.NAME : command_class})
             for alias in command_class.ALIASES:
-                self.commands.update({alias : command_class})
-            command_class.plugin = plugin_instance
-        for trigger_class in plugin_instance.TRIGGERS:
-            self.triggers.update({trigger_class.REGEXP : trigger_class})
-            trigger_class.plugin = plugin_instance
+                commands.update({alias : command_class})
+            command_class.plugin = plugin
+        for trigger_class in plugin.TRIGGERS:
+            trigger_class.plugin = plugin
 
-        self.plugins.append(plugin_instance)
-        return plugin_instance
+    def find_plugin(self, name):
+        """
+        the loaded plugin named name: its class name or the path it was loaded with ('RssPlugin', 'feed.rssbot.RssPlugin' or 'feed')
+        """
+        for plugin, (path, append_plugin_dir) in self.plugin_paths.items():
+            if name.lower() in (plugin.__class__.__name__.lower(), path.lower(), path.split('.')[0].lower()):
+                return plugin
+        return None
+
+    def reload_plugin(self, old_plugin):
+        """
+        Reimports the module of a loaded plugin and replaces it by an instance of the new class,
+        which takes over the state of the old one (see BaseBotPlugin.migrate).
+        The commands and triggers tables are swapped at once, the commands already running finish with the old code.
+        Returns the new plugin, or None if the module can't be imported.
+        """
+        path, append_plugin_dir = self.plugin_paths[old_plugin]
+        self.error_logger.info('Reloading %s.', path)
+
+        plugin_class = self._import_plugin(path, append_plugin_dir, reload_module=True)
+        if plugin_class is None:
+            return None
+        plugin = plugin_class.__new__(plugin_class)
+        plugin.migrate(old_plugin)
+
+        commands = dict((name, command_class) for name, command_class in self.commands.items() if command_class not in old_plugin.COMMANDS)
+        self._register(plugin, commands)
+        self.triggers.replace(old_plugin.TRIGGERS, plugin.TRIGGERS)
+        self.commands = commands
+        self.workers.replace(old_plugin, plugin)  # the commands still running keep their slots
+        self.response_cache.clear()  # the new code could answer differently
+
+        if old_plugin in self.plugins:
+            self.plugins[self.plugins.index(old_plugin)] = plugin
+        if old_plugin is self.auth_plugin:
+            self.auth_plugin = plugin
+        self.handlers = index_handlers(self.plugins)
+        del self.plugin_paths[old_plugin]
+        self.plugin_paths[plugin] = (path, append_plugin_dir)
+        return plugin
 
     def disconnect(self, message=None):
         super(BaseIrcBot, self).disconnect(message or self.LEAVE_MESSAGE)
@@ -372,107 +1010,77 @@ class BaseIrcBot(SingleServerIRCBot):
 
         if plugin in self.plugins:  # or it could be the auth_plugin
             self.plugins.remove(plugin)
+            self.handlers = index_handlers(self.plugins)
+        self.plugin_paths.pop(plugin, None)
         for command_class in plugin.COMMANDS:
-            for name, command in self.commands.iteritems():
+            for name, command in self.commands.items():
                 if command == command_class:
                     del self.commands[name]
-        for trigger_class in plugin.TRIGGERS:
-            for name, trigger in self.triggers.iteritems():
-                if trigger == trigger_class:
-                    del self.triggers[name]
+        self.triggers.remove(*plugin.TRIGGERS)
+        self.response_cache.clear()  # the help still lists the removed commands
 
     def _init_plugins(self):
-        for command_class in self.COMMANDS:
-            self.commands.update({command_class.NAME : command_class})
-            for alias in command_class.ALIASES:
-                self.commands.update({alias : command_class})
-            command_class.plugin = self
-        for trigger_class in self.TRIGGERS:
-            self.triggers.update({trigger_class.REGEXP : trigger_class})
-            trigger_class.plugin = self
+        self._register(self, self.commands)
+        self.triggers.add(*self.TRIGGERS)
 
         if hasattr(settings, 'AUTH_PLUGIN'):
             self.auth_plugin = self._load_plugin(getattr(settings, 'AUTH_PLUGIN', 'auth.BaseAuthPlugin'))
         else:
             self.auth_plugin = self._load_plugin('auth.BaseAuthPlugin', append_plugin_dir=False)
 
-        for plugin in getattr(settings, 'PLUGINS', []):
-            self._load_plugin(plugin)
-
-        self.error_logger.info("Done loading plugins.")
-
-    def _start_msg_consumer(self):
-        t = Thread(target=self._msg_consumer)
-        t.daemon = True
-        t.start()
-
-    ########## PARALLEL IMPLEMENTATION - TESTING ANTI FLOOD METHODS ##########
-    # the issue here is double:
-    # firstly, the rfc only gives advices about how to deal with flood, so servers are free to have their own
-    # implementations of flood protections
-    # secondly, there is no way to tell at what speed the server really process data, or the state of the server's socket buffer
-    # and thus if the command will overflow
-    # (overflow = the read buffer is already full and we try to send more data)
-
-    def _check_flood_danger2(self):
-        """
-        very basic implementation
-        """
-        return (datetime.datetime.now() - self.last_sent).seconds < self.TIME_BETWEEN_MSGS
-
-    def _check_flood_danger(self, msg):
-        """
-        We try to make a wild guess on the server process time
-        so we can chain a lot of small commands, but larger responses trigger the timer
-        """
-        now = datetime.datetime.now()
-
-        def _sum_bytes():
-            return sum([s['bytes'] for s in self.last_sent if (now - s['time']).seconds <= self.FLOOD_TIMER])
-
-        def _clean():
-            for s in self.last_sent:
-                if (now - s['time']).seconds > self.FLOOD_TIMER:
-                    self.last_sent.remove(s)
-
-        sb = _sum_bytes() + len(msg.text)
-        _clean()
-        return (sb > self.MAX_MSG_LEN)
-
-    #########################################################################
-
-    def _send(self, msg):
-        while self._check_flood_danger(msg):
-            time.sleep(self.TIME_BETWEEN_MSGS)
-        self.last_sent.append({'time':datetime.datetime.now(), 'bytes': len(msg.text)})
-        self.msg_logger.info(u'>>> %s - %s', msg.target, msg.text)
-        self.server.privmsg(msg.target, msg.text)
+        if self.shards and self.shard_index is None:
+            # the front process only needs the auth plugin (flood profile, auth bot),
+            # the plugins run in the shards
+            return
 
-    def _msg_consumer(self):
+        # the plugins are imported here, it's cheap as they import their heavy dependencies when they use them,
+        # then each one is instantiated in its own thread (db, network sessions...)
+        # and registered from the reactor as soon as it is ready, so the bot doesn't wait for them to connect
+        self._plugins_start = time.time()
+        self._plugins_pending = 0
+        for plugin in getattr(settings, 'PLUGINS', []):
+            self.error_logger.info('Loading %s.', plugin)
+            start = time.time()
+            plugin_class = self._import_plugin(plugin)
+            if plugin_class is None:
+                continue
+            self._plugins_pending += 1
+            t = Thread(target=self._init_plugin, args=(plugin, plugin_class, time.time() - start), name='init-%s' % plugin)
+            t.daemon = True
+            t.start()
+        if not self._plugins_pending:
+            self._plugins_loaded()  # no plugin to wait for
+
+    def _init_plugin(self, plugin, plugin_class, import_time):
         """
-        Called from a specific Thread because it is blocking
+        called from a specific thread, as the plugins can be slow to initialize
         """
-        while True:
-            msg = self.msg_queue.get()
-            while len(msg.text) > self.MAX_MSG_LEN:
-                ind = msg.text.rfind(" ", 0, self.MAX_MSG_LEN)
-                if ind == -1:
-                    ind = self.MAX_MSG_LEN
-                buff = msg.text[ind:]
-                msg.text = msg.text[:ind]
-                self._send(msg)
-                msg.text = buff
-            self._send(msg)
-
-    def send(self, target, msg):
-        if not type(msg) in (tuple, list, set):  # we don't use collections.Iterable because a string is an iterable
-            msg = msg.split("\n")
-        else:
-            # ok.
-            msg = [i for sub in [s.split("\n") for s in msg] for i in sub]
-
-        for m in msg:
-            self.msg_queue.put(Message(target, m))
+        start = time.time()
+        try:
+            plugin_instance = plugin_class(self)
+        except Exception, e:
+            self.error_logger.exception('Can not initialize %s : %s' % (plugin, e))
+            plugin_instance = None
+        self.engine.call_soon(self._plugin_ready, plugin, plugin_instance, import_time, time.time() - start)
+
+    def _plugin_ready(self, plugin, plugin_instance, import_time, init_time):
+        if plugin_instance is not None:
+            self._add_plugin(plugin_instance, plugin)
+            # it missed the welcome of the networks already connected
+            if hasattr(plugin_instance, 'on_welcome'):
+                for network in self.networks.values():
+                    if network.welcome is not None:
+                        plugin_instance.on_welcome(*network.welcome)
+
+        self.plugin_timings[plugin] = (import_time, init_time)
+        self._plugins_pending -= 1
+        if not self._plugins_pending:
+            self._plugins_loaded()
+
+    def _plugins_loaded(self):
+        self.error_logger.info("Done loading plugins in %.2fs : %s." % (
+            time.time() - self._plugins_start,
+            ', '.join(['%s %.2fs (import %.2fs)' % (p, i + t, i) for p, (i, t) in sorted(self.plugin_timings.items(), key=lambda pt: -sum(pt[1]))]) or 'none'))
 
     def get_needs_to_be_admin(self):
         return "Sorry, you can't do that by yourself, ask %s" % (" or ".join(settings.ADMINS))
@@ -485,46 +1093,122 @@ class BaseIrcBot(SingleServerIRCBot):
         if not os.path.isdir(logdir):
             os.makedirs(logdir)
 
+        # the files are written by a background thread, see asynclog
+        self.log_handlers = []
+
         msg_logger = logging.getLogger('msgslog')
         msg_logger.setLevel(logging.DEBUG)
-        handler = handlers.TimedRotatingFileHandler(os.path.join(settings.LOG_DIR, str(datetime.datetime.today().year), str(datetime.datetime.today().month), 'daily.log'), when='midnight')
+        handler = TimedRotatingFileHandler(os.path.join(settings.LOG_DIR, str(datetime.datetime.today().year), str(datetime.datetime.today().month), self._log_file_name('daily.log')), when='midnight')
         handler.setFormatter(msg_formatter)
-        msg_logger.addHandler(handler)
+        msg_logger.addHandler(self._async_log_handler(handler))
         self.msg_logger = msg_logger
 
         error_logger = logging.getLogger('errorlog')
         error_logger.setLevel(logging.INFO)
-        handler = handlers.RotatingFileHandler(os.path.join(settings.LOG_DIR, 'error.log'), maxBytes=1024 * 100, backupCount=5)  # 100 kB
+        handler = RotatingFileHandler(os.path.join(settings.LOG_DIR, self._log_file_name('error.log')), maxBytes=1024 * 100, backupCount=5)  # 100 kB
         handler.setFormatter(formatter)
-        error_logger.addHandler(handler)
+        error_logger.addHandler(self._async_log_handler(handler))
         self.error_logger = error_logger
 
+    def _log_file_name(self, name):
+        """
+        the shard processes don't share the log files, rotating them wouldn't be safe
+        """
+        if self.shard_index is None:
+            return name
+        root, ext = os.path.splitext(name)
+        return '%s.shard%d%s' % (root, self.shard_index, ext)
+
+    def _metrics_gauges(self):
+        """
+        the values read when the metrics are exported, see metrics.py
+        """
+        gauges = []
+        for name, network in self.networks.items():
+            gauges.append(('msg_queue_depth', {'network': name}, network.msg_queue.qsize()))
+            if hasattr(network, 'flood'):  # not before the plugins are loaded
+                gauges.append(('flood_wait_seconds_total', {'network': name}, network.flood.total_wait))
+            if hasattr(getattr(network, 'auth_plugin', None), 'auth_queries'):
+                gauges.append(('auth_queries_pending', {'network': name}, len(network.auth_plugin.auth_queries)))
+        workers = self.workers.stats()
+        gauges.append(('worker_queue_depth', {}, self.workers.queue_depth()))
+        gauges.append(('worker_running', {}, sum(workers['running'].values())))
+        gauges.append(('log_records_dropped_total', {}, sum([h.dropped for h in self.log_handlers])))
+        for name, value in self.timers.stats().items():
+            gauges.append(('timers_%s' % name, {}, value))
+        for name, value in self.command_limiter.stats().items():
+            gauges.append(('command_limiter_%s' % name, {}, value))
+        for name, value in self.response_cache.stats().items():
+            gauges.append(('response_cache_%s' % name, {}, value))
+        gauges.append(('upstream_in_flight', {}, self.flights.stats()['in_flight']))
+        for path, (import_time, init_time) in self.plugin_timings.items():
+            gauges.append(('plugin_import_seconds', {'plugin': path}, import_time))
+            gauges.append(('plugin_init_seconds', {'plugin': path}, init_time))
+        for handler, (calls, total, maximum) in self.handler_timings.items():
+            gauges.append(('handler_calls_total', {'handler': handler}, calls))
+            gauges.append(('handler_seconds_total', {'handler': handler}, total))
+            gauges.append(('handler_max_seconds', {'handler': handler}, maximum))
+        return gauges
+
+    def _write_metrics(self):
+        path = os.path.join(getattr(settings, 'LOG_DIR', 'logs'), self._log_file_name('metrics.prom'))
+        while True:
+            yield Sleep(self.METRICS_INTERVAL)
+            try:
+                yield Blocking(self.metrics.write, path)
+            except Exception, e:
+                self.error_logger.warning('Could not write the metrics to %s : %s' % (path, e))
+
+    def _async_log_handler(self, handler):
+        async_handler = AsyncHandler([handler], max_queue=self.LOG_QUEUE_SIZE, fsync_interval=self.LOG_FSYNC)
+        self.log_handlers.append(async_handler)
+        return async_handler
+
     def on_welcome(self, serv, ev):
         self.server = serv
         # changing the default Buffer to ensure no encoding error
-        self.connection.buffer = CompliantDecodingLineBuffer()
+        self.connection.buffer = CompliantDecodingLineBuffer(self.encodings)
 
-        for chan in settings.START_CHANNELS:
+        for chan in self.START_CHANNELS:
             self.connection.join(chan)
 
+    # the irc handlers are global to all the connections,
+    # SingleServerIRCBot only has to track the channels of its own
+    def _on_disconnect(self, serv, ev):
+        if serv is self.connection:
+            super(BaseIrcBot, self)._on_disconnect(serv, ev)
+
+    def _on_mode(self, serv, ev):
+        if serv is self.connection:
+            super(BaseIrcBot, self)._on_mode(serv, ev)
+
+    def _on_namreply(self, serv, ev):
+        if serv is self.connection:
+            super(BaseIrcBot, self)._on_namreply(serv, ev)
+
     def _on_join(self, serv, ev):
-        super(BaseIrcBot, self)._on_join(serv, ev)
+        if serv is self.connection:
+            super(BaseIrcBot, self)._on_join(serv, ev)
         self.msg_logger.info(u"%s joined the channel %s." % (ev.source.nick, ev.target))
 
     def _on_nick(self, serv, ev):
-        super(BaseIrcBot, self)._on_nick(serv, ev)
+        if serv is self.connection:
+            super(BaseIrcBot, self)._on_nick(serv, ev)
         self.msg_logger.info(u"%s is now known as %s." % (ev.source.nick, ev.target))
 
     def _on_part(self, serv, ev):
-        super(BaseIrcBot, self)._on_part(serv, ev)
+        if serv is self.connection:
+            super(BaseIrcBot, self)._on_part(serv, ev)
         self.msg_logger.info(u"%s left the channel %s." % (ev.source.nick, ev.target))
 
     def _on_kick(self, serv, ev):
-        super(BaseIrcBot, self)._on_kick(serv, ev)
+        if serv is self.connection:
+            super(BaseIrcBot, self)._on_kick(serv, ev)
         self.msg_logger.info(u"%s was kicked from %s." % (ev.source.nick, ev.target))
 
     def _on_quit(self, serv, ev):
-        super(BaseIrcBot, self)._on_quit(serv, ev)
+        if serv is self.connection:
+            super(BaseIrcBot, self)._on_quit(serv, ev)
         self.msg_logger.info(u"%s left." % (ev.source.nick))
 
     def log_msg(self, ev):
@@ -537,64 +1221,240 @@ class BaseIrcBot(SingleServerIRCBot):
 
     # we dispatch all the handlers to the plugins in case they have something to do
     def _dispatcher(self, serv, ev):
+        network = self.get_network(serv)
+        if network is not self:
+            network._dispatcher(serv, ev)
+            return
+
         super(BaseIrcBot, self)._dispatcher(serv, ev)
+        if self.shards is None:
+            self._dispatch_plugins(serv, ev)
+
+    def _dispatch_plugins(self, serv, ev):
+        if ev.type == 'welcome':
+            self.welcome = (serv, ev)
+        handlers = self.handlers.get(ev.type)
+        if handlers:
+            self._call_handlers(handlers, serv, ev)
+
+    def _call_handlers(self, handlers, serv, ev):
+        if not self.PROFILE_HANDLERS:
+            for plugin, handler in handlers:
+                handler(serv, ev)
+            return
 
-        for plugin in self.plugins:
-            m = "on_" + ev.type
-            if hasattr(plugin, m):
-                getattr(plugin, m)(serv, ev)
+        for plugin, handler in handlers:
+            start = time.time()
+            try:
+                handler(serv, ev)
+            finally:
+                elapsed = time.time() - start
+                timing = self.handler_timings.setdefault('%s.%s' % (plugin.__class__.__name__, handler.__name__), [0, 0, 0])
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] = max(timing[2], elapsed)
+
+    def _on_shard_event(self, network_name, ev):
+        """
+        an event sent to this shard process by the front one
+        """
+        network = self.networks[network_name]
+        network._dispatch_plugins(network.connection, ev)
+        self._handle_event(network, ev)
 
-    def check_command_timer(self, user):
+    def check_command_timer(self, user, cost=1):
         """
         ensure that an user is not tring to excess flood the bot.
         we don't use the auth_plugin here, no need
 
-        for now, we consider that the user tries to flood the bot if he issue more than 2 commands
-        in less than 2 seconds
+        a user can issue FLOOD_PROTECTION_MAX_COMMANDS commands at once, then has to wait
+        FLOOD_PROTECTION_TIMER / FLOOD_PROTECTION_MAX_COMMANDS seconds per command,
+        expensive commands (see BaseCommand.COST) count for more than one.
 
         note that it doesn't protect against the flood, it only make sure that one user only can not
         make the bot be kicked for excess flood.
         """
-        now = datetime.datetime.now()
-        if user not in self.command_timer_map:
-            self.command_timer_map[user] = {'counter':0, 'time':now}
-        ctm = self.command_timer_map[user]
+        return self.command_limiter.check(user, cost)
 
-        if (now - ctm['time']).seconds <= self.FLOOD_PROTECTION_TIMER:
-            ctm['counter'] = ctm['counter'] + 1
-            if ctm['counter'] > self.FLOOD_PROTECTION_MAX_COMMANDS:
-                return False
-        else:
-            # the last command was a long time ago : reset
-            ctm = {'counter':1, 'time':now}
+    def get_command(self, name):
+        """
+        returns the (command class, plugin) issued with name, raises a KeyError if there is none
+        """
+        cmdcls = self.commands[name]
+        return cmdcls, cmdcls.plugin
 
-        return True
+    def match_triggers(self, msg):
+        """
+        yields a (trigger class, plugin, match) tuple for every trigger matching msg
+        """
+        for trigger_class, m in self.triggers.match(msg):
+            yield trigger_class, trigger_class.plugin, m
 
     def global_handler(self, serv, ev):
         self.log_msg(ev)
-        if ev.type in ["pubmsg", "privnotice", "privmsg"]:
+        # the commands and triggers of another network reply on it
+        network = self.get_network(serv)
+        if self.shards:
+            self.shards.route(network, ev)
+        else:
+            self._handle_event(network, ev)
 
+    def _handle_event(self, network, ev):
+        if ev.type in ["pubmsg", "privnotice", "privmsg"]:
             msg = ev.arguments[0]
             if msg[0] == self.COMMAND_PREFIX:
                 try:
-                    cmdcls = self.commands[msg[1:].split(' ')[0]]
+                    cmdcls, plugin = network.get_command(msg[1:].split(' ')[0])
                     try:
-                        cmd = cmdcls(self, ev)
+                        cmd = cmdcls(network, ev)
                     except BadCommandLineException, e:
-                        self.send(ev.target, u"Bad command line - %s" % e.message or cmdcls.HELP)
+                        network.send(ev.target, u"Bad command line - %s" % e.message or cmdcls.HELP)
                     else:
-                        if self.check_command_timer(ev.source.nick):
-                            cmd.handle()
+                        if self.check_command_timer(ev.source.nick, cmdcls.COST):
+                            self._submit(plugin, self._handle_command, cmd)
                         else:
                             self.error_logger.warning(u'Flood attempt by %s.' % ev.source)
                             #self.send(ev.target, u'Nop.')
-                            self.server.privmsg(ev.target, u'Nop.')
+                            network.server.privmsg(ev.target, u'Nop.')
                 except KeyError, e:
                     self.error_logger.warning('Invalid command : %s by %s' % (e, ev.source))
-                except NotImplementedError, e:
-                    self.send(ev.target, u"Not implemented. Sorry !")
             else:
-                for regexp, trigger_class in self.triggers.items():
-                    m = re.match(regexp, msg)
-                    if m:
-                        trigger_class(self, m, ev).handle()
+                for trigger_class, plugin, m in network.match_triggers(msg):
+                    trigger = trigger_class(network, m, ev)
+                    self._submit(plugin, self._handle_trigger, trigger)
+
+    def _submit(self, plugin, fn, *args):
+        if not self.workers.submit(plugin, fn, *args):
+            self.error_logger.warning('Worker queue full (%d), dropping %s.' % (self.workers.queue_depth(), fn))
+
+    def _handle_command(self, cmd):
+        self.metrics.inc('commands_total', command=cmd.NAME)
+        try:
+            with self.metrics.timer('command_handle_seconds', command=cmd.NAME):
+                cmd.handle()
+        except NotImplementedError, e:
+            cmd.bot.send(cmd.ev.target, u"Not implemented. Sorry !")
+
+    def _handle_trigger(self, trigger):
+        name = trigger.__class__.__name__
+        self.metrics.inc('triggers_total', trigger=name)
+        with self.metrics.timer('trigger_seconds', trigger=name):
+            trigger.handle()
+
+
+class Network(MsgQueueMixin):
+    """
+    Another irc network the bot is connected to, configured by a dict of settings.NETWORKS:
+    {'SERVER': 'irc.freenode.net', 'PORT': 6667, 'START_CHANNELS': ['#chan'],
+     'AUTH_PLUGIN': 'freenode.freebot.FreenodePlugin', 'AUTH_LOGIN': '...', 'AUTH_PASSWORD': '...',
+     'NICK': '...', 'REALNAME': '...', 'PASSWORD': None, 'FLOOD_PROFILE': None}
+
+    The plugins, the workers and the loggers are the ones of the bot, a network only has
+    its own connection (on the same reactor), auth plugin, flood control and outgoing queue.
+    The commands and triggers coming from a network get it as their bot, so they reply and
+    check the auths on the right network, anything else is looked up on the bot.
+    """
+
+    def __init__(self, bot, config):
+        self.bot = bot
+        self.network_name = config['SERVER']
+        self.port = config.get('PORT', 6667)
+        self.password = config.get('PASSWORD')
+        self.START_CHANNELS = config.get('START_CHANNELS', [])
+        for attr in ('NICK', 'REALNAME', 'AUTH_LOGIN', 'AUTH_PASSWORD'):
+            if attr in config:
+                setattr(self, attr, config[attr])
+
+        self.connection = bot._new_connection(self.network_name)
+        self.server = self.connection
+        self.msg_queue = bot._new_msg_queue(self.network_name)
+        self.encodings = OrderedDict()
+        self.welcome = None
+        self.handlers = {}
+        self._bot_handlers = None  # the handlers of the bot self.handlers was built from
+
+        if 'AUTH_PLUGIN' in config:
+            auth_class = bot._import_plugin(config['AUTH_PLUGIN'])
+        else:
+            auth_class = bot._import_plugin('auth.BaseAuthPlugin', append_plugin_dir=False)
+        if auth_class is None:
+            raise ImproperlyConfigured("Can not load the auth plugin of %s." % self.network_name)
+        self.auth_plugin = auth_class(self)
+
+        # the commands and triggers of the auth plugin of the bot are replaced by these ones
+        self.auth_commands = {}
+        for command_class in self.auth_plugin.COMMANDS:
+            self.auth_commands[command_class.NAME] = command_class
+            for alias in command_class.ALIASES:
+                self.auth_commands[alias] = command_class
+        self.auth_triggers = TriggerIndex()
+        self.auth_triggers.add(*self.auth_plugin.TRIGGERS)
+
+        self.flood = FloodController.from_profile(config.get('FLOOD_PROFILE') or getattr(self.auth_plugin, 'FLOOD_PROFILE', 'default'), self.error_logger)
+        self._start_msg_consumer()
+
+    def __getattr__(self, name):
+        return getattr(self.bot, name)
+
+    def __repr__(self):
+        return '<Network %s>' % self.network_name
+
+    def _connect(self):
+        self.error_logger.info('Connecting to %s.', self.network_name)
+        try:
+            self.connection.connect(self.network_name, self.port, self.NICK, self.password, ircname=self.REALNAME)
+        except ServerConnectionError, e:
+            self.error_logger.error('Can not connect to %s : %s' % (self.network_name, e))
+            self.engine.call_later(self.RECONNECTION_INTERVAL, self._connect)
+
+    def _reconnect(self):
+        if not self.connection.is_connected():
+            self._connect()
+
+    def disconnect(self, message=None):
+        self.connection.disconnect(message or self.LEAVE_MESSAGE)
+
+    def on_welcome(self, serv, ev):
+        self.connection.buffer = CompliantDecodingLineBuffer(self.encodings)
+        for chan in self.START_CHANNELS:
+            self.connection.join(chan)
+
+    def _on_disconnect(self, serv, ev):
+        self.engine.call_later(self.RECONNECTION_INTERVAL, self._reconnect)
+
+    def _dispatcher(self, serv, ev):
+        if ev.type == 'welcome':
+            self.on_welcome(serv, ev)
+        elif ev.type == 'disconnect':
+            self._on_disconnect(serv, ev)
+        if self.shards is None:
+            self._dispatch_plugins(serv, ev)
+
+    def _dispatch_plugins(self, serv, ev):
+        if ev.type == 'welcome':
+            self.welcome = (serv, ev)
+        if self._bot_handlers is not self.bot.handlers:
+            # the plugins of the bot changed, the auth plugin of the network replaces the one of the bot
+            self._bot_handlers = self.bot.handlers
+            self.handlers = index_handlers([self.auth_plugin if p is self.bot.auth_plugin else p for p in self.bot.plugins])
+        handlers = self.handlers.get(ev.type)
+        if handlers:
+            self.bot._call_handlers(handlers, serv, ev)
+
+    def owns(self, target):
+        return self.shards is None or self.shards.owns(self.network_name, target)
+
+    def get_command(self, name):
+        if name in self.auth_commands:
+            return self.auth_commands[name], self.auth_plugin
+        cmdcls = self.bot.commands[name]
+        if cmdcls in self.bot.auth_plugin.COMMANDS:
+            raise KeyError(name)
+        return cmdcls, cmdcls.plugin
+
+    def match_triggers(self, msg):
+        for trigger_class, m in self.auth_triggers.match(msg):
+            yield trigger_class, self.auth_plugin, m
+        for trigger_class, m in self.bot.triggers.match(msg):
+            if trigger_class not in self.bot.auth_plugin.TRIGGERS:
+                yield trigger_class, trigger_class.plugin, m
@@ -1,3 +1,5 @@
+from threading import Lock
+
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
@@ -5,6 +7,10 @@ import settings
 from basebot import ImproperlyConfigured, BaseCommand
 
 
+# the plugins are initialized in parallel, they share the engine
+_engine_lock = Lock()
+
+
 class DbCommand(BaseCommand):
     def __init__(self, bot, ev):
         super(DbCommand, self).__init__(bot, ev)
@@ -24,10 +30,11 @@ class DbMixin(object):
     def _init_engine(self):
         if not hasattr(settings, 'DB_BACKEND'):
             raise ImproperlyConfigured("A DbMixin plugin needs a DB_BACKEND setting.")
-        if not hasattr(self.bot, 'engine') or self.bot.engine is None:
-            self.bot.engine = create_engine(settings.DB_BACKEND, echo=True, pool_recycle=3600)
-        if not hasattr(self.bot, 'Session') or self.bot.Session is None:
-            self.bot.Session = sessionmaker(bind=self.bot.engine)
+        with _engine_lock:
+            if not hasattr(self.bot, 'db_engine') or self.bot.db_engine is None:
+                self.bot.db_engine = create_engine(settings.DB_BACKEND, echo=True, pool_recycle=3600)
+            if not hasattr(self.bot, 'Session') or self.bot.Session is None:
+                self.bot.Session = sessionmaker(bind=self.bot.db_engine)
 
     def _make_table(self):
-        self.SCHEMA.metadata.create_all(self.bot.engine)
+        self.SCHEMA.metadata.create_all(self.bot.db_engine)
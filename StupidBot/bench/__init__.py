@@ -0,0 +1,15 @@
+"""
+Benchmarks, run them from the StupidBot directory:
+$ python -m bench.triggers
+$ python -m bench.loadtest  # against a local fake irc server, see bench.fakeircd
+$ python -m bench.replay logs/2014/3/daily.log  # replays the logged traffic through the handlers
+
+if there is no settings.py (yet), bench_settings is used in place.
+"""
+import sys
+
+try:
+    import settings
+except ImportError:
+    from bench import bench_settings
+    sys.modules['settings'] = bench_settings
@@ -0,0 +1,11 @@
+"""
+the settings used by the benchmarks when there is no settings.py
+"""
+
+NICK = u'StupidBench'
+REALNAME = u'StupidBench'
+SERVER = u'localhost'
+START_CHANNELS = ['#bench', ]
+ADMINS = ['admin', ]
+PLUGINS = []
+LOG_DIR = "/tmp/stupidbench/logs"
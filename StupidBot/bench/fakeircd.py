@@ -0,0 +1,440 @@
+"""
+A local stand-in irc server for the load tests, see bench.loadtest
+
+It speaks enough of rfc1459 for the bot (registration, motd, ping, join/part with the names,
+privmsg/notice, quit) and plays the auth bots of the networks the bot has an auth plugin for:
+* quakenet: Q, answering AUTH and WHOIS like plugins.quakenet.quakebot expects
+* freenode: NickServ, answering IDENTIFY and ACC like plugins.freenode.freebot expects
+
+With ircv3, it also tells the accounts of the users like solanum (the ircd of libera.chat):
+the account-notify and extended-join capabilities, and WHOX.
+
+The other users are virtual: they only exist in the server, the load test makes them
+join and talk with the FakeIrcd methods, and sees what the bot sends with on_message.
+
+It can also run on its own, with a few idle users, to try the bot by hand:
+$ python -m bench.fakeircd --port 6667 --network quakenet
+"""
+import argparse
+import SocketServer
+import time
+from collections import deque
+from threading import Lock, RLock, Thread, Condition
+
+SERVER_NAME = 'fakeircd.bench'
+USER_HOST = 'users.bench'
+
+SERVICES = {
+    'quakenet': ('Q', 'TheQBot', 'CServe.quakenet.org'),
+    'freenode': ('NickServ', 'NickServ', 'services.'),
+}
+
+CAPABILITIES = ('account-notify', 'extended-join')
+# the fields a WHOX reply can have, in the order they are sent
+WHOX_FIELDS = 'tcuihsnfdlaor'
+
+
+def parse_line(line):
+    """
+    returns (prefix, command, params), the trailing parameter being the last of params
+    """
+    prefix = None
+    if line.startswith(':'):
+        prefix, line = line[1:].split(' ', 1)
+    if ' :' in line:
+        line, trailing = line.split(' :', 1)
+        params = line.split() + [trailing]
+    else:
+        params = line.split()
+    return prefix, params[0].upper() if params else '', params[1:]
+
+
+class VirtualUser(object):
+    def __init__(self, nick, account=None):
+        self.nick = nick
+        self.user = '~' + (nick or '')[:9]
+        self.host = USER_HOST
+        self.account = account
+        self.channels = set()
+        self.caps = set()
+
+    @property
+    def prefix(self):
+        return '%s!%s@%s' % (self.nick, self.user, self.host)
+
+    def send(self, line):
+        pass  # nobody is listening
+
+
+class Client(VirtualUser):
+    """
+    a real connection, the bot
+    """
+
+    def __init__(self, handler):
+        super(Client, self).__init__(None)
+        self.handler = handler
+        self.host = handler.client_address[0]
+        self.registered = False
+        self.authed = False  # with the services
+        self._lock = Lock()
+
+    def send(self, line):
+        with self._lock:
+            try:
+                self.handler.wfile.write(line.encode('utf-8') + '\r\n')
+                self.handler.wfile.flush()
+            except (IOError, ValueError):
+                pass  # it quit, the handler will clean up
+
+
+class ClientHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        ircd = self.server
+        client = Client(self)
+        try:
+            for line in iter(self.rfile.readline, ''):
+                line = line.rstrip('\r\n').decode('utf-8', 'replace')
+                if line:
+                    ircd.received += 1
+                    ircd.handle_line(client, line)
+        finally:
+            ircd.quit(client, u'Connection closed')
+
+
+class FakeIrcd(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port=6667, network='quakenet', auth_delay=0, host='127.0.0.1', ircv3=False):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, port), ClientHandler)
+        self.port = self.server_address[1]
+        self.network = network
+        self.auth_delay = auth_delay  # how long the auth bot takes to reply, in seconds
+        self.ircv3 = ircv3
+
+        self.lock = RLock()  # the on_* callbacks can call the methods of the virtual users
+        self.users = {}  # lower nick -> VirtualUser or Client
+        self.channels = {}  # lower channel -> set of users
+        self.received = 0  # lines received from the real clients
+
+        # called with (client, command, target, text) for every privmsg/notice of a real client
+        self.on_message = None
+        # called with (client, channel) when a real client joined a channel
+        self.on_join = None
+
+        self.service = None
+        if network in SERVICES:
+            nick, user, host = SERVICES[network]
+            self.service = VirtualUser(nick)
+            self.service.user, self.service.host = user, host
+            self.users[nick.lower()] = self.service
+
+        self._replies = deque()  # (when, client, line) sent by the services after auth_delay
+        self._replies_cond = Condition()
+
+    def start(self):
+        """
+        serves in background threads, the socket is already listening so the process
+        can be forked before, without any thread running
+        """
+        for target, name in [(self._send_replies, 'fakeircd-services'), (self.serve_forever, 'fakeircd')]:
+            t = Thread(target=target, name=name)
+            t.daemon = True
+            t.start()
+        return t
+
+    def clients(self):
+        """
+        the real connections
+        """
+        with self.lock:
+            return [user for user in self.users.values() if isinstance(user, Client)]
+
+    # the virtual users, for the load tests
+
+    def add_user(self, nick, account=None):
+        with self.lock:
+            user = self.users[nick.lower()] = VirtualUser(nick, account)
+        return user
+
+    def join(self, nick, channel):
+        with self.lock:
+            user = self.users[nick.lower()]
+            members = self.channels.setdefault(channel.lower(), set())
+            members.add(user)
+            user.channels.add(channel.lower())
+            self._join(user, channel, members)
+
+    def set_account(self, nick, account):
+        """
+        the user logs in (or out with None), told to the clients having account-notify
+        """
+        with self.lock:
+            user = self.users[nick.lower()]
+            user.account = account
+            line = u':%s ACCOUNT %s' % (user.prefix, account or '*')
+            self._broadcast([u for u in self._neighbours(user) if 'account-notify' in u.caps], line)
+
+    def say(self, nick, target, text, command='PRIVMSG'):
+        with self.lock:
+            self._deliver(self.users[nick.lower()], command, target, text)
+
+    def change_nick(self, nick, new_nick):
+        with self.lock:
+            user = self.users.pop(nick.lower())
+            self._broadcast(self._neighbours(user), u':%s NICK :%s' % (user.prefix, new_nick))
+            user.nick = new_nick
+            self.users[new_nick.lower()] = user
+
+    def quit(self, user, message=u'Quit'):
+        with self.lock:
+            if isinstance(user, basestring):
+                user = self.users.get(user.lower())
+            if user is None or self.users.get((user.nick or '').lower()) is not user:
+                return
+            self._broadcast(self._neighbours(user) - set([user]), u':%s QUIT :%s' % (user.prefix, message))
+            for channel in user.channels:
+                self.channels[channel].discard(user)
+            del self.users[user.nick.lower()]
+
+    # the protocol
+
+    def handle_line(self, client, line):
+        prefix, command, params = parse_line(line)
+        handler = getattr(self, 'irc_%s' % command, None)
+        if handler is None:
+            client.send(u':%s 421 %s %s :Unknown command' % (SERVER_NAME, client.nick or '*', command))
+            return
+        with self.lock:
+            handler(client, params)
+
+    def _numeric(self, client, numeric, text):
+        client.send(u':%s %s %s %s' % (SERVER_NAME, numeric, client.nick, text))
+
+    def irc_NICK(self, client, params):
+        nick = params[0]
+        if nick.lower() in self.users and self.users[nick.lower()] is not client:
+            client.send(u':%s 433 * %s :Nickname is already in use' % (SERVER_NAME, nick))
+            return
+        if client.nick:
+            del self.users[client.nick.lower()]
+            self._broadcast(self._neighbours(client) | set([client]), u':%s NICK :%s' % (client.prefix, nick))
+        client.nick = nick
+        self.users[nick.lower()] = client
+        self._register(client)
+
+    def irc_USER(self, client, params):
+        client.user = '~' + params[0][:9]
+        self._register(client)
+
+    def _register(self, client):
+        if client.registered or not client.nick or client.user == '~':
+            return
+        client.registered = True
+        self._numeric(client, '001', u':Welcome to the fake irc network %s' % client.prefix)
+        self._numeric(client, '002', u':Your host is %s' % SERVER_NAME)
+        self._numeric(client, '003', u':This server was created for a benchmark')
+        self._numeric(client, '004', u'%s fakeircd-1 io ov' % SERVER_NAME)
+        self._numeric(client, '005', u'CHANTYPES=# PREFIX=(ov)@+ NICKLEN=15 NETWORK=%s %s:are supported by this server' % (self.network, 'WHOX ' if self.ircv3 else ''))
+        self._numeric(client, '375', u':- %s Message of the day -' % SERVER_NAME)
+        self._numeric(client, '372', u':- nothing to see here')
+        self._numeric(client, '376', u':End of /MOTD command.')
+
+    def irc_PING(self, client, params):
+        client.send(u':%s PONG %s :%s' % (SERVER_NAME, SERVER_NAME, params[0] if params else ''))
+
+    def irc_PONG(self, client, params):
+        pass
+
+    def irc_MODE(self, client, params):
+        pass
+
+    def irc_CAP(self, client, params):
+        if not self.ircv3:
+            client.send(u':%s 421 %s CAP :Unknown command' % (SERVER_NAME, client.nick or '*'))
+            return
+        subcommand = params[0].upper() if params else ''
+        if subcommand == 'LS':
+            client.send(u':%s CAP %s LS :%s' % (SERVER_NAME, client.nick or '*', ' '.join(CAPABILITIES)))
+        elif subcommand == 'REQ':
+            caps = params[1].split() if len(params) > 1 else []
+            if [cap for cap in caps if cap.lstrip('-') not in CAPABILITIES]:
+                client.send(u':%s CAP %s NAK :%s' % (SERVER_NAME, client.nick or '*', ' '.join(caps)))
+                return
+            for cap in caps:
+                if cap.startswith('-'):
+                    client.caps.discard(cap[1:])
+                else:
+                    client.caps.add(cap)
+            client.send(u':%s CAP %s ACK :%s' % (SERVER_NAME, client.nick or '*', ' '.join(caps)))
+
+    def irc_WHO(self, client, params):
+        if self.ircv3 and len(params) > 1 and params[1].startswith('%'):
+            # WHOX: WHO #channel %fields,token
+            fields, _, token = params[1][1:].partition(',')
+            for user in self.channels.get(params[0].lower(), set()):
+                values = {'t': token, 'c': params[0], 'u': user.user, 'i': '255.255.255.255', 'h': user.host,
+                          's': SERVER_NAME, 'n': user.nick, 'f': 'H', 'd': '0', 'l': '0',
+                          'a': user.account or '0', 'o': 'n/a', 'r': ':' + user.nick}
+                self._numeric(client, '354', u' '.join(values[f] for f in WHOX_FIELDS if f in fields))
+        self._numeric(client, '315', u'%s :End of /WHO list.' % (params[0] if params else '*'))
+
+    def irc_JOIN(self, client, params):
+        for channel in params[0].split(','):
+            members = self.channels.setdefault(channel.lower(), set())
+            members.add(client)
+            client.channels.add(channel.lower())
+            self._join(client, channel, members)
+            self._names(client, channel, members)
+            if self.on_join:
+                self.on_join(client, channel)
+
+    def _join(self, user, channel, members):
+        for member in members:
+            if 'extended-join' in member.caps:
+                member.send(u':%s JOIN %s %s :%s' % (user.prefix, channel, user.account or '*', user.nick))
+            else:
+                member.send(u':%s JOIN %s' % (user.prefix, channel))
+
+    def _names(self, client, channel, members):
+        """
+        as many 353 as needed to stay below 512 bytes
+        """
+        head = u'= %s :' % channel
+        names = []
+        for user in members:
+            names.append(user.nick)
+            if len(head) + len(u' '.join(names)) > 400:
+                self._numeric(client, '353', head + u' '.join(names))
+                names = []
+        if names:
+            self._numeric(client, '353', head + u' '.join(names))
+        self._numeric(client, '366', u'%s :End of /NAMES list.' % channel)
+
+    def irc_PART(self, client, params):
+        for channel in params[0].split(','):
+            members = self.channels.get(channel.lower(), set())
+            if client in members:
+                self._broadcast(members, u':%s PART %s' % (client.prefix, channel))
+                members.discard(client)
+                client.channels.discard(channel.lower())
+
+    def irc_PRIVMSG(self, client, params, command='PRIVMSG'):
+        if len(params) < 2:
+            self._numeric(client, '412', u':No text to send')
+            return
+        for target in params[0].split(','):
+            self._deliver(client, command, target, params[1])
+            if self.on_message:
+                self.on_message(client, command, target, params[1])
+
+    def irc_NOTICE(self, client, params):
+        self.irc_PRIVMSG(client, params, 'NOTICE')
+
+    def irc_QUIT(self, client, params):
+        client.handler.request.close()
+
+    def _deliver(self, sender, command, target, text):
+        line = u':%s %s %s :%s' % (sender.prefix, command, target, text)
+        if target[0] == '#':
+            self._broadcast(self.channels.get(target.lower(), set()) - set([sender]), line)
+            return
+
+        user = self.users.get(target.split('@')[0].lower())  # Q@CServe.quakenet.org
+        if user is None:
+            sender.send(u':%s 401 %s %s :No such nick/channel' % (SERVER_NAME, sender.nick, target))
+        elif user is self.service and command == 'PRIVMSG':
+            self._service(sender, text)
+        else:
+            user.send(line)
+
+    def _neighbours(self, user):
+        neighbours = set()
+        for channel in user.channels:
+            neighbours |= self.channels[channel]
+        return neighbours
+
+    def _broadcast(self, users, line):
+        for user in users:
+            user.send(line)
+
+    # the auth bots
+
+    def _service(self, client, text):
+        words = text.split()
+        if not words:
+            return
+        getattr(self, '_%s_%s' % (self.network, words[0].lower()), self._unknown_service_command)(client, words[1:])
+
+    def _service_reply(self, client, text):
+        with self._replies_cond:
+            self._replies.append((time.time() + self.auth_delay, client, u':%s NOTICE %s :%s' % (self.service.prefix, client.nick, text)))
+            self._replies_cond.notify()
+
+    def _send_replies(self):
+        while True:
+            with self._replies_cond:
+                while not self._replies:
+                    self._replies_cond.wait()
+                when, client, line = self._replies.popleft()
+            if when > time.time():
+                time.sleep(when - time.time())
+            client.send(line)
+
+    def _unknown_service_command(self, client, args):
+        self._service_reply(client, u'Unknown command. Type HELP for help.')
+
+    def _quakenet_auth(self, client, args):
+        client.authed = True
+        client.account = args[0] if args else client.nick
+        self._service_reply(client, u'You are now logged in as %s.' % client.account)
+
+    def _quakenet_whois(self, client, args):
+        if not client.authed:
+            self._service_reply(client, u'WHOIS is only available to authed users.')
+            return
+        nick = args[0] if args else ''
+        user = self.users.get(nick.lower())
+        if user is None:
+            self._service_reply(client, u"Can't find user %s." % nick)
+        elif user.account:
+            self._service_reply(client, u'-Information for user %s (using account %s):' % (user.nick, user.account))
+            self._service_reply(client, u'End of list.')
+        else:
+            self._service_reply(client, u'User %s is not authed.' % user.nick)
+
+    def _freenode_identify(self, client, args):
+        client.authed = True
+        client.account = args[0] if args else client.nick
+        self._service_reply(client, u'You are now identified for %s.' % client.account)
+
+    def _freenode_acc(self, client, args):
+        nick = args[0] if args else ''
+        user = self.users.get(nick.lower())
+        if user is None:
+            self._service_reply(client, u'%s ACC 0' % nick)
+        elif user.account:
+            self._service_reply(client, u'%s ACC 3' % user.nick)
+        else:
+            self._service_reply(client, u'%s ACC 1' % user.nick)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='A fake irc server.')
+    parser.add_argument('--port', type=int, default=6667)
+    parser.add_argument('--network', choices=sorted(SERVICES.keys()) + ['none'], default='quakenet')
+    parser.add_argument('--auth-delay', type=float, default=0, help="how long the auth bot takes to reply, in seconds")
+    parser.add_argument('--users', type=int, default=10, help="idle users, half of them authed")
+    parser.add_argument('--channel', default='#bench')
+    parser.add_argument('--ircv3', action='store_true', help="tell the accounts with account-notify, extended-join and WHOX")
+    args = parser.parse_args()
+
+    ircd = FakeIrcd(args.port, args.network, args.auth_delay, ircv3=args.ircv3)
+    for i in range(args.users):
+        ircd.add_user('user%04d' % i, 'acct%04d' % i if i % 2 else None)
+        ircd.join('user%04d' % i, args.channel)
+    print "listening on %d (%s)" % (ircd.port, args.network)
+    t = ircd.start()
+    while t.is_alive():
+        t.join(1)  # a bare join would not let ^C through
@@ -0,0 +1,466 @@
+"""
+Load test of the whole bot: a local fake irc server (see bench.fakeircd), the StupidIrcBot
+of NotABot.py connected to it in a child process, and virtual users chatting and issuing
+commands in its channels, while a local rss feed gets new entries in bursts.
+
+$ python -m bench.loadtest --channels 20 --users 200 --duration 60 --mix calc=2,rand=1,stats=1
+
+It reports the latency of every command (from the message of the user to the reply of the bot),
+the messages per second both ways, and the memory and cpu used by the bot process.
+
+The bot runs with its own settings (see bot_settings), in a temporary directory for its
+databases and logs. The outgoing flood control and the per user command limits are lifted
+unless --flood-profile is given, so the numbers are the ones of the bot, not the ones of the network.
+"""
+import argparse
+import os
+import random
+import re
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import traceback
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from email.utils import formatdate
+from threading import Lock, Thread
+
+import bench  # ensures there is a settings module
+from bench.fakeircd import FakeIrcd
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+AUTH_PLUGINS = {
+    'quakenet': 'quakenet.quakebot.QuakeNetPlugin',
+    'freenode': 'freenode.freebot.FreenodePlugin',
+}
+
+FEED_TITLE = u'benchfeed'
+# what the rss plugin sends to the channels: kind -> regexp
+FEED_LINES = {
+    'entries': re.compile(re.escape(FEED_TITLE) + u' : '),
+    # more than FEED_MAX_ENTRIES new entries
+    'summaries': re.compile(r'\d+ new entries for ' + re.escape(FEED_TITLE) + r' !'),
+    # the replies to !feedadd
+    'setup': re.compile(r'Feed added to this channel\.|Already added in this channel\.|Invalid RSS feed\.'),
+}
+
+WORDS = u"lol ok the a bot rand stats why is it so hard to type right now anyway brb tonight maybe".split()
+
+
+# the commands the users can issue: name -> (plugin, fn(user, seq) returning the line and a test of the reply)
+
+def _calc(user, seq):
+    n = 1000000 + seq  # the result identifies the command
+    return u'!calc %d+0' % n, lambda text: text == unicode(n)
+
+
+def _rand(user, seq):
+    return u'!rand', lambda text: user.shown_as(text) and u'(1-100)' in text
+
+
+def _stats(user, seq):
+    return u'!stats', lambda text: user.shown_as(text) and (u' rolled ' in text or u'No stats' in text)
+
+
+COMMANDS = {
+    'calc': ('calc.calcbot.CalcPlugin', _calc),
+    'rand': ('rand.randbot.RandPlugin', _rand),
+    'stats': ('rand.randbot.RandPlugin', _stats),
+}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class User(object):
+    def __init__(self, nick, account, channels):
+        self.nick = nick
+        self.account = account
+        self.channels = channels
+        self.pending = None  # the command waiting for a reply
+
+    def shown_as(self, text):
+        """
+        the bot names the users by their account, or by their nick if it couldn't get it
+        """
+        return (self.account and self.account in text) or self.nick in text
+
+
+class Pending(object):
+    def __init__(self, user, name, channel, test):
+        self.user = user
+        self.name = name
+        self.channel = channel
+        self.test = test
+        self.sent = time.time()
+
+
+class FeedServer(HTTPServer):
+    """
+    an rss feed getting `burst` new entries every `interval` seconds
+    """
+
+    def __init__(self, burst, interval):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FeedHandler)
+        self.port = self.server_address[1]
+        self.burst = burst
+        self.interval = interval
+        self.started = time.time()
+        self.fetched = 0
+
+    def rss(self):
+        bursts = int((time.time() - self.started) / self.interval) + 1
+        updated = self.started + (bursts - 1) * self.interval
+        items = []
+        for i in reversed(range(max(0, bursts * self.burst - 50), bursts * self.burst)):
+            items.append(u'<item><title>entry %d</title><link>http://127.0.0.1:%d/entry/%d</link><guid>entry-%d</guid>'
+                         u'<pubDate>%s</pubDate><description>entry %d</description></item>' % (i, self.port, i, i, formatdate(updated), i))
+        return (u'<?xml version="1.0"?><rss version="2.0"><channel><title>%s</title><link>http://127.0.0.1:%d/</link>'
+                u'<description>bench</description><lastBuildDate>%s</lastBuildDate>%s</channel></rss>'
+                % (FEED_TITLE, self.port, formatdate(updated), u''.join(items))).encode('utf-8')
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.rss()
+        self.server.fetched += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rss+xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def bot_settings(args, port, channels, workdir):
+    plugins = []
+    for name in args.mix:
+        if COMMANDS[name][0] not in plugins:
+            plugins.append(COMMANDS[name][0])
+    if args.feed_burst:
+        plugins.append('feed.rssbot.RssPlugin')
+
+    overrides = {
+        'NICK': u'StupidBench', 'REALNAME': u'StupidBench', 'SERVER': u'127.0.0.1', 'PORT': port,
+        'START_CHANNELS': channels, 'NETWORKS': [], 'ADMINS': ['admin'],
+        'AUTH_LOGIN': 'stupidbench', 'AUTH_PASSWORD': 'bench',
+        'PLUGINS': plugins,
+        'LOG_DIR': os.path.join(workdir, 'logs'),
+        'BACKUP_DIR': os.path.join(workdir, 'backups'),
+        'WORKER_THREADS': args.workers,
+        'SHARDS': args.shards,
+        'FEED_FETCH_TIME': args.feed_interval / 60.0,
+        'METRICS_INTERVAL': 0,
+    }
+    if args.flood_profile:
+        overrides['FLOOD_PROFILE'] = args.flood_profile
+    else:
+        overrides['FLOOD_PROFILE'] = 'bench'
+        overrides['FLOOD_PROFILES'] = {'bench': {'lines_rate': 100000, 'lines_burst': 100000, 'bytes_rate': 10 ** 8, 'bytes_burst': 10 ** 8}}
+        overrides['FLOOD_PROTECTION_MAX_COMMANDS'] = 100000
+    if args.network in AUTH_PLUGINS:
+        overrides['AUTH_PLUGIN'] = AUTH_PLUGINS[args.network]
+    return overrides
+
+
+def run_bot(overrides, workdir):
+    """
+    in the child process
+    """
+    import settings
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+    if 'AUTH_PLUGIN' not in overrides and hasattr(settings, 'AUTH_PLUGIN'):
+        del settings.AUTH_PLUGIN
+
+    sys.path.insert(0, BOT_DIR)  # the plugins are imported from there
+    os.chdir(workdir)  # the plugins databases are created in the current directory
+    from NotABot import StupidIrcBot
+    StupidIrcBot().start()
+
+
+class LoadTest(object):
+    def __init__(self, args):
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.lock = Lock()
+
+        self.channels = ['#bench%d' % i for i in range(args.channels)]
+        self.joined = set()
+        self.users = []
+        self.pendings = dict((channel.lower(), []) for channel in self.channels)
+
+        self.chatter = 0
+        self.commands = 0
+        self.latencies = dict((name, []) for name in args.mix)
+        self.lost = dict((name, 0) for name in args.mix)
+        self.replies = 0
+        self.feed_lines = dict((kind, 0) for kind in FEED_LINES)
+        self.service_lines = 0
+        self.unmatched = 0
+        self.bot_lines = 0
+
+        self.rss = []  # (time, rss in kB) of the bot process
+
+    def setup(self):
+        args = self.args
+        self.ircd = FakeIrcd(args.port, args.network, args.auth_delay, ircv3=args.ircv3)
+        self.ircd.on_message = self.on_message
+        self.ircd.on_join = self.on_join
+
+        for i in range(args.users):
+            account = 'acct%04d' % i if self.rnd.random() < args.authed else None
+            channels = self.rnd.sample(self.channels, min(args.user_channels, len(self.channels)))
+            user = User('user%04d' % i, account, channels)
+            self.ircd.add_user(user.nick, account)
+            for channel in channels:
+                self.ircd.join(user.nick, channel)
+            self.users.append(user)
+        self.ircd.add_user('admin', 'admin')
+        for channel in self.channels:
+            self.ircd.join('admin', channel)
+
+    def start_bot(self):
+        self.workdir = tempfile.mkdtemp(prefix='stupidbench')
+        overrides = bot_settings(self.args, self.ircd.port, self.channels, self.workdir)
+        self.pid = os.fork()  # before any thread is started
+        if self.pid == 0:
+            self.ircd.server_close()
+            try:
+                run_bot(overrides, self.workdir)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(0)
+        self.ircd.start()
+
+    def stop_bot(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        # lets the server see the connection closed before the interpreter exits
+        end = time.time() + 5
+        while self.ircd.clients() and time.time() < end:
+            time.sleep(0.05)
+        if self.args.keep:
+            print "the databases and logs of the bot are in %s" % self.workdir
+        else:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def wait_joined(self, timeout=60):
+        end = time.time() + timeout
+        while len(self.joined) < len(self.channels):
+            if time.time() > end:
+                raise RuntimeError('the bot joined only %d of the %d channels in %ds.' % (len(self.joined), len(self.channels), timeout))
+            if os.waitpid(self.pid, os.WNOHANG)[0]:
+                raise RuntimeError('the bot process died, see its output above.')
+            time.sleep(0.1)
+
+    def add_feeds(self):
+        self.feeds = FeedServer(self.args.feed_burst, self.args.feed_interval)
+        t = Thread(target=self.feeds.serve_forever, name='feeds')
+        t.daemon = True
+        t.start()
+        for channel in self.channels:
+            self.ircd.say('admin', channel, u'!feedadd %s http://127.0.0.1:%d/feed.xml' % (FEED_TITLE, self.feeds.port))
+
+    # what the bot sends
+
+    def on_join(self, client, channel):
+        self.joined.add(channel.lower())
+
+    def on_message(self, client, command, target, text):
+        with self.lock:
+            self.bot_lines += 1
+            if target[0] != '#':
+                self.service_lines += 1
+                return
+            for kind, regexp in FEED_LINES.items():
+                if regexp.match(text):
+                    self.feed_lines[kind] += 1
+                    return
+            pendings = self.pendings.get(target.lower(), [])
+            for pending in pendings:
+                if pending.test(text):
+                    pendings.remove(pending)
+                    pending.user.pending = None
+                    self.latencies[pending.name].append(time.time() - pending.sent)
+                    self.replies += 1
+                    return
+            self.unmatched += 1
+
+    # the load
+
+    def chat(self):
+        user = self.rnd.choice(self.users)
+        text = u' '.join(self.rnd.choice(WORDS) for w in range(self.rnd.randint(1, 12)))
+        self.ircd.say(user.nick, self.rnd.choice(user.channels), text)
+        self.chatter += 1
+
+    def command(self):
+        with self.lock:
+            idle = [u for u in self.rnd.sample(self.users, min(20, len(self.users))) if u.pending is None]
+            if not idle:
+                return
+            user = idle[0]
+            name = self.rnd.choice(self.args.mix)
+            line, test = COMMANDS[name][1](user, self.commands)
+            pending = user.pending = Pending(user, name, self.rnd.choice(user.channels), test)
+            self.pendings[pending.channel.lower()].append(pending)
+            self.commands += 1
+        self.ircd.say(user.nick, pending.channel, line)
+
+    def expire(self, older_than):
+        with self.lock:
+            for channel, pendings in self.pendings.items():
+                for pending in [p for p in pendings if p.sent < older_than]:
+                    pendings.remove(pending)
+                    pending.user.pending = None
+                    self.lost[pending.name] += 1
+
+    def bot_pids(self):
+        """
+        the bot process and its shard processes
+        """
+        try:
+            with open('/proc/%d/task/%d/children' % (self.pid, self.pid)) as f:
+                return [self.pid] + [int(pid) for pid in f.read().split()]
+        except IOError:
+            return [self.pid]
+
+    def sample_memory(self):
+        rss = 0
+        try:
+            for pid in self.bot_pids():
+                with open('/proc/%d/status' % pid) as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            rss += int(line.split()[1])
+        except IOError:
+            return  # not linux
+        self.rss.append((time.time(), rss))
+
+    def cpu_time(self):
+        try:
+            total = 0
+            for pid in self.bot_pids():
+                with open('/proc/%d/stat' % pid) as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                total += int(fields[11]) + int(fields[12])
+            return total / float(os.sysconf('SC_CLK_TCK'))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def run(self):
+        args = self.args
+        start = last_sample = time.time()
+        cpu_start = self.cpu_time()
+        self.sample_memory()
+        while time.time() - start < args.duration:
+            elapsed = time.time() - start
+            while self.chatter < elapsed * args.rate:
+                self.chat()
+            while self.commands < elapsed * args.command_rate and self._command_possible():
+                self.command()
+            if time.time() - last_sample > 1:
+                self.sample_memory()
+                self.expire(time.time() - args.timeout)
+                last_sample = time.time()
+            time.sleep(0.01)
+        self.duration = time.time() - start
+
+        # the replies still on their way
+        end = time.time() + args.timeout
+        while any(self.pendings.values()) and time.time() < end:
+            time.sleep(0.1)
+        self.expire(time.time())
+        self.sample_memory()
+        cpu_end = self.cpu_time()
+        self.cpu = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+
+    def _command_possible(self):
+        return any(u.pending is None for u in self.users)
+
+    def report(self):
+        args = self.args
+        print "%d channels, %d users (%d%% authed), network %s, %d workers, %d shards, %ds" % (
+            args.channels, args.users, args.authed * 100, args.network, args.workers, args.shards, self.duration)
+        print "sent %d chatter lines and %d commands (%.1f lines/s)" % (self.chatter, self.commands, (self.chatter + self.commands) / self.duration)
+        print "received %d lines from the bot (%.1f lines/s) : %d replies, %d feed lines, %d to the auth bot, %d other" % (
+            self.bot_lines, self.bot_lines / self.duration, self.replies, sum(self.feed_lines.values()), self.service_lines, self.unmatched)
+        if args.feed_burst:
+            print "feed lines : %d entries, %d summaries of too many entries, %d replies to !feedadd" % (
+                self.feed_lines['entries'], self.feed_lines['summaries'], self.feed_lines['setup'])
+        print
+        print "%-8s %7s %6s %8s %8s %8s %8s" % ('command', 'replies', 'lost', 'p50', 'p95', 'p99', 'max')
+        for name in sorted(set(args.mix)):
+            latencies = self.latencies[name]
+            print "%-8s %7d %6d %7.1fms %7.1fms %7.1fms %7.1fms" % (
+                name, len(latencies), self.lost[name], percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000,
+                percentile(latencies, 0.99) * 1000, max(latencies or [0]) * 1000)
+        print
+        if self.rss:
+            print "memory : %.1f MB after joining, %.1f MB at the end, %.1f MB at most" % (
+                self.rss[0][1] / 1024.0, self.rss[-1][1] / 1024.0, max(r for t, r in self.rss) / 1024.0)
+        if self.cpu is not None:
+            print "cpu : %.1fs (%d%% of a core)" % (self.cpu, self.cpu / self.duration * 100)
+
+
+def parse_mix(value):
+    """
+    calc=2,rand=1 -> ['calc', 'calc', 'rand']
+    """
+    mix = []
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name not in COMMANDS:
+            raise argparse.ArgumentTypeError('unknown command %s, one of %s' % (name, ', '.join(sorted(COMMANDS))))
+        mix.extend([name] * int(weight or 1))
+    return mix
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of the bot against a local fake irc server.')
+    parser.add_argument('--channels', type=int, default=10)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--user-channels', type=int, default=3, help="the channels joined by each user")
+    parser.add_argument('--authed', type=float, default=0.8, help="the share of the users having an account")
+    parser.add_argument('--duration', type=float, default=30, help="in seconds")
+    parser.add_argument('--rate', type=float, default=50, help="chatter lines per second, over all the channels")
+    parser.add_argument('--command-rate', type=float, default=5, help="commands per second, over all the channels")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('calc=1,rand=1,stats=1'), help="the commands issued and their weights")
+    parser.add_argument('--timeout', type=float, default=10, help="a command not answered after this many seconds is lost")
+    parser.add_argument('--feed-burst', type=int, default=0, help="new entries of the feed followed in every channel, at every fetch")
+    parser.add_argument('--feed-interval', type=float, default=10, help="how often the bot fetches the feeds, in seconds")
+    parser.add_argument('--network', choices=sorted(AUTH_PLUGINS.keys()) + ['none'], default='quakenet')
+    parser.add_argument('--auth-delay', type=float, default=0.05, help="how long the auth bot takes to reply, in seconds")
+    parser.add_argument('--ircv3', action='store_true', help="the server tells the accounts (account-notify, extended-join, WHOX)")
+    parser.add_argument('--workers', type=int, default=4, help="WORKER_THREADS of the bot")
+    parser.add_argument('--shards', type=int, default=0, help="SHARDS of the bot")
+    parser.add_argument('--flood-profile', help="the outgoing flood control of the bot, none by default")
+    parser.add_argument('--port', type=int, default=0, help="of the fake irc server, any free one by default")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keep', action='store_true', help="keep the databases and logs of the bot")
+    args = parser.parse_args()
+
+    test = LoadTest(args)
+    test.setup()
+    test.start_bot()
+    try:
+        test.wait_joined()
+        if args.feed_burst:
+            test.add_feeds()
+        test.run()
+    finally:
+        test.stop_bot()
+    test.report()
@@ -0,0 +1,198 @@
+"""
+Replays the events logged by the bot (logs/YYYY/M/daily.log, see BaseIrcBot.log_msg)
+through its handlers as fast as possible, to benchmark the dispatch on real traffic.
+
+$ python -m bench.replay logs/2014/3/daily.log [logs/2014/3/daily.log.2014-03-01 ...] [--repeat 3]
+
+Every event goes through BaseIrcBot._dispatch_plugins (the on_* hooks of the plugins) and
+BaseIrcBot.global_handler (logging, commands, triggers), like when the irc library gets it.
+The commands and triggers run in the replaying thread (WORKER_THREADS = 0), so their cost
+is measured, and the coroutines and delayed calls of the plugins are run between two events.
+
+The side effects are kept away:
+* the bot is never connected, what it sends goes nowhere (but is counted)
+* it runs in a temporary directory, for the databases of the plugins and the logs
+* any outgoing connection fails (weather, wikipedia, feeds...), unless --network is given
+
+It reports the events per second, the cost by event type, and the commands, triggers and
+on_* handlers that cost the most.
+"""
+import argparse
+import os
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import bench  # ensures there is a settings module
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 2014-03-01 21:04:01,042 - pubmsg - #chan - nick: the text | more arguments
+LINE = re.compile(r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} - (?P<type>[a-z_]+) - (?P<target>[^ ]*) - (?P<source>[^ ]*): (?P<arguments>.*)$')
+
+# their only argument is the text, which can contain ' | '
+MESSAGE_EVENTS = ('pubmsg', 'privmsg', 'pubnotice', 'privnotice', 'action')
+
+
+def parse_log(path):
+    """
+    yields (type, source, target, arguments), the other lines (what the bot sent, joins...) are skipped
+    """
+    with open(path) as f:
+        for line in f:
+            m = LINE.match(line.rstrip('\r\n').decode('utf-8', 'replace'))
+            if m is None:
+                continue
+            if m.group('type') in MESSAGE_EVENTS:
+                arguments = [m.group('arguments')]
+            elif m.group('arguments'):
+                arguments = m.group('arguments').split(u' | ')
+            else:
+                arguments = []
+            target = m.group('target')
+            yield m.group('type'), m.group('source'), None if target == u'None' else target, arguments
+
+
+def make_events(records):
+    from irc.client import Event, NickMask
+    events = []
+    for type, source, target, arguments in records:
+        if source and '.' not in source:  # a nick, not a server
+            source = NickMask(source)
+        events.append(Event(type, source, target, arguments))
+    return events
+
+
+class NullConnection(object):
+    """
+    the connection of the bot, any call (privmsg, join, send_raw...) is only counted
+    """
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls[name] += 1
+        return call
+
+
+def no_network(*args, **kwargs):
+    raise socket.error('no network during a replay')
+
+
+def make_bot(args, workdir):
+    import settings
+    overrides = {
+        'LOG_DIR': os.path.join(workdir, 'logs'),
+        'BACKUP_DIR': os.path.join(workdir, 'backups'),
+        'NETWORKS': [],
+        'WORKER_THREADS': 0,
+        'SHARDS': 0,
+        'METRICS_INTERVAL': 0,
+        'PROFILE_HANDLERS': True,
+        # the events come way faster than they did
+        'FLOOD_PROFILE': 'replay',
+        'FLOOD_PROFILES': {'replay': {'lines_rate': 10 ** 8, 'lines_burst': 10 ** 8, 'bytes_rate': 10 ** 10, 'bytes_burst': 10 ** 10}},
+        'FLOOD_PROTECTION_MAX_COMMANDS': 10 ** 8,
+    }
+    if args.plugins is not None:
+        overrides['PLUGINS'] = [p for p in args.plugins.split(',') if p]
+    if args.auth_plugin is not None:
+        overrides['AUTH_PLUGIN'] = args.auth_plugin
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+
+    sys.path.insert(0, BOT_DIR)  # the plugins are imported from there
+    os.chdir(workdir)  # the plugins databases are created in the current directory
+    from NotABot import StupidIrcBot
+    bot = StupidIrcBot()
+    bot.connection = bot.server = NullConnection()
+
+    # the plugins are initialized in threads, and registered from the reactor
+    end = time.time() + 60
+    while bot._plugins_pending and time.time() < end:
+        bot.engine.reactor.process_timeout()
+        time.sleep(0.01)
+    return bot
+
+
+def replay(bot, events):
+    """
+    returns the total time and {event type: [count, time]}
+    """
+    reactor = bot.engine.reactor
+    connection = bot.connection
+    by_type = defaultdict(lambda: [0, 0.0])
+    start = time.time()
+    for ev in events:
+        ev_start = time.time()
+        bot._dispatch_plugins(connection, ev)
+        bot.global_handler(connection, ev)
+        reactor.process_timeout()
+        cost = by_type[ev.type]
+        cost[0] += 1
+        cost[1] += time.time() - ev_start
+    return time.time() - start, by_type
+
+
+def report(bot, events, elapsed, by_type, top):
+    print "%d events in %.2fs : %d events/s" % (len(events), elapsed, len(events) / elapsed)
+    print "sent %s" % (', '.join('%d %s' % (n, name) for name, n in sorted(bot.connection.calls.items())) or 'nothing')
+    print
+    print "%-20s %8s %10s %8s" % ('event', 'count', 'total', 'average')
+    for type, (count, total) in sorted(by_type.items(), key=lambda t: -t[1][1]):
+        print "%-20s %8d %8.1fms %6.1fus" % (type, count, total * 1000, total / count * 10 ** 6)
+
+    counters, histograms, gauges = bot.metrics.snapshot()
+    for metric, label, title in [('command_handle_seconds', 'command', 'command'), ('trigger_seconds', 'trigger', 'trigger')]:
+        rows = [(dict(labels)[label], stats) for (name, labels), stats in histograms if name == metric]
+        print
+        print "%-28s %8s %10s %8s %8s" % (title, 'count', 'total', 'p50', 'p95')
+        for name, (count, total, maximum, quantiles) in sorted(rows, key=lambda r: -r[1][1])[:top]:
+            q = dict(quantiles)
+            print "%-28s %8d %8.1fms %6.2fms %6.2fms" % (name, count, total * 1000, q[0.5] * 1000, q[0.95] * 1000)
+
+    print
+    print "%-40s %8s %10s %8s" % ('handler', 'count', 'total', 'max')
+    for handler, (count, total, maximum) in sorted(bot.handler_timings.items(), key=lambda h: -h[1][1])[:top]:
+        print "%-40s %8d %8.1fms %6.2fms" % (handler, count, total * 1000, maximum * 1000)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays the daily.log of the bot through its handlers.')
+    parser.add_argument('logs', nargs='+', help="daily.log files")
+    parser.add_argument('--plugins', help="comma separated, the PLUGINS of the settings by default")
+    parser.add_argument('--auth-plugin', help="the AUTH_PLUGIN of the settings by default")
+    parser.add_argument('--repeat', type=int, default=1, help="replay the events this many times")
+    parser.add_argument('--limit', type=int, help="replay only the first events")
+    parser.add_argument('--top', type=int, default=10, help="how many commands, triggers and handlers to show")
+    parser.add_argument('--network', action='store_true', help="let the plugins connect to the internet")
+    parser.add_argument('--keep', action='store_true', help="keep the databases and logs of the bot")
+    args = parser.parse_args()
+
+    records = []
+    for path in args.logs:
+        records.extend(parse_log(os.path.abspath(path)))
+    records = records[:args.limit] * args.repeat
+    if not records:
+        parser.error('no event found in %s' % ', '.join(args.logs))
+
+    if not args.network:
+        socket.create_connection = no_network
+
+    workdir = tempfile.mkdtemp(prefix='stupidreplay')
+    try:
+        bot = make_bot(args, workdir)
+        events = make_events(records)
+        elapsed, by_type = replay(bot, events)
+        report(bot, events, elapsed, by_type, args.top)
+    finally:
+        if args.keep:
+            print "the databases and logs of the bot are in %s" % workdir
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,94 @@
+"""
+Microbenchmark of the trigger matching done for every message in BaseIrcBot.global_handler
+
+$ python -m bench.triggers [--messages N]
+"""
+import argparse
+import random
+import re
+import time
+
+import bench  # ensures there is a settings module
+
+from basebot import TriggerIndex
+
+
+def get_trigger_classes():
+    """
+    the triggers of the plugins shipped with the bot, when they can be imported
+    """
+    triggers = []
+    for mod, attr in [('NotABot', 'StupidIrcBot'),
+                      ('plugins.quakenet.quakebot', 'QuakeNetPlugin'),
+                      ('plugins.freenode.freebot', 'FreenodePlugin'),
+                      ('plugins.facts.facts', 'FactsPlugin'),
+                      ('plugins.cleverbot.cleverircbot', 'CleverBotPlugin')]:
+        try:
+            triggers.extend(getattr(__import__(mod, fromlist=[attr]), attr).TRIGGERS)
+        except ImportError, e:
+            print "skipping %s (%s)" % (mod, e)
+    return triggers
+
+
+WORDS = u"lol ok the a bot rand stats why is it so hard to type right now anyway brb tonight maybe".split()
+
+
+def make_messages(n):
+    """
+    mostly chatter, with some services replies and rolls like on a real channel
+    """
+    rnd = random.Random(42)
+    msgs = []
+    for i in xrange(n):
+        r = rnd.random()
+        if r < 0.02:
+            msgs.append(u"User nick%d is not authed." % i)
+        elif r < 0.04:
+            msgs.append(u"nick%d obtient un %d (1-100)" % (i, rnd.randint(1, 100)))
+        elif r < 0.1:
+            msgs.append(u"!%s %s" % (rnd.choice(WORDS), rnd.choice(WORDS)))
+        else:
+            msgs.append(u" ".join(rnd.choice(WORDS) for w in xrange(rnd.randint(1, 12))))
+    return msgs
+
+
+def linear(triggers, msgs):
+    """
+    the previous implementation, every REGEXP tried on every message
+    """
+    table = dict((t.REGEXP, t) for t in triggers)
+    matched = 0
+    for msg in msgs:
+        for regexp, trigger_class in table.items():
+            if re.match(regexp, msg):
+                matched += 1
+    return matched
+
+
+def indexed(triggers, msgs):
+    index = TriggerIndex()
+    index.add(*triggers)
+    matched = 0
+    for msg in msgs:
+        for trigger_class, m in index.match(msg):
+            matched += 1
+    return matched
+
+
+def run(name, fn, triggers, msgs):
+    start = time.time()
+    matched = fn(triggers, msgs)
+    elapsed = time.time() - start
+    print "%-8s %8d msgs/s (%d matches)" % (name, len(msgs) / elapsed, matched)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Trigger matching microbenchmark.')
+    parser.add_argument('--messages', type=int, default=200000)
+    args = parser.parse_args()
+
+    triggers = get_trigger_classes()
+    msgs = make_messages(args.messages)
+    print "%d triggers, %d messages" % (len(triggers), len(msgs))
+    run('before', linear, triggers, msgs)
+    run('after', indexed, triggers, msgs)
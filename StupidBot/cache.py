@@ -0,0 +1,52 @@
+"""
+A size bounded LRU cache whose entries also expire, used for the responses of the commands
+(see BaseCommand.CACHE_TTL), shared by the worker threads.
+"""
+from threading import Lock
+from collections import OrderedDict
+
+from flood import monotonic
+
+
+class LRUCache(object):
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()  # key -> (expires at, value), least recently used first
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0  # to make room, the expired ones are not counted
+
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evicted': self.evicted}
+
+    def get(self, key):
+        """
+        returns (True, value), or (False, None) if the key is unknown or expired
+        """
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] <= monotonic():
+                self.misses += 1
+                return False, None
+            self.entries[key] = entry  # the most recently used now
+            self.hits += 1
+            return True, entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (monotonic() + ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+
+    def clear(self):
+        """
+        returns the number of entries removed
+        """
+        with self._lock:
+            count = len(self.entries)
+            self.entries.clear()
+            return count
@@ -0,0 +1,253 @@
+"""
+A small coroutine engine running on the irc reactor thread.
+
+Python 2 generators play the part of coroutines (the same way trollius does),
+the engine drives them and resumes them from the reactor, so a plugin can wait
+for timers or blocking calls without owning a thread:
+
+    def poll(self):
+        while True:
+            data = yield Blocking(urllib.urlopen(URL).read)
+            ...
+            yield Sleep(60)
+
+    self.spawn(self.poll())
+
+What a coroutine can yield:
+* Sleep(seconds): resumed after this delay.
+* Blocking(fn, *args, **kwargs): fn is run in a worker thread, the coroutine gets back
+  its result, or its exception is raised at the yield.
+* another coroutine (generator) or a Task: waits for it and gets back its result.
+* None: gives the hand back to the reactor, resumed as soon as possible.
+
+python 2 generators can't return a value, use raise Return(value).
+"""
+import os
+import fcntl
+import sys
+import threading
+import types
+
+
+class Return(Exception):
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+
+class CancelledError(Exception):
+    pass
+
+
+class Sleep(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class Blocking(object):
+    def __init__(self, fn, *args, **kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self):
+        return self.fn(*self.args, **self.kwargs)
+
+
+class Task(object):
+    """
+    A running coroutine.
+    """
+
+    def __init__(self, engine, coroutine, plugin=None):
+        self.engine = engine
+        self.coroutine = coroutine
+        self.plugin = plugin  # the blocking calls count in the plugin MAX_CONCURRENCY
+
+        self.done = False
+        self.cancelled = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()  # the callbacks can be added from another thread
+        self._stack = []  # the coroutines waiting for the current one to return
+        self._timer = None  # while it sleeps
+
+    def __repr__(self):
+        return '<Task %s>' % getattr(self.coroutine, '__name__', self.coroutine)
+
+    def result(self):
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def add_done_callback(self, fn):
+        """
+        thread safe, fn(task) is called once it is done, right now if it already is
+        """
+        with self._lock:
+            if not self.done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def cancel(self):
+        if not self.done:
+            self.cancelled = True
+            if self._timer is not None:
+                self._timer.cancel()
+            self.engine.call_soon(self._step)
+
+    def _step(self, value=None, exc_info=None):
+        if self.done:
+            return
+        self._timer = None
+        if self.cancelled:
+            for coroutine in [self.coroutine] + self._stack:
+                coroutine.close()
+            self._stack = []
+            self._finish(exc_info=(CancelledError, CancelledError(), None))
+            return
+
+        try:
+            if exc_info:
+                yielded = self.coroutine.throw(*exc_info)
+            else:
+                yielded = self.coroutine.send(value)
+        except StopIteration:
+            self._return()
+        except Return, r:
+            self._return(r.value)
+        except Exception:
+            self._return(exc_info=sys.exc_info())
+        else:
+            self.engine._wait(self, yielded)
+
+    def _return(self, value=None, exc_info=None):
+        if self._stack:
+            # back to the calling coroutine
+            self.coroutine = self._stack.pop()
+            self._step(value, exc_info)
+        else:
+            if exc_info:
+                self.engine.bot.error_logger.error('Error in %r' % self, exc_info=exc_info)
+            self._finish(value, exc_info)
+
+    def _finish(self, value=None, exc_info=None):
+        with self._lock:
+            self._result = value
+            self._exc_info = exc_info
+            self.done = True
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+class Wakeup(object):
+    """
+    A pipe registered with the reactor like a connection, written to when something is scheduled
+    from another thread, so the select of process_forever returns right away instead of after its timeout.
+    """
+
+    def __init__(self, reactor):
+        self.socket, self._write = os.pipe()
+        for fd in (self.socket, self._write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._signalled = False
+        reactor.connections.append(self)
+
+    def _get_socket(self):
+        # the old irc.client.IRC reactor
+        return self.socket
+
+    def wake(self):
+        if not self._signalled:
+            self._signalled = True
+            try:
+                os.write(self._write, b'.')
+            except OSError:
+                pass  # the pipe is full, the reactor is woken anyway
+
+    def process_data(self):
+        """
+        called by the reactor, which then runs the delayed calls
+        """
+        self._signalled = False
+        try:
+            os.read(self.socket, 4096)
+        except OSError:
+            pass
+
+    def disconnect(self, message=''):
+        pass
+
+
+class Engine(object):
+    # how long to wait before retrying a blocking call when the workers queue is full
+    BUSY_RETRY = 1  # in seconds
+
+    def __init__(self, bot, reactor):
+        self.bot = bot
+        self.reactor = reactor
+        self.wakeup = Wakeup(reactor)
+
+    def spawn(self, coroutine, plugin=None):
+        task = Task(self, coroutine, plugin)
+        self.call_soon(task._step)
+        return task
+
+    def call_soon(self, fn, *args):
+        """
+        thread safe, fn will be called from the reactor thread
+        """
+        self.call_later(0, fn, *args)
+
+    def call_later(self, delay, fn, *args):
+        """
+        thread safe, fn will be called from the reactor thread, returns a Timer (see timers.py)
+        or None if there is no delay
+        """
+        if delay <= 0:
+            self._schedule(fn, args)
+            return None
+        # the timer thread only hands it to the reactor
+        return self.bot.timers.call_later(delay, self._schedule, fn, args)
+
+    def _schedule(self, fn, args):
+        self.reactor.execute_delayed(0, fn, args)
+        self.wakeup.wake()
+
+    def _wait(self, task, yielded):
+        if yielded is None:
+            self.call_soon(task._step)
+        elif isinstance(yielded, Sleep):
+            task._timer = self.call_later(yielded.seconds, task._step)
+        elif isinstance(yielded, Blocking):
+            self._submit(task, yielded)
+        elif isinstance(yielded, types.GeneratorType):
+            task._stack.append(task.coroutine)
+            task.coroutine = yielded
+            self.call_soon(task._step)
+        elif isinstance(yielded, Task):
+            yielded.add_done_callback(lambda t: self.call_soon(task._step, t._result, t._exc_info))
+        else:
+            try:
+                raise TypeError('A coroutine can not yield %r.' % (yielded,))
+            except TypeError:
+                self.call_soon(task._step, None, sys.exc_info())
+
+    def _submit(self, task, blocking):
+        if not self.bot.workers.submit(task.plugin, self._run_blocking, task, blocking):
+            self.bot.error_logger.warning('Worker queue full, %r will retry its blocking call.' % task)
+            self.call_later(self.BUSY_RETRY, self._submit, task, blocking)
+
+    def _run_blocking(self, task, blocking):
+        """
+        called from a worker thread
+        """
+        try:
+            value = blocking()
+        except Exception:
+            self.call_soon(task._step, None, sys.exc_info())
+        else:
+            self.call_soon(task._step, value)
@@ -0,0 +1,162 @@
+"""
+Outgoing flood control.
+
+The rfc only gives advices about how to deal with flood, so servers are free to have
+their own implementation, and there is no way to tell at what speed the server really
+process data. So we keep token buckets depending on the network (see FLOOD_PROFILES),
+and wait exactly the time needed before a line can be sent:
+ - lines_rate/lines_burst and bytes_rate/bytes_burst: one bucket for the lines and one for the bytes
+ - penalty_line/penalty_bytes/penalty_burst: the ircu model, a single bucket of seconds, where
+   a line costs penalty_line seconds plus 1 per penalty_bytes bytes, with penalty_burst seconds ahead
+"""
+from threading import Lock
+from collections import OrderedDict
+import time
+
+try:
+    from time import monotonic
+except ImportError:
+    # the backport, in requirements.txt: time.time can go backward, and break the buckets
+    from monotonic import monotonic
+
+import settings
+
+
+# rates are per second, bursts are what can be sent at once after being idle
+FLOOD_PROFILES = {
+    # ircu (and snircd): every line costs 2 seconds plus 1 per 120 bytes, 10 seconds ahead is an excess flood
+    'quakenet': {'penalty_line': 2, 'penalty_bytes': 120, 'penalty_burst': 10},
+    # ircd-seven, charybdis
+    'freenode': {'lines_rate': 1, 'lines_burst': 5, 'bytes_rate': 512, 'bytes_burst': 2048},
+    # what the old settings meant: no more than MAX_MSG_LEN bytes every FLOOD_TIMER seconds
+    'default': {'lines_rate': 1.0 / getattr(settings, 'TIME_BETWEEN_MSGS', 1),
+                'lines_burst': 5,
+                'bytes_rate': float(getattr(settings, 'MAX_MSG_LEN', 450)) / getattr(settings, 'FLOOD_TIMER', 4),
+                'bytes_burst': getattr(settings, 'MAX_MSG_LEN', 450)},
+}
+FLOOD_PROFILES.update(getattr(settings, 'FLOOD_PROFILES', {}))
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + max(0, now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self, cost, now):
+        """
+        the time to wait before cost tokens are available
+        """
+        self._refill(now)
+        cost = min(cost, self.burst)  # or it would never be available
+        if self.tokens >= cost:
+            return 0
+        return (cost - self.tokens) / self.rate
+
+    def consume(self, cost, now):
+        self._refill(now)
+        self.tokens -= min(cost, self.burst)
+
+
+class FloodController(object):
+    def __init__(self, profile):
+        self.profile = profile
+        self.buckets = []  # (bucket, cost of a line of nbytes)
+        if 'lines_rate' in profile:
+            self.buckets.append((TokenBucket(profile['lines_rate'], profile['lines_burst']),
+                                 lambda nbytes: 1))
+        if 'bytes_rate' in profile:
+            self.buckets.append((TokenBucket(profile['bytes_rate'], profile['bytes_burst']),
+                                 lambda nbytes: nbytes))
+        if 'penalty_burst' in profile:
+            self.buckets.append((TokenBucket(1, profile['penalty_burst']),
+                                 lambda nbytes: profile['penalty_line'] + float(nbytes) / profile['penalty_bytes']))
+        self.total_wait = 0  # the time spent waiting, in seconds
+        self._lock = Lock()
+
+    @classmethod
+    def from_profile(cls, name, logger=None):
+        if name not in FLOOD_PROFILES:
+            if logger is not None:
+                logger.warning('Unknown flood profile %s, using the default one.' % name)
+            name = 'default'
+        return cls(FLOOD_PROFILES[name])
+
+    def wait_time(self, nbytes):
+        with self._lock:
+            now = monotonic()
+            return max([bucket.delay(cost(nbytes), now) for bucket, cost in self.buckets] or [0])
+
+    def acquire(self, nbytes):
+        """
+        blocks until a line of nbytes can be sent without flooding, and account for it
+        """
+        wait = self.wait_time(nbytes)
+        while wait > 0:
+            time.sleep(wait)
+            self.total_wait += wait
+            wait = self.wait_time(nbytes)
+        with self._lock:
+            now = monotonic()
+            for bucket, cost in self.buckets:
+                bucket.consume(cost(nbytes), now)
+
+
+class CommandRateLimiter(object):
+    """
+    Incoming flood control: how many commands a user can issue.
+
+    GCRA (a leaky bucket storing only a time per user): a command of cost 1 is allowed every
+    period / burst seconds, with bursts of up to burst commands.
+    A command of cost n counts for n commands, even when n is more than burst.
+    A user whose bucket is empty again is forgotten, and never more than max_users are tracked
+    (the least recently seen are forgotten first).
+    """
+
+    def __init__(self, burst, period, max_users):
+        self.burst = burst
+        self.interval = float(period) / burst  # the time to recover from a command of cost 1
+        self.max_users = max_users
+        self.tats = OrderedDict()  # user -> theoretical arrival time, least recently seen first
+        self._lock = Lock()
+
+        self.allowed = 0
+        self.rejected = 0
+        self.evicted = 0
+
+    def stats(self):
+        return {'tracked': len(self.tats), 'allowed': self.allowed, 'rejected': self.rejected, 'evicted': self.evicted}
+
+    def check(self, user, cost=1):
+        """
+        returns True if user can issue a command of this cost now, and account for it
+        """
+        with self._lock:
+            now = monotonic()
+            tat = max(self.tats.pop(user, now), now)
+            debt = tat - now + self.interval * cost
+            # a command costing more than the whole burst is allowed once the user fully recovered
+            if debt > self.interval * self.burst + 1e-6 and tat > now:  # float rounding
+                self.rejected += 1
+                allowed = False
+            else:
+                self.allowed += 1
+                tat = now + debt
+                allowed = True
+            self.tats[user] = tat
+            self._evict(now)
+            return allowed
+
+    def _evict(self, now):
+        while self.tats:
+            user, tat = next(self.tats.iteritems())
+            if tat > now and len(self.tats) <= self.max_users:
+                break
+            del self.tats[user]
+            if tat > now:
+                self.evicted += 1
@@ -0,0 +1,150 @@
+"""
+In process metrics: counters and latency histograms, plus gauges read when the
+metrics are exported (queue depths, flood wait...), see BaseIrcBot._metrics_gauges.
+
+    bot.metrics.inc('commands_total', command='meteo')
+    with bot.metrics.timer('trigger_seconds', trigger='QAuthTrigger'):
+        ...
+
+They are shown by the !perf admin command, and written every METRICS_INTERVAL seconds
+to LOG_DIR/metrics.prom in the prometheus text format, which the node_exporter
+textfile collector (or a simple cat) can read.
+"""
+import os
+import time
+from collections import deque
+from threading import Lock
+
+# the percentiles reported for every histogram
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, unicode(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+
+def _format_name(name, labels):
+    return name + _format_labels(labels)
+
+
+class Histogram(object):
+    """
+    Keeps the last `size` samples to compute the percentiles, and the count and sum of all of them.
+    """
+
+    def __init__(self, size):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantiles(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return [(q, 0.0) for q in QUANTILES]
+        return [(q, samples[min(len(samples) - 1, int(q * len(samples)))]) for q in QUANTILES]
+
+
+class Timer(object):
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.time() - self.start, **self.labels)
+
+
+class Metrics(object):
+    """
+    Thread safe, the commands run in the worker threads and the messages are sent from the msg consumers.
+    """
+
+    def __init__(self, samples=1000):
+        self.samples = samples
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.gauges = []  # callables returning [(name, labels dict, value), ...]
+        self._lock = Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.samples)
+            histogram.observe(seconds)
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def add_gauges(self, fn):
+        self.gauges.append(fn)
+
+    def read_gauges(self):
+        values = []
+        for fn in self.gauges:
+            for name, labels, value in fn():
+                values.append((_key(name, labels), value))
+        return values
+
+    def snapshot(self):
+        """
+        returns (counters, histograms, gauges), the histograms as (count, sum, max, quantiles)
+        """
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (h.count, h.sum, h.max, h.quantiles())) for key, h in self.histograms.items())
+        return counters, histograms, sorted(self.read_gauges())
+
+    def slowest(self, name, count=5):
+        """
+        the labels and stats of the histograms of this name with the highest p95 first
+        """
+        histograms = [(labels, stats) for (n, labels), stats in self.snapshot()[1] if n == name]
+        return sorted(histograms, key=lambda h: -dict(h[1][3])[0.95])[:count]
+
+    def to_prometheus(self):
+        counters, histograms, gauges = self.snapshot()
+        lines = []
+        for (name, labels), value in counters:
+            lines.append('%s %s' % (_format_name(name, labels), value))
+        for (name, labels), (count, total, maximum, quantiles) in histograms:
+            for q, value in quantiles:
+                lines.append('%s %f' % (name + _format_labels(labels, [('quantile', q)]), value))
+            lines.append('%s %d' % (_format_name(name + '_count', labels), count))
+            lines.append('%s %f' % (_format_name(name + '_sum', labels), total))
+        for (name, labels), value in gauges:
+            lines.append('%s %s' % (_format_name(name, labels), value))
+        return u'\n'.join(lines) + u'\n'
+
+    def write(self, path):
+        """
+        atomically, the collectors never read a partial file
+        """
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.to_prometheus().encode('utf-8'))
+        os.rename(tmp, path)
@@ -0,0 +1,156 @@
+from threading import Condition
+from collections import deque
+
+# the lower, the sooner
+PRIORITY_HIGH = 0  # the authentification of the bot, admin replies
+PRIORITY_NORMAL = 1  # command replies
+PRIORITY_LOW = 2  # announcements nobody is waiting for (feeds...), auth bot queries
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+
+class _Level(object):
+    """
+    the messages of one priority, a fifo per target
+    """
+
+    def __init__(self):
+        self.queues = {}  # target -> deque of messages
+        self.deficits = {}  # target -> bytes it can send in this round
+        self.active = deque()  # the targets with messages, in round robin order
+
+
+class OutQueue(object):
+    """
+    The outgoing messages, with one fifo per target.
+
+    Priorities are strict: a message is only sent when there is nothing
+    of a higher priority waiting.
+    Within a priority, targets are served in deficit round robin: each turn a target
+    gets QUANTUM bytes of credit and sends while its credit covers its next message,
+    so a burst of lines to a channel doesn't delay the replies to other targets.
+    """
+    # the credit in bytes given to a target every turn, about a short line,
+    # so the targets mostly take turns line by line
+    QUANTUM = 100
+
+    def __init__(self, quantum=None):
+        self.quantum = quantum or self.QUANTUM
+        self._cond = Condition()
+        self._levels = dict((p, _Level()) for p in PRIORITIES)
+        self._size = 0
+
+    def qsize(self):
+        return self._size
+
+    def depths(self):
+        """
+        the number of waiting messages per target
+        """
+        depths = {}
+        with self._cond:
+            for level in self._levels.values():
+                for target, queue in level.queues.items():
+                    depths[target] = depths.get(target, 0) + len(queue)
+        return depths
+
+    def put(self, msg, priority=PRIORITY_NORMAL):
+        with self._cond:
+            level = self._levels[priority]
+            if msg.target not in level.queues:
+                level.queues[msg.target] = deque()
+                level.deficits[msg.target] = 0
+                level.active.append(msg.target)
+            level.queues[msg.target].append(msg)
+            self._size += 1
+            self._cond.notify()
+
+    def get(self):
+        """
+        blocks until there is a message to send
+        """
+        with self._cond:
+            while not self._size:
+                self._cond.wait()
+            for priority in PRIORITIES:
+                level = self._levels[priority]
+                if level.active:
+                    return self._pop(level)
+
+    def take(self, target, priority, max_bytes):
+        """
+        pops the next message of target with this priority if it's not longer than max_bytes,
+        without waiting. It is charged to the deficit of target, like a message sent in its turn.
+        """
+        with self._cond:
+            level = self._levels[priority]
+            queue = level.queues.get(target)
+            if not queue:
+                return None
+            cost = len(to_bytes(queue[0].text))
+            if cost > max_bytes:
+                return None
+            msg = queue.popleft()
+            if queue:
+                level.deficits[target] -= cost  # can go negative, the target then skips turns
+            else:
+                del level.queues[target]
+                del level.deficits[target]
+                level.active.remove(target)
+            self._size -= 1
+            return msg
+
+    def _pop(self, level):
+        while True:
+            target = level.active[0]
+            queue = level.queues[target]
+            cost = len(to_bytes(queue[0].text))  # the quantum is in bytes
+            if level.deficits[target] < cost:
+                # next turn
+                level.deficits[target] += self.quantum
+                level.active.rotate(-1)
+                continue
+
+            level.deficits[target] -= cost
+            msg = queue.popleft()
+            if not queue:
+                del level.queues[target]
+                del level.deficits[target]
+                level.active.popleft()
+            self._size -= 1
+            return msg
+
+
+def to_bytes(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+def split_text(text, max_bytes):
+    """
+    splits text in chunks of at most max_bytes once encoded in utf-8,
+    on spaces when possible and never inside a multi-byte character.
+    A str is split as it is, and its chunks are left as bytes, it can be in another encoding.
+    Linear in the length of text.
+    """
+    data = to_bytes(text)
+    max_bytes = max(max_bytes, 4)  # at least one character
+    chunks = []
+    pos = 0
+    while len(data) - pos > max_bytes:
+        end = pos + max_bytes
+        while end > pos and (ord(data[end]) & 0xC0) == 0x80:
+            # data[end] is a continuation byte, the character starts before
+            end -= 1
+        if end == pos:
+            # only continuation bytes, not utf-8 (a str in another encoding), cut anywhere
+            end = pos + max_bytes
+        cut = data.rfind(' ', pos, end)
+        if cut <= pos:
+            cut = end
+        chunks.append(data[pos:cut])
+        pos = cut + 1 if data[cut] == ' ' else cut
+    chunks.append(data[pos:])
+    if not isinstance(text, unicode):
+        return chunks
+    return [c.decode('utf-8') for c in chunks]
@@ -76,6 +76,7 @@ class CalcCommand(BaseCommand):
     NAME = "calc"
     ALIASES = ['c']
     HELP = u"!calc EXPRESSION: a simple calculator."
+    COST = 3  # spawns a process
     
     def parse_options(self):
         if not len(self.options):
@@ -111,3 +112,4 @@ class CalcCommand(BaseCommand):
 
 class CalcPlugin(BaseBotPlugin):
     COMMANDS = [CalcCommand,]
+    MAX_CONCURRENCY = 2  # every calc spawns a process
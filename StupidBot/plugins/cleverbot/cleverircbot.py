@@ -1,6 +1,5 @@
 #! -*- coding: utf-8 -*-
 #from cleverbot import Cleverbot
-from chatterbotapi import ChatterBotFactory, ChatterBotType
 import settings
 
 from basebot import BaseBotPlugin, BaseTrigger
@@ -18,9 +17,11 @@ class CleverBotTrigger(BaseTrigger):
 class CleverBotPlugin(BaseBotPlugin):
     COMMANDS = []
     TRIGGERS = [CleverBotTrigger]
+    MAX_CONCURRENCY = 1  # there is only one brain session
 
     def __init__(self, bot):
         super(CleverBotPlugin, self).__init__(bot)
+        from chatterbotapi import ChatterBotFactory, ChatterBotType
         factory = ChatterBotFactory()
         cleverbot = factory.create(ChatterBotType.CLEVERBOT)
         self.bot.brain = cleverbot.create_session()
@@ -8,7 +8,9 @@ from basebot import BaseBotPlugin, BaseCommand, BadCommandLineException
 class CurrencyCommand(BaseCommand):
     NAME = "currency"
     ALIASES = ["cur",]
+    COST = 2  # http request
     HELP = u"!currency FROMCUR [TOCUR] [AMOUNT] - for a list of all currencies, check !currencies."
+    CACHE_TTL = 10 * 60  # the rates are updated every hour
 
     default_currency = getattr(settings,'DEFAULT_CURRENCY', 'eur')
     oops = u'Wrong parameters, or service unreachable.'
@@ -33,8 +35,15 @@ class CurrencyCommand(BaseCommand):
         else:
             raise BadCommandLineException
 
+    def get_cache_key(self):
+        return self.from_curr.lower(), self.to_curr.lower(), self.amount
+
+    def should_cache(self, response):
+        return response != self.oops
+
     def get_response(self):
-        c = convert(from_curr=self.from_curr, to_curr=self.to_curr, amount=self.amount)
+        c = self.bot.flights.do('openexchange', self.get_cache_key(), convert,
+                                from_curr=self.from_curr, to_curr=self.to_curr, amount=self.amount)
         if c is None:
             return self.oops
 
@@ -44,9 +53,10 @@ class CurrencyCommand(BaseCommand):
 class CurrenciesCommand(BaseCommand):
     NAME = "currencies"
     HELP = u"!currencies - a list of all available currencies"
+    CACHE_TTL = 24 * 3600
 
     def get_response(self):
-        curs = get_currencies()
+        curs = self.bot.flights.do('openexchange', 'currencies', get_currencies)
         if not curs:
             return self.oops
         return ', '.join(curs)
@@ -1,9 +1,8 @@
-import time
 import urllib
-from threading import Thread
 from xml.dom.minidom import parseString
 
-from basebot import BaseCommand, BaseBotPlugin
+from basebot import BaseCommand, BaseBotPlugin, PRIORITY_LOW
+from engine import Blocking, Sleep
 
 
 class RegisterOnline(BaseCommand):
@@ -11,7 +10,7 @@ class RegisterOnline(BaseCommand):
 
     def get_response(self):
         if self.ev.target.startswith('#'):
-            self.plugin.registered_chans.add(self.ev.target)
+            self.plugin.registered_chans.add((self.bot.network_name, self.ev.target))
             if len(self.plugin.registered_chans) == 1:
                 self.plugin.fetch()
         return u"Done."
@@ -33,7 +32,14 @@ class EvePlugin(BaseBotPlugin):
     def __init__(self, bot):
         super(EvePlugin, self).__init__(bot)
         self.online = None
-        self.registered_chans = set()
+        self.registered_chans = set()  # (network, channel)
+        self.poller = None
+
+    def migrate(self, old):
+        super(EvePlugin, self).migrate(old)
+        if self.poller is not None and not self.poller.done:
+            self.poller.cancel()
+            self.poller = self.spawn(self._poll())
 
     def on_welcome(self, serv, ev):
         if self.registered_chans:
@@ -51,11 +57,15 @@ class EvePlugin(BaseBotPlugin):
             msg = msg + " (%d players)" % self.nb
         return  msg
 
+    def _get_status(self):
+        return urllib.urlopen(self.API_ONLINE_URL).read()
+
     def _poll(self):
         # polling
         while(True):
             try:
-                data = urllib.urlopen(self.API_ONLINE_URL).read()
+                # a reloaded plugin can poll while the old poller still waits for its answer
+                data = yield Blocking(self.bot.flights.do, 'eveonline', self.API_ONLINE_URL, self._get_status)
                 dom = parseString(data)
                 online = dom.getElementsByTagName("serverOpen")[0].firstChild.wholeText
                 nbnode = dom.getElementsByTagName("onlinePlayers")
@@ -66,13 +76,12 @@ class EvePlugin(BaseBotPlugin):
                 o = (online == u"True")
                 if o != self.online:
                     self.online = o
-                    for chan in self.registered_chans:
-                        self.bot.send(chan, self.tell_status())
-            except (TypeError, IndexError, ValueError), e:
+                    for network, chan in self.registered_chans:
+                        self.bot.networks[network].send(chan, self.tell_status(), priority=PRIORITY_LOW)
+            except (TypeError, IndexError, ValueError, IOError), e:
                 self.bot.error_logger.error("Error fetching eve status : %s" % e)
-            time.sleep(self.FETCH_TIME*60)
+            yield Sleep(self.FETCH_TIME*60)
 
     def fetch(self):
-        thr = Thread(target=self._poll)
-        thr.daemon = True
-        thr.start()
+        if self.poller is None or self.poller.done:
+            self.poller = self.spawn(self._poll())
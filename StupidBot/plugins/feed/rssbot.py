@@ -2,14 +2,11 @@ import re
 import os.path
 import sqlite3
 import datetime, time
-import bleach
-from threading import Thread
-
-import feedparser
 
 import settings
 
-from basebot import BaseBotPlugin, BaseCommand, BadCommandLineException
+from basebot import BaseBotPlugin, BaseCommand, BadCommandLineException, PRIORITY_LOW
+from engine import Blocking, Sleep
 
 
 def dt_to_sql(dt):
@@ -32,7 +29,7 @@ class RssFeed(object):
         self.updated = from_sql_dt(row[2])
         self.last_entry = row[3]
 
-        self.server = settings.SERVER
+        self.server = row[8]
         self.channel = row[4]
         self.title = row[5]
         self.filter = row[6]
@@ -51,6 +48,7 @@ class RssFeed(object):
             return u'Bad parameters.'
 
     def tell_more(self, entry):
+        import bleach
         try:
             return [entry.title, re.sub(r'\s+', ' ', bleach.clean(entry.summary, tags=[], strip=True)), entry.link]
         except (IndexError, AttributeError), e:
@@ -70,6 +68,7 @@ class RssFeed(object):
         self.plugin.feed_conn.commit()
 
     def fetch(self):
+        import feedparser
         data = feedparser.parse(self.url, request_headers={'Cache-control': 'max-age=%d' % self.plugin.FETCH_TIME * 60})
 
         del self.entries
@@ -119,7 +118,7 @@ class AddFeedCommand(BaseCommand):
 
     def get_response(self):
         # check if the feed already exists, create it if not
-        feed, created = self.plugin._get_or_create_feed(self.feed_url, self.feed_title, self.ev.target)
+        feed, created = self.plugin._get_or_create_feed(self.feed_url, self.feed_title, self.ev.target, self.bot.network_name)
         if feed:
             if created:
                 return u'Feed added to this channel.'
@@ -135,7 +134,7 @@ class FeedListCommand(BaseCommand):
 
     def get_response(self):
         if self.plugin.feeds:
-            return ' - '.join(['%s:%s' % (f.title, f.url) for f in self.plugin.feeds if (self.ev.target == f.channel)])
+            return ' - '.join(['%s:%s' % (f.title, f.url) for f in self.plugin.feeds if (self.ev.target == f.channel and self.bot.network_name == f.server)])
         else:
             return u'No rss feed added yet.'
 
@@ -153,7 +152,7 @@ class FeedRemoveCommand(BaseCommand):
     def get_response(self):
         chan = self.ev.target
         for feed in self.plugin.feeds:
-            if feed.title == self.options[0] and feed.channel == chan:
+            if feed.title == self.options[0] and feed.channel == chan and feed.server == self.bot.network_name:
                 feed.delete()
                 self.plugin.feeds.remove(feed)
                 return "Done. %s won't bother you anymore." % feed.title
@@ -182,7 +181,7 @@ class FeedAddFilter(BaseCommand):
 
     def get_response(self):
         for feed in self.plugin.feeds:
-            if feed.title == self.options[0] and feed.channel == self.ev.target:
+            if feed.title == self.options[0] and feed.channel == self.ev.target and feed.server == self.bot.network_name:
                 self.apply_filter(feed)
                 return self.RESPONSE % feed.title
 
@@ -250,11 +249,13 @@ class RssPlugin(BaseBotPlugin):
     MAX_ENTRIES = getattr(settings, 'FEED_MAX_ENTRIES', 5)  # maximum entries to display when fetching a feed
 
     COMMANDS = [AddFeedCommand, FeedListCommand, FeedRemoveCommand, FeedCommand, FeedAddFilter, FeedAddExclude]
+    MAX_CONCURRENCY = 1  # the commands share self.feeds and feed_conn
 
     def __init__(self, bot):
         super(RssPlugin, self).__init__(bot)
 
         self.feeds = []
+        self.poller = None
 
         # initialize the loop to fetch the feeds
         if not os.path.isfile(self.db_file):
@@ -263,15 +264,26 @@ class RssPlugin(BaseBotPlugin):
         else:
             self.feed_conn = sqlite3.connect(self.db_file, check_same_thread=False)
 
-        sql = "SELECT ROWID, url, last_updated, last_entry, channel, title, filter, exclude FROM feeds WHERE server=?"
+        # the feeds of all the networks the bot is connected to
+        servers = self.bot.networks.keys()
+        sql = "SELECT ROWID, url, last_updated, last_entry, channel, title, filter, exclude, server FROM feeds WHERE server IN (%s)" % ','.join('?' * len(servers))
         cur = self.feed_conn.cursor()
-        for row in cur.execute(sql, [settings.SERVER,]):
+        for row in cur.execute(sql, servers):
             self.feeds.append(RssFeed(self, row))
         cur.close()
 
     def close(self):
         self.feed_conn.close()
 
+    def migrate(self, old):
+        super(RssPlugin, self).migrate(old)
+        for feed in self.feeds:
+            feed.__class__ = RssFeed  # the reloaded one
+            feed.plugin = self
+        if self.poller is not None and not self.poller.done:
+            self.poller.cancel()
+            self.poller = self.spawn(self._fetch())
+
     def on_welcome(self, serv, ev):
         self.fetch_feeds()
 
@@ -292,12 +304,13 @@ class RssPlugin(BaseBotPlugin):
         self.feed_conn.commit()
         cur.close()
 
-    def _get_or_create_feed(self, feed_url, feed_title, chan):
+    def _get_or_create_feed(self, feed_url, feed_title, chan, server):
         created = False
         for feed in self.feeds:
-            if feed.url == feed_url and feed.channel == chan:
+            if feed.url == feed_url and feed.channel == chan and feed.server == server:
                 return feed, created
 
+        import feedparser
         try:
             data = feedparser.parse(feed_url)
 
@@ -309,7 +322,7 @@ class RssPlugin(BaseBotPlugin):
                 upd = getattr(data,'updated',None) or getattr(data, 'published', None) or data['entries'][0]['published']
                 last_updated = datetime.datetime.strptime(upd[:24], '%a, %d %b %Y %H:%M:%S')
 
-            feed = RssFeed(self, self._create_feed(feed_url, feed_title, last_entry, dt_to_sql(last_updated), chan))
+            feed = RssFeed(self, self._create_feed(feed_url, feed_title, last_entry, dt_to_sql(last_updated), chan, server))
             feed.entries = data['entries']
             created = True
         except (IndexError, KeyError), e:
@@ -319,31 +332,33 @@ class RssPlugin(BaseBotPlugin):
         self.feeds.append(feed)
         return feed, created
 
-    def _create_feed(self, feed_url, feed_title, last_entry, last_updated, chan):
+    def _create_feed(self, feed_url, feed_title, last_entry, last_updated, chan, server):
         sql = "INSERT INTO feeds (url, last_entry, last_updated, server, channel, title) VALUES (?,?,?,?,?,?)"
         cur = self.feed_conn.cursor()
-        cur.execute(sql, [feed_url, last_entry, last_updated, settings.SERVER, chan, feed_title])
+        cur.execute(sql, [feed_url, last_entry, last_updated, server, chan, feed_title])
         self.feed_conn.commit()
 
-        sql = "SELECT ROWID, url, last_updated, last_entry, channel, title, filter, exclude FROM feeds WHERE url=?"
-        cur.execute(sql, [feed_url,])
+        sql = "SELECT ROWID, url, last_updated, last_entry, channel, title, filter, exclude, server FROM feeds WHERE ROWID=?"
+        cur.execute(sql, [cur.lastrowid,])
         return cur.fetchone()
 
     def _fetch(self):
         # polling
         while(True):
-            for feed in self.feeds:
+            for feed in list(self.feeds):
                 # TODO : this is sub-obtimal,
                 # if we have the same feed in different channels, it will be fetched as many times
-                new_data = feed.fetch()
+                network = self.bot.networks.get(feed.server, self.bot)
+                if not network.owns(feed.channel):
+                    continue  # polled by another shard process
+                new_data = yield Blocking(feed.fetch)
                 if len(new_data) > self.MAX_ENTRIES:
-                    self.bot.send(feed.channel, u"%d new entries for %s ! access them with !feed %s X" % (len(new_data), feed.title, feed.title))
+                    network.send(feed.channel, u"%d new entries for %s ! access them with !feed %s X" % (len(new_data), feed.title, feed.title), priority=PRIORITY_LOW)
                 else:
                     for n, entry in enumerate(new_data[:self.MAX_ENTRIES]):
-                        self.bot.send(feed.channel, feed.tell(entry))
-            time.sleep(self.FETCH_TIME * 60)
+                        network.send(feed.channel, feed.tell(entry), priority=PRIORITY_LOW)
+            yield Sleep(self.FETCH_TIME * 60)
 
     def fetch_feeds(self):
-        thr = Thread(target=self._fetch)
-        thr.daemon = True
-        thr.start()
+        if self.poller is None or self.poller.done:  # on_welcome is called again after a reconnection
+            self.poller = self.spawn(self._fetch())
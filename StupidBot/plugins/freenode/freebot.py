@@ -1,8 +1,6 @@
-from basebot import BaseTrigger
+from basebot import BaseTrigger, PRIORITY_HIGH
 from auth import BaseIdentPlugin, AuthCommand, BaseAuth
 
-import settings
-
 
 class FreenodeAuth(BaseAuth):
     USER_INFO_CMD = u"ACC %s"
@@ -28,7 +26,10 @@ class ACCTrigger(BaseTrigger):
 
     def handle(self):
         username = self.match.group('username')
-        self.auth = self.bot.auth_plugin.get_auth(username)
+        # NickServ replies are sent to every shard process, only the ones knowing the user care
+        self.auth = self.bot.auth_plugin.auths.get(username)
+        if not self.auth:
+            return
         status = int(self.match.group('status'))
         if status == 0 or status == 1:
             self.auth.set_auth(None)
@@ -39,10 +40,11 @@ class ACCTrigger(BaseTrigger):
 class FreenodePlugin(BaseIdentPlugin):
     AUTH_CLASS = FreenodeAuth
     AUTH_BOT = "NickServ"
+    FLOOD_PROFILE = 'freenode'
 
     COMMANDS = [AuthCommand,]
     TRIGGERS = [ACCTrigger, BotAuthedTrigger]  # , BotNotAuthedTrigger
 
     def authentify(self):
         self.bot.error_logger.info("Authentifying with NickServ ...")
-        self.bot.send(self.AUTH_BOT, "identify %s %s" % (settings.AUTH_LOGIN, settings.AUTH_PASSWORD))
+        self.bot.send(self.AUTH_BOT, "identify %s %s" % (self.bot.AUTH_LOGIN, self.bot.AUTH_PASSWORD), priority=PRIORITY_HIGH)
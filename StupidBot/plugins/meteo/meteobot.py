@@ -1,8 +1,9 @@
 #! -*- coding: utf-8 -*-
 import os
 import sqlite3
+from threading import Lock
 
-from datetime import datetime
+from datetime import datetime, date
 from unidecode import unidecode
 
 from basebot import BaseBotPlugin
@@ -15,6 +16,8 @@ from worldweatheronline import get_weather
 class MeteoCommand(BaseAuthCommand):
     NAME = "meteo"
     ALIASES = ["weather",]
+    COST = 2  # http request
+    CACHE_TTL = 30 * 60  # the forecasts don't change that often
 
     # custom
     DATE_REQUEST_CHOICES = ['current', 'today', 'tomorrow', 'weekend']
@@ -25,21 +28,36 @@ class MeteoCommand(BaseAuthCommand):
     def get_user_from_line(self):
         return self.ev.source.nick
 
-    def get_response(self):
-        user = self.bot.auth_plugin.get_username(self.user)
-        location = self.plugin.meteo_db[user] or getattr(settings, 'DEFAULT_LOCATION', 'Paris,france')
-        day = 'tomorrow'
+    def get_location(self):
+        """
+        returns the (location, day) asked, the location is remembered as the one of the user
+        """
+        if not hasattr(self, 'location'):
+            user = self.bot.auth_plugin.get_username(self.user)
+            self.location = self.plugin.meteo_db[user] or getattr(settings, 'DEFAULT_LOCATION', 'Paris,france')
+            self.day = 'tomorrow'
 
-        for arg in self.options:
-            if arg in ['current', 'today', 'tomorrow', 'weekend']:
-                day = arg
-            else:
-                location = unidecode(arg)
+            for arg in self.options:
+                if arg in ['current', 'today', 'tomorrow', 'weekend']:
+                    self.day = arg
+                else:
+                    self.location = unidecode(arg)
+
+            self.plugin.meteo_db[user] = self.location
+        return self.location, self.day
 
-        self.plugin.meteo_db[user] = location
+    def get_cache_key(self):
+        location, day = self.get_location()
+        return location.lower(), day, date.today()
+
+    def should_cache(self, response):
+        return response != self.oops
+
+    def get_response(self):
+        location, day = self.get_location()
 
         # TODO : this is blocking, is it a good idea ?
-        weather, error = get_weather(location, day)
+        weather, error = self.bot.flights.do('worldweatheronline', (location.lower(), day), get_weather, location, day)
         if not weather:
             if error:
                 self.plugin.bot.error_logger.error("Cannot fetch the weather : %s" % error)
@@ -56,6 +74,8 @@ class MeteoDB(object):
     db_file = "meteo.db"
 
     def __init__(self):
+        # the commands are handled by several worker threads
+        self.lock = Lock()
         if not os.path.isfile(self.db_file):
             self._connect()
             self._make_db()
@@ -63,25 +83,27 @@ class MeteoDB(object):
             self._connect()
 
     def __getitem__(self, key):
-        cur = self.conn.cursor()
-        cur.execute("SELECT location FROM meteo WHERE user=?;", [key,])
-        r = cur.fetchone()
-        cur.close()
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute("SELECT location FROM meteo WHERE user=?;", [key,])
+            r = cur.fetchone()
+            cur.close()
         if r:
             return r[0]
         else:
             return None
 
     def __setitem__(self, key, value):
-        cur = self.conn.cursor()
-        cur.execute("SELECT ROWID FROM meteo WHERE user=?;", [key,])
-        r = cur.fetchone()
-        if r:
-            cur.execute("UPDATE meteo SET location=? WHERE user=?;", [value, key])
-        else:
-            cur.execute("INSERT INTO meteo (user, location) VALUES (?, ?);", [key, value])
-        self.conn.commit()
-        cur.close()
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute("SELECT ROWID FROM meteo WHERE user=?;", [key,])
+            r = cur.fetchone()
+            if r:
+                cur.execute("UPDATE meteo SET location=? WHERE user=?;", [value, key])
+            else:
+                cur.execute("INSERT INTO meteo (user, location) VALUES (?, ?);", [key, value])
+            self.conn.commit()
+            cur.close()
 
     def _make_db(self):
         sql = """CREATE TABLE meteo (
@@ -95,7 +117,7 @@ class MeteoDB(object):
         self.conn.close()
 
     def _connect(self):
-        self.conn = sqlite3.connect(self.db_file)
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
 
 
 class MeteoPlugin(BaseBotPlugin):
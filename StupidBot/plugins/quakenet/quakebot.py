@@ -1,5 +1,4 @@
-import settings
-from basebot import BaseTrigger
+from basebot import BaseTrigger, PRIORITY_HIGH
 from auth import BaseIdentPlugin, AuthCommand, BaseAuth
 
 
@@ -10,22 +9,23 @@ class QuakenetAuth(BaseAuth):
 class QAuthTrigger(BaseTrigger):
     def handle(self):
         username = self.match.group('username')
-        self.auth = self.bot.auth_plugin.get_auth(username)
+        # Q replies are sent to every shard process, only the ones knowing the user care
+        self.auth = self.bot.auth_plugin.auths.get(username)
+        if self.auth:
+            self.process()
 
 
 class NotAuthedTrigger(QAuthTrigger):
     REGEXP = r"User (?P<username>[^ ]+) is not authed\."
 
-    def handle(self):
-        super(NotAuthedTrigger, self).handle()
+    def process(self):
         self.auth.set_auth(None)
 
 
 class AuthedTrigger(QAuthTrigger):
     REGEXP = r"\-Information for user (?P<username>[^ ]+) \(using account (?P<authname>[^ ]+)\)"
 
-    def handle(self):
-        super(AuthedTrigger, self).handle()
+    def process(self):
         authname = self.match.group('authname')
         self.auth.set_auth(authname)
 
@@ -33,13 +33,10 @@ class AuthedTrigger(QAuthTrigger):
 class UserUnknownTrigger(QAuthTrigger):
     REGEXP = r"Can\'t find user (?P<username>[^ ]+)."
 
-    def handle(self):
-        super(UserUnknownTrigger, self).handle()
-        self.auth.set_auth(None)  # to call the callbacks
-        # self.auth is a ghost Auth instance, created only to reply
-        # to the command
-        if self.auth.nick in self.bot.auth_plugin.auths:
-            del self.bot.auth_plugin.auths[self.auth.nick]
+    def process(self):
+        self.auth.set_auth(None)  # to resolve the commands waiting for it
+        # the user is gone, the auth was only kept to reply to the command
+        self.bot.auth_plugin.forget(self.auth.nick)
 
 
 class BotNotAuthedTrigger(BaseTrigger):
@@ -60,10 +57,11 @@ class BotAuthedTrigger(BaseTrigger):
 class QuakeNetPlugin(BaseIdentPlugin):
     AUTH_CLASS = QuakenetAuth
     AUTH_BOT = "Q@CServe.quakenet.org"
+    FLOOD_PROFILE = 'quakenet'
 
     COMMANDS = [AuthCommand, ]
     TRIGGERS = [NotAuthedTrigger, AuthedTrigger, UserUnknownTrigger, BotNotAuthedTrigger, BotAuthedTrigger]
 
     def authentify(self):
         self.bot.error_logger.info("Authentifying with Q ...")
-        self.bot.send(self.AUTH_BOT, "AUTH %s %s" % (settings.AUTH_LOGIN, settings.AUTH_PASSWORD))
+        self.bot.send(self.AUTH_BOT, "AUTH %s %s" % (self.bot.AUTH_LOGIN, self.bot.AUTH_PASSWORD), priority=PRIORITY_HIGH)
@@ -13,10 +13,20 @@ import sqlite3
 import datetime
 import shutil
 import os
+from functools import wraps
+from threading import RLock
 
 import settings
 
 
+def locked(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class RandDb(object):
     db_file = "rand.db"
 
@@ -24,15 +34,20 @@ class RandDb(object):
         self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
 
     def __init__(self):
+        # the connection is shared by the worker threads (the commands of RandPlugin, the triggers of the bot),
+        # reentrant as add_entry, flush and merge use the other methods
+        self.lock = RLock()
         if not os.path.isfile(self.db_file):
             self._connect()
             self.make()
         else:
             self._connect()
 
+    @locked
     def close(self):
         self.conn.close()
 
+    @locked
     def backup(self):
         bck_dir = os.path.join(getattr(settings, 'BACKUP_DIR', 'backups'), 'rand')
         if not os.path.isdir(bck_dir):
@@ -40,6 +55,7 @@ class RandDb(object):
         d = datetime.datetime.strftime(datetime.datetime.now(), '%Y%m%d_%H%M')
         shutil.copy(self.db_file, os.path.join(bck_dir, '%s.%s' % (self.db_file, d)))
 
+    @locked
     def insert(self, table, values):
         cur = self.conn.cursor()
         if table == 'rolls':
@@ -76,6 +92,7 @@ class RandDb(object):
     def sql_dt(self, dt):
         return datetime.datetime.strftime(dt, '%Y-%m-%d %H:%M')
 
+    @locked
     def already_rolled(self, dt, user, chan):
         cur = self.conn.cursor()
         sql = "SELECT * FROM rolls WHERE date(roll_on)=date(?) AND user=? AND chan=? LIMIT 1;"
@@ -84,6 +101,7 @@ class RandDb(object):
             return True
         return False
 
+    @locked
     def add_entry(self, dt, user, roll, chan, valid=None):
         if valid is None:
             # test the existence of a roll
@@ -92,6 +110,7 @@ class RandDb(object):
         self.insert('rolls', [user, dt, roll, chan, valid])
         return valid
 
+    @locked
     def flush(self):
         self.backup()
         cur = self.conn.cursor()
@@ -99,6 +118,7 @@ class RandDb(object):
         cur.execute("DELETE FROM rolls;")
         self.conn.commit()
 
+    @locked
     def get_points(self, user, dt, chan):
         cur = self.conn.cursor()
         if not dt:
@@ -108,6 +128,7 @@ class RandDb(object):
         return cur.fetchall()
             
 
+    @locked
     def get_stats(self, user, dt, chan, allrolls=False):
         cur = self.conn.cursor()
         if not dt:
@@ -124,6 +145,7 @@ class RandDb(object):
 
             return {'avg':r[0], 'count':r[1], 'min':r[2], 'max':r[3], 'pos':p[0]}
 
+    @locked
     def get_ladder(self, min_rolls, dt, chan):
         cur = self.conn.cursor()
         if not dt:
@@ -134,6 +156,7 @@ class RandDb(object):
         cur.execute(sql, (self.sql_dt(dt), chan, min_rolls))
         return cur.fetchall()
 
+    @locked
     def get_users(self, chan, like=None):
         cur = self.conn.cursor()
         if like:
@@ -142,6 +165,7 @@ class RandDb(object):
             cur.execute("SELECT DISTINCT(user) FROM rolls WHERE chan=?;", [chan,])
         return [u[0] for u in cur.fetchall()]
 
+    @locked
     def merge(self, user1, *users):
         self.backup()
         cur = self.conn.cursor()
@@ -156,7 +156,7 @@ class MergeCommand(BaseCommand):
 
     def process(self):
         self.bot.rand_db.merge(self.dst_user, *self.src_users.split(', '))
-        self.bot.send(self.get_target(), u"Merge done in favor of %s." % self.dst_user)
+        self.bot.send(self.get_target(), u"Merge done in favor of %s." % self.dst_user, priority=self.get_priority())
 
 
 class UsersListCommand(BaseCommand):
@@ -183,7 +183,7 @@ class BackupCommand(BaseCommand):
 
     def process(self):
         self.bot.rand_db.backup()
-        self.bot.send(self.get_target(), u"Done.")
+        self.bot.send(self.get_target(), u"Done.", priority=self.get_priority())
 
 
 class GraphCommand(BaseCommand, StatsArgsMixin):
@@ -225,7 +225,7 @@ class GraphCommand(BaseCommand, StatsArgsMixin):
             data.append(d)
 
         if not data:
-            self.bot.send(self.get_target(), u"No data.")
+            self.bot.send(self.get_target(), u"No data.", priority=self.get_priority())
         else:
             with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), self.TEMPLATE), 'r') as template:
                 r = template.read()
@@ -233,11 +233,12 @@ class GraphCommand(BaseCommand, StatsArgsMixin):
             filename = "graph_%s.html" % datetime.datetime.now().strftime('%Y%m%d%H%M')
             with open(os.path.join(self.DIRECTORY, filename), 'w+') as html:
                 html.write(render)
-            self.bot.send(self.get_target(), urllib.basejoin(self.BASE_URL, filename))
+            self.bot.send(self.get_target(), urllib.basejoin(self.BASE_URL, filename), priority=self.get_priority())
 
 
 class RandPlugin(BaseBotPlugin):
     COMMANDS = [RandCommand, StatsCommand, AllStatsCommand, LadderCommand, MergeCommand, UsersListCommand, BackupCommand] #GraphCommand
+    MAX_CONCURRENCY = 1  # the queries to rand_db wait for each other anyway (see RandDb.lock), no need to hold more workers
 
     def __init__(self, bot):
         super(RandPlugin, self).__init__(bot)
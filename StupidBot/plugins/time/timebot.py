@@ -1,6 +1,4 @@
-import pytz
 from datetime import datetime
-from dateutil.parser import parse
 
 from basebot import BaseCommand, BaseBotPlugin, BadCommandLineException
 
@@ -12,8 +10,17 @@ class TimeCommand(BaseCommand):
 
     DEFAULT_TIMEZONE = 'CET'
     OUTPUT_FORMAT = '%Hh%M'
+    CACHE_TTL = 60
+
+    def get_cache_key(self):
+        # without a time, the response is the current one
+        return tuple(self.options), datetime.now().strftime('%Y%m%d%H%M')
 
     def parse_options(self):
+        # parse_options runs on the reactor, they were imported by TimePlugin, this is only a lookup
+        import pytz
+        from dateutil.parser import parse
+
         try:
             nbopts = len(self.options)
             if nbopts == 0:
@@ -55,3 +62,10 @@ class TimeCommand(BaseCommand):
 
 class TimePlugin(BaseBotPlugin):
     COMMANDS = [TimeCommand,]
+
+    def __init__(self, bot):
+        super(TimePlugin, self).__init__(bot)
+        # slow to import, done here in the init thread of the plugin, not by the first !time
+        import pytz
+        import dateutil.parser
+        pytz.timezone(TimeCommand.DEFAULT_TIMEZONE)  # and loads the zone file
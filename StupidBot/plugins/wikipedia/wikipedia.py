@@ -11,9 +11,11 @@ import settings
 class DefineCommand(BaseCommand):
     NAME = "define"
     ALIASES = ["d"]
+    COST = 2  # http request
     HELP = u"define [lang=CODE] [index=INDEX] WORD|EXPRESSION - fetch the wikipedia api to give you the definition of the given word/expression."
 
     WIKI_SEARCH_URL = u"http://%s.wikipedia.org/w/api.php"
+    CACHE_TTL = 3600
 
     def split_options(self, arguments):
         super(DefineCommand, self).split_options(arguments)
@@ -21,17 +23,27 @@ class DefineCommand(BaseCommand):
         self.lang = self.args.get(u'lang', getattr(settings, 'DEFAULT_LANG', 'en'))
         self.query = " ".join(self.options).encode('utf-8')  # because urllib doesn't like unicode
 
+    def get_cache_key(self):
+        return self.lang, self.query.lower(), self.index
+
+    def should_cache(self, response):
+        return response != u"Nop."
+
+    def fetch(self, url):
+        return urllib2.urlopen(urllib2.Request(url)).read()
+
     def get_response(self):
         params = {'action':'opensearch', 'search': self.query, 'format':'xml'}
-        request = urllib2.Request(self.WIKI_SEARCH_URL % self.lang + '?' + urllib.urlencode(params))
+        url = self.WIKI_SEARCH_URL % self.lang + '?' + urllib.urlencode(params)
         try:
-            response = urllib2.urlopen(request)
-            dom = parseString(response.read())
+            # the same search for all the indexes
+            data = self.bot.flights.do('wikipedia', url, self.fetch, url)
+            dom = parseString(data)
             name = dom.getElementsByTagName('Text')[self.index].firstChild.wholeText
             description = dom.getElementsByTagName('Description')[self.index].firstChild.wholeText
             items_count = dom.getElementsByTagName('Item').length
         except (urllib2.URLError, ExpatError, IndexError, ValueError), e:
-            self.plugin.bot.error_logger.error('Problem trying to fetch a wikipedia description (%s): %s' % (request.get_full_url(), e))
+            self.plugin.bot.error_logger.error('Problem trying to fetch a wikipedia description (%s): %s' % (url, e))
             return u"Nop."
 
         resp_count = u"%s(index %s of %d):" % (name, self.index + 1, items_count)
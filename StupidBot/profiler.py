@@ -0,0 +1,78 @@
+"""
+A sampling profiler for all the threads of the bot, see ProfileCommand.
+
+Every INTERVAL seconds the stacks of all the threads are read with sys._current_frames,
+which costs a few microseconds per thread and needs nothing from the profiled code.
+The result is written in the collapsed stack format, one line per stack:
+
+    thread;file.py:function;file.py:function count
+
+which flamegraph.pl (or speedscope) turns into a flame graph.
+"""
+import os
+import sys
+import threading
+import time
+
+# the functions where a thread only waits for some work, not counted in the hot functions.
+# time.sleep has no python frame, the functions calling it are listed instead
+IDLE_FRAMES = set([('threading.py', 'wait'), ('Queue.py', 'get'), ('queues.py', 'get'),
+                   ('client.py', 'process_once'), ('bot.py', 'process_forever'),
+                   ('flood.py', 'acquire'),  # the msg consumers waiting for the flood control
+                   ('asynclog.py', 'flush')])
+
+
+def _frame_name(frame):
+    return '%s:%s' % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+
+
+class SamplingProfiler(object):
+    INTERVAL = 0.005  # in seconds
+
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.stacks = {}  # (thread name, frame names from the root) -> samples
+        self.samples = 0
+
+    def run(self, seconds):
+        """
+        samples the other threads for this many seconds, blocks meanwhile
+        """
+        me = threading.current_thread().ident
+        end = time.time() + seconds
+        while time.time() < end:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread-%s' % ident))
+                key = tuple(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+            time.sleep(self.interval)
+        return self
+
+    def collapsed(self):
+        return ['%s %d' % (';'.join(stack), count) for stack, count in sorted(self.stacks.items())]
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write('\n'.join(self.collapsed()) + '\n')
+
+    def top(self, count=5):
+        """
+        the functions the busy threads were in the most, as (name, share of their samples)
+        """
+        leaves = {}
+        total = 0
+        for stack, samples in self.stacks.items():
+            if tuple(stack[-1].split(':', 1)) in IDLE_FRAMES:
+                continue
+            leaves[stack[-1]] = leaves.get(stack[-1], 0) + samples
+            total += samples
+        hot = sorted(leaves.items(), key=lambda leaf: -leaf[1])[:count]
+        return [(name, float(samples) / total) for name, samples in hot]
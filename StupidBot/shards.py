@@ -0,0 +1,202 @@
+"""
+Channel sharding: with settings.SHARDS = N, the bot forks N shard processes
+running the plugins, while the front process only owns the irc connections.
+
+* the messages of a channel (or of a nick, for the private ones) always go to the same shard,
+  picked by a hash of the network and the channel, so the plugins keep a consistent state
+  per channel (feeds, registered channels...), see BaseIrcBot.owns
+* the other events (join, nick, quit, namreply, welcome...) and the replies of the auth bot
+  go to every shard, they update the users and auths each of them tracks
+* so do the commands acting on the process (reload, flushcache, perf, profile), see BaseCommand.BROADCAST,
+  each shard replies for itself
+* the replies of the shards are sent back to the front process and go through
+  its outgoing queue, so the flood control still sees everything the bot sends
+"""
+import os
+import signal
+import zlib
+from threading import Thread
+from multiprocessing import Queue
+from Queue import Empty
+
+# never sent to the shards
+UNSHARDED_EVENTS = ('all_raw_messages', 'ping', 'pong', 'motd', 'motdstart', 'endofmotd', 'disconnect')
+# sent to the shard of their channel, or of their source for the private ones
+MESSAGE_EVENTS = ('pubmsg', 'privmsg', 'pubnotice', 'privnotice', 'action')
+
+
+def shard_of(network_name, target, count):
+    """
+    stable across processes, unlike hash()
+    """
+    key = (u'%s %s' % (network_name, target.lower())).encode('utf-8')
+    return (zlib.crc32(key) & 0xffffffff) % count
+
+
+def is_channel(target):
+    return target and target[0] in '#&+!'
+
+
+class ShardQueue(object):
+    """
+    The OutQueue of a network in a shard process, the messages are put in the one of the front process
+    """
+
+    def __init__(self, outbox, network_name):
+        self.outbox = outbox
+        self.network_name = network_name
+
+    def put(self, msg, priority):
+        self.outbox.put(('send', self.network_name, (msg.target, msg.text, priority)))
+
+    def qsize(self):
+        return 0
+
+    def depths(self):
+        return {}
+
+
+class ShardConnection(object):
+    """
+    The connection of a network in a shard process, any method call (privmsg, join, send_raw...)
+    is made on the real connection by the front process. Nothing is returned.
+    """
+
+    def __init__(self, outbox, network_name):
+        self.outbox = outbox
+        self.network_name = network_name
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.outbox.put(('call', self.network_name, (name, args, kwargs)))
+        return call
+
+
+class ShardSet(object):
+    # how often a shard checks that the front process is still alive
+    PARENT_CHECK = 1  # in seconds
+
+    def __init__(self, count):
+        self.count = count
+        self.index = None  # the index of this process, None in the front process
+        self.pids = []
+        self.inboxes = []  # the events for each shard
+        self.outbox = Queue()  # what the shards want to send
+        self.parent_pid = os.getpid()
+
+    def fork(self):
+        """
+        like os.fork: returns None in the front process and the index of the shard in the shard processes.
+        It has to be called before any thread is started.
+        """
+        for index in range(self.count):
+            inbox = Queue()
+            self.inboxes.append(inbox)
+            pid = os.fork()
+            if pid == 0:
+                self.index = index
+                self.inbox = inbox
+                return index
+            self.pids.append(pid)
+        return None
+
+    def owns(self, network_name, target):
+        return self.index is not None and shard_of(network_name, target, self.count) == self.index
+
+    def connection(self, network_name):
+        return ShardConnection(self.outbox, network_name)
+
+    def msg_queue(self, network_name):
+        return ShardQueue(self.outbox, network_name)
+
+    def stop(self):
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    # in the front process
+
+    def route(self, network, ev):
+        if ev.type in UNSHARDED_EVENTS:
+            return
+
+        if ev.type in MESSAGE_EVENTS and not self._from_auth_bot(network, ev) and not self._is_broadcast(network, ev):
+            if is_channel(ev.target):
+                key = ev.target
+            else:
+                key = getattr(ev.source, 'nick', ev.source)
+            self.inboxes[shard_of(network.network_name, key, self.count)].put((network.network_name, ev))
+        else:
+            for inbox in self.inboxes:
+                inbox.put((network.network_name, ev))
+
+    def _from_auth_bot(self, network, ev):
+        auth_bot = getattr(network.auth_plugin, 'AUTH_BOT', None)
+        return auth_bot and getattr(ev.source, 'nick', ev.source) == auth_bot.split('@')[0]
+
+    def _is_broadcast(self, network, ev):
+        """
+        a command every shard has to run (see BaseCommand.BROADCAST), the front process knows the commands of the bot
+        """
+        msg = ev.arguments[0] if ev.arguments else u''
+        if not msg.startswith(network.COMMAND_PREFIX):
+            return False
+        try:
+            cmdcls, plugin = network.get_command(msg[1:].split(' ')[0])
+        except KeyError:
+            return False
+        return cmdcls.BROADCAST
+
+    def start_front(self, bot):
+        t = Thread(target=self._front_consumer, args=(bot,), name='shards-outbox')
+        t.daemon = True
+        t.start()
+
+    def _front_consumer(self, bot):
+        while True:
+            kind, network_name, args = self.outbox.get()
+            if kind == 'quit':
+                bot.engine.call_soon(bot.quit)
+                continue
+            network = bot.networks.get(network_name)
+            if network is None:
+                continue
+            try:
+                if kind == 'send':
+                    network.send(*args)
+                else:
+                    name, call_args, call_kwargs = args
+                    getattr(network.connection, name)(*call_args, **call_kwargs)
+            except Exception, e:
+                bot.error_logger.exception('Error forwarding %s %s from a shard : %s' % (kind, args, e))
+
+    # in a shard process
+
+    def quit_front(self):
+        """
+        asks the front process to quit, which stops the shards
+        """
+        self.outbox.put(('quit', None, None))
+
+    def serve(self, bot):
+        """
+        handles the events sent by the front process, never returns
+        """
+        t = Thread(target=self._shard_consumer, args=(bot,), name='shard-inbox')
+        t.daemon = True
+        t.start()
+        # the reactor has no connection, the engine wakes it when the inbox thread or the workers schedule something
+        bot.engine.reactor.process_forever()
+
+    def _shard_consumer(self, bot):
+        while True:
+            try:
+                network_name, ev = self.inbox.get(timeout=self.PARENT_CHECK)
+            except Empty:
+                if os.getppid() != self.parent_pid:
+                    os._exit(0)  # the front process is gone
+                continue
+            # handled in the reactor thread, like in the front process
+            bot.engine.call_soon(bot._on_shard_event, network_name, ev)
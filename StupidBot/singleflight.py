@@ -0,0 +1,66 @@
+"""
+Coalesces the identical upstream requests made at the same time by the worker threads:
+when ten users ask !meteo paris within a second, only the first one fetches the weather,
+the others wait for it and get the same result (or the same exception).
+
+    weather, error = self.bot.flights.do('meteo', (location, day), get_weather, location, day)
+
+Nothing is kept once the call is done, that is the job of the response cache (see cache.py).
+"""
+import sys
+from threading import Lock, Event
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.exc_info = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.flights = {}  # (upstream, key) -> _Flight in progress
+        self._lock = Lock()
+
+        self.calls = 0
+        self.coalesced = 0
+
+    def stats(self):
+        return {'in_flight': len(self.flights), 'calls': self.calls, 'coalesced': self.coalesced}
+
+    def do(self, upstream, key, fn, *args, **kwargs):
+        """
+        returns fn(*args, **kwargs), unless a call with the same upstream and key is already
+        in progress in another thread, then waits for it and returns its result.
+        upstream names the service for the metrics, key must be hashable
+        """
+        with self._lock:
+            flight = self.flights.get((upstream, key))
+            leader = flight is None
+            if leader:
+                flight = self.flights[(upstream, key)] = _Flight()
+                self.calls += 1
+            else:
+                flight.waiters += 1
+                self.coalesced += 1
+        if self.metrics is not None:
+            self.metrics.inc('upstream_%s_total' % ('calls' if leader else 'coalesced'), upstream=upstream)
+
+        if leader:
+            try:
+                flight.result = fn(*args, **kwargs)
+            except Exception:
+                flight.exc_info = sys.exc_info()
+            finally:
+                with self._lock:
+                    del self.flights[(upstream, key)]
+                flight.done.set()
+        else:
+            flight.done.wait()
+
+        if flight.exc_info is not None:
+            raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+        return flight.result
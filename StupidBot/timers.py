@@ -0,0 +1,109 @@
+"""
+One thread for all the delayed calls of the bot: the timeouts of the auth bot queries,
+the Sleep of the coroutines (feeds, eve...), the reconnections...
+
+    timer = bot.timers.call_later(5, fn, arg)
+    timer.cancel()
+
+The timers are kept in a heap. A cancelled timer stays in it until it comes out, where it
+is skipped, unless the cancelled ones are the majority and the heap is rebuilt without them.
+The callbacks run in the timer thread, one after the other, so they must be quick:
+anything slow goes to the workers or the reactor (see Engine.call_later).
+"""
+import heapq
+import itertools
+from threading import Thread, Condition
+
+from flood import monotonic
+
+
+class Timer(object):
+    __slots__ = ('timers', 'deadline', 'fn', 'args', 'cancelled')
+
+    def __init__(self, timers, deadline, fn, args):
+        self.timers = timers
+        self.deadline = deadline
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        does nothing if the timer already fired
+        """
+        self.timers._cancel(self)
+
+
+class Timers(object):
+    # the heap is rebuilt when it holds more cancelled timers than this, and than pending ones
+    COMPACT_THRESHOLD = 100
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._heap = []  # (deadline, sequence, Timer)
+        self._sequence = itertools.count()  # the timers with the same deadline fire in order
+        self._cancelled = 0  # in the heap
+        self._cond = Condition()
+        self.fired = 0
+
+        t = Thread(target=self._run, name='timers')
+        t.daemon = True
+        t.start()
+
+    def pending(self):
+        return len(self._heap) - self._cancelled
+
+    def stats(self):
+        return {'pending': self.pending(), 'fired': self.fired}
+
+    def call_later(self, delay, fn, *args):
+        """
+        thread safe, fn(*args) will be called from the timer thread in delay seconds
+        """
+        timer = Timer(self, monotonic() + delay, fn, args)
+        with self._cond:
+            heapq.heappush(self._heap, (timer.deadline, next(self._sequence), timer))
+            if self._heap[0][2] is timer:
+                self._cond.notify()  # the thread waits for a later one
+        return timer
+
+    def _cancel(self, timer):
+        with self._cond:
+            if timer.cancelled or timer.fn is None:
+                return
+            timer.cancelled = True
+            self._cancelled += 1
+            if self._cancelled > self.COMPACT_THRESHOLD and self._cancelled * 2 > len(self._heap):
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def _next(self):
+        """
+        waits for the next timer due and pops it
+        """
+        with self._cond:
+            while True:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                    self._cancelled -= 1
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                wait = self._heap[0][0] - monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                timer = heapq.heappop(self._heap)[2]
+                fn, args = timer.fn, timer.args
+                timer.fn = timer.args = None  # fired, can't be cancelled anymore
+                self.fired += 1
+                return fn, args
+
+    def _run(self):
+        while True:
+            fn, args = self._next()
+            try:
+                fn(*args)
+            except Exception, e:
+                self.bot.error_logger.exception('Error in the timer %s : %s' % (getattr(fn, '__name__', fn), e))
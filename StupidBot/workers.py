@@ -0,0 +1,121 @@
+from threading import Thread, Lock
+from Queue import Queue, Full
+from collections import deque
+
+
+class WorkerPool(object):
+    """
+    A bounded pool of threads handling the commands and triggers,
+    so a slow one (http request, subprocess...) does not block the irc reactor.
+
+    A plugin can limit how many of its tasks run at the same time with its
+    MAX_CONCURRENCY attribute, the extra tasks wait in a per plugin queue
+    and are run as soon as one of its running tasks is done.
+
+    With 0 thread, the tasks are simply run in the calling thread.
+    """
+
+    def __init__(self, bot, size, max_queue):
+        self.bot = bot
+        self.size = size
+        self.max_queue = max_queue
+        self.tasks = Queue(max_queue)
+
+        self._lock = Lock()
+        self._running = {}  # plugin -> number of running (or queued) tasks
+        self._waiting = {}  # plugin -> deque of tasks waiting for a free slot
+        self._replaced = {}  # reloaded plugin -> the plugin which took over its slots
+
+        for i in range(size):
+            t = Thread(target=self._worker, name='worker-%d' % i)
+            t.daemon = True
+            t.start()
+
+    def queue_depth(self):
+        """
+        the number of tasks not yet running
+        """
+        with self._lock:
+            waiting = sum([len(w) for w in self._waiting.values()])
+        return self.tasks.qsize() + waiting
+
+    def stats(self):
+        with self._lock:
+            return {'queued': self.tasks.qsize(),
+                    'running': dict((p, n) for p, n in self._running.items() if n),
+                    'waiting': dict((p, len(w)) for p, w in self._waiting.items() if w)}
+
+    def submit(self, plugin, fn, *args):
+        """
+        Returns False if the task was dropped because the queue is full.
+        """
+        if not self.size:
+            self._run(fn, args)
+            return True
+
+        with self._lock:
+            plugin = self._current(plugin)
+            limit = getattr(plugin, 'MAX_CONCURRENCY', None)
+            if limit and self._running.get(plugin, 0) >= limit:
+                waiting = self._waiting.setdefault(plugin, deque())
+                if len(waiting) >= self.max_queue:
+                    return False
+                waiting.append((fn, args))
+                return True
+            self._running[plugin] = self._running.get(plugin, 0) + 1
+
+        try:
+            self.tasks.put_nowait((plugin, fn, args))
+        except Full:
+            # not _release: the next waiting task would take the slot, and be lost with it
+            with self._lock:
+                self._running[self._current(plugin)] -= 1
+            return False
+        return True
+
+    def replace(self, old, new):
+        """
+        the plugin old was reloaded as new, which takes over its slots:
+        the tasks of old still running count in the MAX_CONCURRENCY of new
+        """
+        with self._lock:
+            self._replaced[old] = new
+            for plugin, current in self._replaced.items():
+                if current is old:
+                    self._replaced[plugin] = new
+            self._running[new] = self._running.get(new, 0) + self._running.pop(old, 0)
+            waiting = self._waiting.pop(old, None)
+            if waiting:
+                self._waiting.setdefault(new, deque()).extend(waiting)
+
+    def _current(self, plugin):
+        """
+        called with the lock held
+        """
+        return self._replaced.get(plugin, plugin)
+
+    def _release(self, plugin):
+        """
+        frees a slot of plugin, or return its next waiting task, which takes the slot.
+        """
+        with self._lock:
+            plugin = self._current(plugin)
+            waiting = self._waiting.get(plugin)
+            if waiting:
+                return waiting.popleft()
+            self._running[plugin] -= 1
+        return None
+
+    def _run(self, fn, args):
+        try:
+            fn(*args)
+        except BaseException, e:  # a SystemExit would silently kill the worker thread
+            self.bot.error_logger.exception('Error in %s : %r' % (getattr(fn, '__name__', fn), e))
+
+    def _worker(self):
+        while True:
+            plugin, fn, args = self.tasks.get()
+            task = (fn, args)
+            while task:
+                self._run(*task)
+                task = self._release(plugin)